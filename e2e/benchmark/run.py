@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""Training throughput scaling benchmark.
+
+Runs train_synthetic.py on 1, 2, 4 ... N nodes of the current stack with
+chainer-mpirun and writes a JSON report of samples/s, step time
+percentiles and scaling efficiency against one node:
+
+    python3 run.py --out report.json
+
+With --local, it runs 1, 2, 4 ... processes on this host on CPU with
+mpiexec instead, so that it works on any Linux machine with Chainer,
+ChainerMN and MPI.
+
+Reports of different template versions or instance types are compared
+with:
+
+    python3 run.py diff old.json new.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import urllib.request
+
+SCHEMA_VERSION = 1
+HERE = os.path.dirname(os.path.abspath(__file__))
+TRAIN = os.path.join(HERE, 'train_synthetic.py')
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+# nodes with GPUs, written by the agent
+HOSTFILE = '/usr/local/mpi/etc/openmpi-default-hostfile'
+NODE_CONFIG = '/etc/chainer-cfn/node.json'
+
+
+def scales(n):
+    """Returns 1, 2, 4 ... up to ``n``, and ``n``."""
+    result = []
+    s = 1
+    while s < n:
+        result.append(s)
+        s *= 2
+    return result + [n]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(result):
+    steps = result['step_times']
+    return {
+        'mean': sum(steps) / len(steps),
+        'p50': percentile(steps, 50),
+        'p90': percentile(steps, 90),
+        'p99': percentile(steps, 99),
+        'min': min(steps),
+        'max': max(steps),
+    }
+
+
+def run_one(cmd):
+    sys.stderr.write('+ %s\n' % ' '.join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    result = None
+    for line in proc.stdout:
+        line = line.decode('utf-8', 'replace')
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+        else:
+            sys.stderr.write(line)
+    if proc.wait() != 0 or result is None:
+        raise RuntimeError('benchmark failed: %s' % ' '.join(cmd))
+    return result
+
+
+def _imds(path):
+    try:
+        url = 'http://169.254.169.254/latest/meta-data/' + path
+        with urllib.request.urlopen(url, timeout=2) as res:
+            return res.read().decode('utf-8')
+    except Exception:
+        return None
+
+
+def environment(args):
+    if args.local:
+        return {
+            'hostname': platform.node(),
+            'cpus': os.cpu_count(),
+            'platform': platform.platform(),
+        }
+    with open(NODE_CONFIG) as f:
+        conf = json.load(f)
+    return {
+        'cluster_name': conf['cluster_name'],
+        'region': conf['region'],
+        'node_groups': conf.get('node_groups'),
+        'launching_instance_type': _imds('instance-type'),
+    }
+
+
+def count_hosts(path):
+    with open(path) as f:
+        return len([l for l in f if l.strip() and not l.startswith('#')])
+
+
+def benchmark(args, workload):
+    if args.local:
+        max_scale = args.max_procs or min(os.cpu_count() or 1, 4)
+        base = ['mpiexec', '--oversubscribe'] if args.oversubscribe else ['mpiexec']
+    else:
+        max_scale = args.max_nodes or count_hosts(args.hostfile)
+        # ranks on the other nodes need the script at the same path
+        subprocess.check_call(['chainer-bcast', '--hostfile', args.hostfile, TRAIN])
+    results = []
+    for n in scales(max_scale):
+        if args.local:
+            cmd = base + ['-n', str(n), sys.executable, TRAIN] + workload
+        else:
+            cmd = ['chainer-mpirun', '--hostfile', args.hostfile, '--nodes', str(n),
+                   'python3', TRAIN, '--gpu'] + workload
+        r = run_one(cmd)
+        results.append({
+            'scale': n,
+            'ranks': r['ranks'],
+            'samples_per_sec': r['samples_per_sec'],
+            'step_time': summarize(r),
+            'step_times': r['step_times'],
+            'versions': {k: r[k] for k in ['chainer', 'chainermn', 'cupy'] if k in r},
+        })
+    for r in results:
+        r['scaling_efficiency'] = r['samples_per_sec'] / (results[0]['samples_per_sec'] * r['scale'])
+    return results
+
+
+def report_table(report):
+    unit = 'procs' if report['mode'] == 'local' else 'nodes'
+    lines = ['%6s %6s %12s %10s %10s %10s' % (unit, 'ranks', 'samples/s', 'p50 ms', 'p99 ms', 'efficiency')]
+    for r in report['results']:
+        lines.append('%6d %6d %12.1f %10.1f %10.1f %9.1f%%' % (
+            r['scale'], r['ranks'], r['samples_per_sec'], r['step_time']['p50'] * 1000,
+            r['step_time']['p99'] * 1000, r['scaling_efficiency'] * 100))
+    return '\n'.join(lines) + '\n'
+
+
+def diff(a, b):
+    if a['schema_version'] != b['schema_version']:
+        sys.stderr.write('warning: schema versions differ: %d, %d\n' % (a['schema_version'], b['schema_version']))
+    if a['workload'] != b['workload']:
+        sys.stderr.write('warning: workloads differ\n')
+    old = {r['scale']: r for r in a['results']}
+    lines = ['%6s %12s %12s %8s %10s %10s' % ('scale', 'old samp/s', 'new samp/s', 'change', 'old eff', 'new eff')]
+    for r in b['results']:
+        o = old.get(r['scale'])
+        if o is None:
+            continue
+        lines.append('%6d %12.1f %12.1f %+7.1f%% %9.1f%% %9.1f%%' % (
+            r['scale'], o['samples_per_sec'], r['samples_per_sec'],
+            100.0 * (r['samples_per_sec'] / o['samples_per_sec'] - 1),
+            o['scaling_efficiency'] * 100, r['scaling_efficiency'] * 100))
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['diff']:
+        p = argparse.ArgumentParser(prog='run.py diff')
+        p.add_argument('old')
+        p.add_argument('new')
+        args = p.parse_args(argv[1:])
+        with open(args.old) as f, open(args.new) as g:
+            sys.stdout.write(diff(json.load(f), json.load(g)))
+        return 0
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--local', action='store_true', help='CPU only, processes on this host')
+    parser.add_argument('--max-procs', type=int, help='with --local (default: min(cpus, 4))')
+    parser.add_argument('--oversubscribe', action='store_true', help='pass --oversubscribe to mpiexec')
+    parser.add_argument('--hostfile', default=HOSTFILE)
+    parser.add_argument('--max-nodes', type=int, help='default: all the hosts in the hostfile')
+    parser.add_argument('--template-version', help='recorded in the report')
+    parser.add_argument('--label', help='free text recorded in the report')
+    parser.add_argument('--batchsize', type=int)
+    parser.add_argument('--iterations', type=int)
+    parser.add_argument('--out', default='benchmark-%s.json' % time.strftime('%Y%m%d-%H%M%S'),
+                        help='"-" for stdout')
+    args = parser.parse_args(argv)
+
+    # small enough to finish in a few minutes on CPU
+    batchsize = args.batchsize or (8 if args.local else 64)
+    iterations = args.iterations or (10 if args.local else 50)
+    workload = ['--batchsize', str(batchsize), '--iterations', str(iterations)]
+    if args.local:
+        workload += ['--image-size', '32', '--channels', '16', '--warmup', '2']
+
+    report = {
+        'schema_version': SCHEMA_VERSION,
+        'mode': 'local' if args.local else 'cluster',
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'template_version': args.template_version,
+        'label': args.label,
+        'environment': environment(args),
+        'workload': {'script': os.path.basename(TRAIN), 'args': workload},
+    }
+    report['results'] = benchmark(args, workload)
+    text = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.out == '-':
+        sys.stdout.write(text)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(text)
+        sys.stderr.write('report is written to %s\n' % args.out)
+    sys.stderr.write(report_table(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Fixed ChainerMN training workload on synthetic data.
+
+Trains a small convolutional network on random images for a fixed number
+of iterations and prints the step times (the slowest rank of each step)
+as a JSON line prefixed with ``RESULT_PREFIX`` from rank 0.  The
+data never leaves memory so that the result only depends on compute and
+communication.
+"""
+import argparse
+import json
+import time
+
+import chainer
+import chainer.functions as F
+import chainer.links as L
+import chainermn
+from mpi4py import MPI
+import numpy as np
+
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+
+class ConvNet(chainer.Chain):
+
+    def __init__(self, channels, n_class=1000):
+        super(ConvNet, self).__init__()
+        with self.init_scope():
+            self.conv1 = L.Convolution2D(3, channels, 3, pad=1)
+            self.conv2 = L.Convolution2D(channels, channels * 2, 3, pad=1)
+            self.conv3 = L.Convolution2D(channels * 2, channels * 4, 3, pad=1)
+            self.conv4 = L.Convolution2D(channels * 4, channels * 8, 3, pad=1)
+            self.fc1 = L.Linear(None, 1024)
+            self.fc2 = L.Linear(1024, n_class)
+
+    def __call__(self, x, t):
+        h = x
+        for conv in [self.conv1, self.conv2, self.conv3, self.conv4]:
+            h = F.max_pooling_2d(F.relu(conv(h)), 2)
+        h = F.relu(self.fc1(h))
+        return F.softmax_cross_entropy(self.fc2(h), t)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--communicator', default=None,
+                        help='default: pure_nccl with --gpu, otherwise naive')
+    parser.add_argument('--batchsize', type=int, default=64, help='per rank')
+    parser.add_argument('--image-size', type=int, default=64)
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    communicator = args.communicator or ('pure_nccl' if args.gpu else 'naive')
+    comm = chainermn.create_communicator(communicator)
+    model = ConvNet(args.channels)
+    xp = np
+    if args.gpu:
+        import cupy
+        chainer.cuda.get_device_from_id(comm.intra_rank).use()
+        model.to_gpu()
+        xp = cupy
+    optimizer = chainermn.create_multi_node_optimizer(
+        chainer.optimizers.MomentumSGD(lr=0.01), comm)
+    optimizer.setup(model)
+
+    rng = np.random.RandomState(comm.rank)
+    x = xp.asarray(rng.uniform(-1, 1, (args.batchsize, 3, args.image_size, args.image_size))
+                   .astype(np.float32))
+    t = xp.asarray(rng.randint(0, 1000, args.batchsize).astype(np.int32))
+
+    def step():
+        optimizer.update(model, x, t)
+        if args.gpu:
+            cupy.cuda.Device().synchronize()
+
+    for _ in range(args.warmup):
+        step()
+    comm.mpi_comm.Barrier()
+    step_times = []
+    for _ in range(args.iterations):
+        start = time.time()
+        step()
+        step_times.append(time.time() - start)
+    # a step is as slow as the slowest rank
+    local = np.array(step_times)
+    step_times = np.empty_like(local)
+    comm.mpi_comm.Allreduce(local, step_times, op=MPI.MAX)
+
+    if comm.rank != 0:
+        return
+    result = {
+        'ranks': comm.size,
+        'nodes': comm.inter_size,
+        'communicator': communicator,
+        'gpu': args.gpu,
+        'batchsize_per_rank': args.batchsize,
+        'image_size': args.image_size,
+        'channels': args.channels,
+        'iterations': args.iterations,
+        'step_times': [float(s) for s in step_times],
+        'samples_per_sec': args.batchsize * comm.size * len(step_times) / float(sum(step_times)),
+        'chainer': chainer.__version__,
+        'chainermn': chainermn.__version__,
+    }
+    if args.gpu:
+        result['cupy'] = cupy.__version__
+    print(RESULT_PREFIX + json.dumps(result, sort_keys=True), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Loads the generated template and resolves it as CloudFormation would.
+
+Only what the node metadata and user data use is supported: parameters,
+pseudo parameters, conditions, mappings and the intrinsic functions
+emitted by template/main.py.  References to resources resolve to the
+fake physical ids given by the simulator.
+"""
+import os
+import subprocess
+import sys
+
+import cfn_flip
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(HERE, '..', '..', 'template')
+
+
+class _NoValue(object):
+    pass
+
+
+NO_VALUE = _NoValue()
+
+
+def load(path):
+    with open(path) as f:
+        return cfn_flip.load_yaml(f.read())
+
+
+def generate(python=sys.executable):
+    """Runs template/main.py and returns the template."""
+    out = subprocess.check_output([python, 'main.py'], cwd=TEMPLATE_DIR)
+    return cfn_flip.load_yaml(out.decode('utf-8'))
+
+
+class Resolver(object):
+
+    def __init__(self, template, parameters, pseudo, physical_ids, attributes):
+        self.template = template
+        self.params = {}
+        for name, p in template.get('Parameters', {}).items():
+            value = parameters.get(name, p.get('Default', ''))
+            self.params[name] = str(value)
+        self.pseudo = pseudo
+        self.physical_ids = physical_ids
+        self.attributes = attributes
+        self.conditions = {}
+
+    def condition(self, name):
+        if name not in self.conditions:
+            self.conditions[name] = bool(self.resolve(self.template['Conditions'][name]))
+        return self.conditions[name]
+
+    def ref(self, name):
+        if name == 'AWS::NoValue':
+            return NO_VALUE
+        if name in self.pseudo:
+            return self.pseudo[name]
+        if name in self.params:
+            return self.params[name]
+        return self.physical_ids.get(name, 'sim-%s' % name.lower())
+
+    def resolve(self, x):
+        if isinstance(x, list):
+            items = [self.resolve(i) for i in x]
+            return [i for i in items if i is not NO_VALUE]
+        if not isinstance(x, dict):
+            return x
+        if len(x) == 1:
+            (k, v), = x.items()
+            if k == 'Ref':
+                return self.ref(v)
+            if k == 'Condition' and isinstance(v, str):
+                return self.condition(v)
+            if k.startswith('Fn::'):
+                return self._function(k[4:], v)
+        result = {}
+        for k, v in x.items():
+            v = self.resolve(v)
+            if v is not NO_VALUE:
+                result[k] = v
+        return result
+
+    def _function(self, name, v):
+        if name == 'If':
+            return self.resolve(v[1] if self.condition(v[0]) else v[2])
+        if name == 'Equals':
+            a, b = self.resolve(v)
+            return str(a) == str(b)
+        if name == 'Not':
+            return not self.resolve(v[0])
+        if name == 'And':
+            return all(self.resolve(c) for c in v)
+        if name == 'Or':
+            return any(self.resolve(c) for c in v)
+        if name == 'Join':
+            sep, items = v[0], self.resolve(v[1])
+            return sep.join(str(i) for i in items)
+        if name == 'Select':
+            return self.resolve(v[1])[int(self.resolve(v[0]))]
+        if name == 'Split':
+            return str(self.resolve(v[1])).split(v[0])
+        if name == 'FindInMap':
+            m, k1, k2 = self.resolve(v)
+            return self.template['Mappings'][m][k1][k2]
+        if name == 'GetAtt':
+            resource, attribute = v
+            return self.attributes.get((resource, attribute), 'sim-%s-%s' % (resource, attribute))
+        if name == 'Base64':
+            return self.resolve(v)
+        if name == 'GetAZs':
+            return [self.pseudo['AWS::Region'] + 'a']
+        if name == 'Sub':
+            text = v if isinstance(v, str) else v[0]
+            variables = {} if isinstance(v, str) else self.resolve(v[1])
+            for key in _sub_names(text):
+                if key in variables:
+                    value = variables[key]
+                elif '.' in key:
+                    value = self._function('GetAtt', key.split('.', 1))
+                else:
+                    value = self.ref(key)
+                text = text.replace('${%s}' % key, str(value))
+            return text
+        raise ValueError('unsupported function Fn::%s' % name)
+
+    def resource(self, name):
+        """Returns the resolved properties and metadata of a resource, or ``None``."""
+        r = self.template['Resources'][name]
+        if 'Condition' in r and not self.condition(r['Condition']):
+            return None
+        return {
+            'Type': r['Type'],
+            'Properties': self.resolve(r.get('Properties', {})),
+            'Metadata': self.resolve(r.get('Metadata', {})),
+        }
+
+
+def _sub_names(text):
+    names = []
+    start = text.find('${')
+    while start >= 0:
+        end = text.find('}', start)
+        names.append(text[start + 2:end])
+        start = text.find('${', end)
+    return names
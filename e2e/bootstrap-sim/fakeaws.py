@@ -0,0 +1,341 @@
+"""Fake IMDS and AWS endpoints of the bootstrap simulator.
+
+One API endpoint serves every service the nodes call (S3, EC2,
+CloudFormation, Auto Scaling, CloudWatch, EFS) through
+``AWS_ENDPOINT_URL``, and one IMDS endpoint serves the instance metadata.
+Each node has its own address, by which every call is counted per node
+and per action.  ``/_sim/`` paths are the simulator's own channel
+(bootstrap phases, the node bundle) and are not counted.
+"""
+import collections
+import email.utils
+import hashlib
+import http.server
+import json
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+from xml.sax.saxutils import escape
+
+EC2_NS = 'http://ec2.amazonaws.com/doc/2016-11-15/'
+CFN_NS = 'http://cloudformation.amazonaws.com/doc/2010-05-15/'
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _xml(value):
+    if isinstance(value, dict):
+        return ''.join('<%s>%s</%s>' % (k, _xml(v), k) for k, v in value.items())
+    if isinstance(value, list):
+        return ''.join('<item>%s</item>' % _xml(v) for v in value)
+    return escape(str(value))
+
+
+class State(object):
+    """Instances, objects, stack metadata and the calls made by each node."""
+
+    def __init__(self, stack_name, api_latency=0.0):
+        self.stack_name = stack_name
+        self.api_latency = api_latency
+        self.lock = threading.Lock()
+        self.instances = collections.OrderedDict()  # node name -> instance dict
+        self.addresses = {}  # private ip -> node name
+        self.objects = {}  # (bucket, key) -> bytes
+        self.metadata = {}  # logical id -> metadata
+        self.calls = []  # (time, node, service, action)
+        self.events = []  # (time, node, event, detail)
+        self.signals = {}  # node -> (time, status)
+        self.bundle = b''
+
+    def call(self, node, service, action):
+        with self.lock:
+            self.calls.append((time.time(), node, service, action))
+
+    def event(self, node, name, detail=None):
+        with self.lock:
+            self.events.append((time.time(), node, name, detail))
+
+    def node_of_instance(self, instance_id):
+        for node, i in self.instances.items():
+            if i['InstanceId'] == instance_id:
+                return node
+        return None
+
+
+#
+# IMDS
+#
+def imds_handler(state):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, code, body):
+            body = body.encode()
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_PUT(self):
+            # IMDSv2 token
+            self._reply(200, 'sim-token')
+
+        def do_GET(self):
+            node = state.addresses.get(self.client_address[0])
+            if node is None:
+                return self._reply(404, 'unknown node')
+            i = state.instances[node]
+            values = {
+                'instance-id': i['InstanceId'],
+                'instance-type': i['InstanceType'],
+                'local-hostname': i['PrivateDnsName'],
+                'hostname': i['PrivateDnsName'],
+                'local-ipv4': i['PrivateIpAddress'],
+                'placement/availability-zone': i['Placement']['AvailabilityZone'],
+                'placement/group-name': i['Placement'].get('GroupName', ''),
+            }
+            path = self.path.split('/latest/meta-data/', 1)[-1]
+            state.call(node, 'imds', path)
+            if path in values:
+                self._reply(200, values[path])
+            else:
+                self._reply(404, 'not found')
+
+    return Handler
+
+
+#
+# API
+#
+def _decode_aws_chunked(body):
+    out = b''
+    while body:
+        header, _, rest = body.partition(b'\r\n')
+        size = int(header.split(b';')[0], 16)
+        if size == 0:
+            break
+        out += rest[:size]
+        body = rest[size + 2:]
+    return out
+
+
+def api_handler(state):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, code, body=b'', headers=None):
+            if isinstance(body, str):
+                body = body.encode()
+            self.send_response(code)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def _body(self):
+            if self.headers.get('Transfer-Encoding') == 'chunked':
+                data = b''
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    if size == 0:
+                        # trailers up to the empty line
+                        while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                            pass
+                        break
+                    data += self.rfile.read(size)
+                    self.rfile.readline()
+            else:
+                data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+                data = _decode_aws_chunked(data)
+            return data
+
+        def _identity(self):
+            node = state.addresses.get(self.client_address[0])
+            m = re.search(r'Credential=[^/]+/[^/]+/[^/]+/([^/]+)/', self.headers.get('Authorization', ''))
+            return node, m.group(1) if m else None
+
+        def _handle(self):
+            if self.path.startswith('/_sim/'):
+                return self._sim()
+            body = self._body()
+            node, service = self._identity()
+            if state.api_latency:
+                time.sleep(state.api_latency)
+            if service == 's3':
+                return self._s3(node, body)
+            content_type = self.headers.get('Content-Type', '')
+            if 'cbor' in content_type:
+                # smithy-rpc-v2-cbor, e.g. CloudWatch; no output is an empty map
+                state.call(node, service, self.path.rsplit('/', 1)[-1])
+                return self._reply(200, b'\xa0', {'Content-Type': 'application/cbor',
+                                                  'smithy-protocol': 'rpc-v2-cbor'})
+            if 'x-www-form-urlencoded' in content_type:
+                params = dict(urllib.parse.parse_qsl(body.decode()))
+                state.call(node, service, params.get('Action'))
+                return self._query(node, service, params)
+            # rest-json (e.g. EFS) and json
+            action = self.headers.get('X-Amz-Target', self.path).rsplit('.', 1)[-1]
+            state.call(node, service, action)
+            return self._reply(200, '{}', {'Content-Type': 'application/json'})
+
+        do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _handle
+
+        #
+        # simulator channel
+        #
+        def _sim(self):
+            if self.path == '/_sim/bundle.tar.gz':
+                return self._reply(200, state.bundle)
+            data = json.loads(self._body().decode() or '{}')
+            if self.path == '/_sim/event':
+                state.event(state.addresses.get(self.client_address[0]), data['event'], data.get('detail'))
+            return self._reply(200, '{}')
+
+        #
+        # query protocols
+        #
+        def _query(self, node, service, params):
+            action = params.get('Action')
+            if service == 'ec2' and action == 'DescribeInstances':
+                return self._xml_reply(action, EC2_NS, self._describe_instances(params), wrap=False)
+            if service == 'cloudformation' and action == 'DescribeStackResource':
+                metadata = state.metadata.get(params['LogicalResourceId'], {})
+                text = json.dumps(metadata)
+                detail = {'StackResourceDetail': collections.OrderedDict([
+                    ('StackName', state.stack_name),
+                    ('LogicalResourceId', params['LogicalResourceId']),
+                    ('ResourceType', 'AWS::EC2::Instance'),
+                    ('LastUpdatedTimestamp', '2020-01-01T00:00:00Z'),
+                    ('ResourceStatus', 'CREATE_IN_PROGRESS'),
+                    ('Metadata', text),
+                ])}
+                return self._xml_reply(action, CFN_NS, detail)
+            if service == 'cloudformation' and action == 'SignalResource':
+                sender = state.node_of_instance(params.get('UniqueId')) or node
+                with state.lock:
+                    state.signals[sender] = (time.time(), params.get('Status'))
+            return self._xml_reply(action, '', {})
+
+        def _xml_reply(self, action, ns, result, wrap=True):
+            inner = _xml(result)
+            if wrap:
+                inner = '<%sResult>%s</%sResult>' % (action, inner, action)
+            xmlns = ' xmlns="%s"' % ns if ns else ''
+            body = '<?xml version="1.0"?><%sResponse%s>%s<requestId>sim</requestId>' \
+                   '<ResponseMetadata><RequestId>sim</RequestId></ResponseMetadata></%sResponse>' % (
+                       action, xmlns, inner, action)
+            self._reply(200, body, {'Content-Type': 'text/xml'})
+
+        def _describe_instances(self, params):
+            filters = {}
+            for k, v in params.items():
+                m = re.match(r'Filter\.(\d+)\.Name$', k)
+                if m:
+                    n = m.group(1)
+                    filters[v] = [params[x] for x in sorted(params) if x.startswith('Filter.%s.Value.' % n)]
+            reservations = []
+            for i in list(state.instances.values()):
+                if not _matches(i, filters):
+                    continue
+                placement = collections.OrderedDict([('availabilityZone', i['Placement']['AvailabilityZone'])])
+                if i['Placement'].get('GroupName'):
+                    placement['groupName'] = i['Placement']['GroupName']
+                item = collections.OrderedDict([
+                    ('instanceId', i['InstanceId']),
+                    ('instanceType', i['InstanceType']),
+                    ('privateDnsName', i['PrivateDnsName']),
+                    ('privateIpAddress', i['PrivateIpAddress']),
+                    ('instanceState', {'code': 16, 'name': i['State']['Name']}),
+                    ('placement', placement),
+                    ('launchTime', '2020-01-01T00:00:00.000Z'),
+                    ('tagSet', [{'key': t['Key'], 'value': t['Value']} for t in i['Tags']]),
+                ])
+                reservations.append({'reservationId': 'r-' + i['InstanceId'], 'instancesSet': [item]})
+            return {'reservationSet': reservations}
+
+        #
+        # S3 (path style)
+        #
+        def _s3(self, node, body):
+            url = urllib.parse.urlparse(self.path)
+            parts = url.path.lstrip('/').split('/', 1)
+            bucket = parts[0]
+            key = urllib.parse.unquote(parts[1]) if len(parts) > 1 else ''
+            query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+            if not key:
+                state.call(node, 's3', 'ListObjectsV2' if self.command == 'GET' else self.command + 'Bucket')
+                return self._s3_list(bucket, query.get('prefix', ''))
+            action = {'GET': 'GetObject', 'HEAD': 'HeadObject', 'PUT': 'PutObject',
+                      'DELETE': 'DeleteObject'}.get(self.command, self.command)
+            state.call(node, 's3', action)
+            if self.command == 'PUT':
+                state.objects[(bucket, key)] = body
+                return self._reply(200, b'', {'ETag': '"%s"' % hashlib.md5(body).hexdigest()})
+            if self.command == 'DELETE':
+                state.objects.pop((bucket, key), None)
+                return self._reply(204)
+            data = state.objects.get((bucket, key))
+            if data is None:
+                return self._reply(404, '<Error><Code>NoSuchKey</Code><Message>sim</Message></Error>'
+                                   if self.command == 'GET' else b'', {'Content-Type': 'application/xml'})
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                return self._reply(304, b'', {'ETag': etag})
+            headers = {'ETag': etag, 'Last-Modified': email.utils.formatdate(usegmt=True),
+                       'Content-Type': 'binary/octet-stream'}
+            self._reply(200, data, headers)
+
+        def _s3_list(self, bucket, prefix):
+            keys = sorted(k for b, k in state.objects if b == bucket and k.startswith(prefix))
+            contents = ''.join(
+                '<Contents><Key>%s</Key><Size>%d</Size><ETag>"%s"</ETag></Contents>' % (
+                    escape(k), len(state.objects[(bucket, k)]),
+                    hashlib.md5(state.objects[(bucket, k)]).hexdigest())
+                for k in keys)
+            body = '<?xml version="1.0"?><ListBucketResult xmlns="%s"><Name>%s</Name><Prefix>%s</Prefix>' \
+                   '<KeyCount>%d</KeyCount><IsTruncated>false</IsTruncated>%s</ListBucketResult>' % (
+                       S3_NS, bucket, escape(prefix), len(keys), contents)
+            self._reply(200, body, {'Content-Type': 'application/xml'})
+
+    return Handler
+
+
+def _matches(instance, filters):
+    tags = {t['Key']: t['Value'] for t in instance['Tags']}
+    for name, values in filters.items():
+        if name.startswith('tag:'):
+            actual = tags.get(name[4:])
+        elif name == 'instance-state-name':
+            actual = instance['State']['Name']
+        elif name == 'instance-id':
+            actual = instance['InstanceId']
+        else:
+            continue
+        if actual not in values:
+            return False
+    return True
+
+
+def serve(handler, port, host='127.0.0.1'):
+    server = _Server((host, port), handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+"""Offline bootstrap simulator.
+
+Boots the master and the workers of a generated template on this Linux
+host, without AWS, and reports the time each node takes to become ready
+and the AWS API calls it makes:
+
+    sudo PYTHONPATH=build/bootstrap-sim/lib python3 e2e/bootstrap-sim/sim.py \\
+        --template build/template.yaml --out build/bootstrap-sim/report.json
+
+Each node is a network namespace with its own address on a bridge, and a
+mount, UTS and PID namespace whose root is an overlay of the host's root.
+The user data of the node (resolved from the template with the given
+parameters) runs there as on first boot: cfn-init applies the metadata,
+the pre-flight check runs, cfn-signal reports and the agent starts.  As
+on a fresh AMI, boto3 is not importable by the node's python until the
+agent configset installs it, from the wheels of --wheels.  A fake IMDS, S3, EC2 and CloudFormation (fakeaws.py) answer on the host
+address of the bridge, and a directory shared by all the nodes stands in
+for EFS.  Privileged operations which would change the host (packages,
+host services, link settings) are stubbed in stubs/; /proc/sys and /sys
+are read-only in the nodes, so tuning reports failures instead.
+
+The report has, per node, the time to ready (cfn-signal) from the start
+of the node and of each bootstrap phase, and the AWS API calls per minute
+during bootstrap and while the agents run for --observe seconds after all
+the nodes are ready.  With --baseline it fails when a run becomes slower
+or chattier than the recorded one.
+
+Requires root, iproute2 and overlayfs, and a Debian or Ubuntu host
+(init scripts use start-stop-daemon and lsb init-functions).
+"""
+import argparse
+import collections
+import io
+import ipaddress
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tarfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import cfn  # NOQA
+import fakeaws  # NOQA
+
+SCHEMA_VERSION = 1
+NODE_DIR = os.path.join(HERE, '..', '..', 'node')
+STUBS_DIR = os.path.join(HERE, 'stubs')
+BRIDGE = 'chainersim0'
+NETNS_PREFIX = 'chainer-sim-'
+API_PORT = 18080
+IMDS_PORT = 18169
+REAL_IMDS = 'http://169.254.169.254'
+STACK_NAME = 'sim'
+PSEUDO = {
+    'AWS::StackName': STACK_NAME,
+    'AWS::StackId': 'arn:aws:cloudformation:us-east-1:123456789012:stack/sim/sim',
+    'AWS::Region': 'us-east-1',
+    'AWS::AccountId': '123456789012',
+    'AWS::Partition': 'aws',
+    'AWS::URLSuffix': 'amazonaws.com',
+}
+AWS_CONFIG = """[default]
+s3 =
+    addressing_style = path
+"""
+
+
+def _log(message, *args):
+    sys.stderr.write('[%s] %s\n' % (time.strftime('%H:%M:%S'), message % args))
+    sys.stderr.flush()
+
+
+def bundle():
+    """Returns the node bundle as `make bundle` builds it."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        tar.add(NODE_DIR, arcname='.',
+                filter=lambda t: None if '__pycache__' in t.name else t)
+    return buf.getvalue()
+
+
+#
+# Nodes
+#
+def plan(template, parameters, subnet):
+    """Returns the nodes of the stack and the metadata of each resource.
+
+    The first address of ``subnet`` is the host's, and nodes get addresses
+    from the 11th on.
+    """
+    resolver = cfn.Resolver(template, parameters, PSEUDO, {}, {})
+    hosts = subnet.hosts()
+    host_address = str(next(hosts))
+    for _ in range(9):
+        next(hosts)
+
+    def rewrite(value):
+        # IMDS of the nodes is on the host address of the bridge
+        text = json.dumps(value).replace(REAL_IMDS, 'http://%s:%d' % (host_address, IMDS_PORT))
+        return json.loads(text)
+
+    groups = [('master', 'ClusterMaster', resolver.resource('ClusterMaster'), None, 1)]
+    for name, r in sorted(template['Resources'].items()):
+        if r['Type'] != 'AWS::AutoScaling::AutoScalingGroup':
+            continue
+        asg = resolver.resource(name)
+        if asg is None:
+            continue
+        lc = r['Properties']['LaunchConfigurationName']['Ref']
+        groups.append((name, lc, resolver.resource(lc), asg, int(asg['Properties']['DesiredCapacity'])))
+
+    nodes = []
+    metadata = {}
+    for asg_name, logical_id, resource, asg, count in groups:
+        metadata[logical_id] = rewrite(resource['Metadata'])
+        relax_preflight(metadata[logical_id])
+        props = resource['Properties']
+        if asg is None:
+            tags = props['Tags']
+            placement_group = props.get('PlacementGroupName')
+        else:
+            tags = [{'Key': t['Key'], 'Value': t['Value']} for t in asg['Properties']['Tags']]
+            tags.append({'Key': 'aws:autoscaling:groupName', 'Value': asg_name})
+            placement_group = asg['Properties'].get('PlacementGroup')
+        role = {t['Key']: t['Value'] for t in tags}['ChainerClusterRole']
+        group = {t['Key']: t['Value'] for t in tags}['ChainerClusterNodeGroup']
+        for k in range(count):
+            address = str(next(hosts))
+            nodes.append({
+                'name': group if asg is None else '%s-%d' % (group, k),
+                'role': role,
+                'address': address,
+                'hostname': 'ip-' + address.replace('.', '-'),
+                'user_data': rewrite(props['UserData']),
+                'instance': {
+                    'InstanceId': 'i-%017x' % (len(nodes) + 1),
+                    'InstanceType': props['InstanceType'],
+                    'PrivateDnsName': 'ip-%s.ec2.internal' % address.replace('.', '-'),
+                    'PrivateIpAddress': address,
+                    'State': {'Name': 'pending'},
+                    'Placement': {'AvailabilityZone': PSEUDO['AWS::Region'] + 'a',
+                                  'GroupName': placement_group or ''},
+                    'Tags': tags,
+                },
+            })
+    return nodes, metadata
+
+
+def relax_preflight(metadata):
+    """Drops the GPU checks and the bandwidth thresholds of the pre-flight check.
+
+    The nodes have no GPU, and share the host's CPU and memory bandwidth,
+    which has nothing to do with the network of the instance types.
+    """
+    for config in metadata.get('AWS::CloudFormation::Init', {}).values():
+        spec = config.get('files', {}).get('/etc/chainer-cfn/node.json') if isinstance(config, dict) else None
+        if spec and 'preflight' in spec['content']:
+            for key in ['GpuCount', 'MinLoopbackGbps', 'MinMasterGbps']:
+                spec['content']['preflight'][key] = 0
+
+
+def setup_network(host_address, subnet, nodes):
+    prefix = '/%d' % subnet.prefixlen
+    subprocess.check_call(['ip', 'link', 'add', BRIDGE, 'type', 'bridge'])
+    subprocess.check_call(['ip', 'addr', 'add', host_address + prefix, 'dev', BRIDGE])
+    subprocess.check_call(['ip', 'link', 'set', BRIDGE, 'up'])
+    for i, node in enumerate(nodes):
+        netns = NETNS_PREFIX + node['name']
+        veth = 'csim%d' % i
+        subprocess.check_call(['ip', 'netns', 'add', netns])
+        subprocess.check_call(['ip', 'link', 'add', veth, 'type', 'veth',
+                               'peer', 'name', 'eth0', 'netns', netns])
+        subprocess.check_call(['ip', 'link', 'set', veth, 'master', BRIDGE, 'up'])
+        subprocess.check_call(['ip', '-n', netns, 'addr', 'add', node['address'] + prefix, 'dev', 'eth0'])
+        subprocess.check_call(['ip', '-n', netns, 'link', 'set', 'eth0', 'up'])
+        subprocess.check_call(['ip', '-n', netns, 'link', 'set', 'lo', 'up'])
+        subprocess.check_call(['ip', '-n', netns, 'route', 'add', 'default', 'via', host_address])
+
+
+def teardown_network(nodes):
+    for node in nodes:
+        subprocess.call(['ip', 'netns', 'del', NETNS_PREFIX + node['name']], stderr=subprocess.DEVNULL)
+    subprocess.call(['ip', 'link', 'del', BRIDGE], stderr=subprocess.DEVNULL)
+
+
+def start_node(node, nodes, workdir, host_address, site_packages, wheels):
+    node_dir = os.path.join(workdir, node['name'])
+    os.makedirs(os.path.join(node_dir, 'fs'))
+    os.makedirs(os.path.join(node_dir, 'log'))
+    api = 'http://%s:%d' % (host_address, API_PORT)
+    spec = {
+        'hostname': node['hostname'],
+        'hosts': ''.join('%s %s.ec2.internal %s\n' % (n['address'], n['hostname'], n['hostname'])
+                         for n in nodes),
+        'user_data': node['user_data'],
+        'api': api,
+        'scratch': os.path.join(node_dir, 'fs'),
+        'binds': [
+            (os.path.abspath(STUBS_DIR), '/sim/bin'),
+            # boto3 of the stubs, not on the path of the node's python
+            (site_packages, '/sim/lib'),
+            (wheels, '/sim/wheels'),
+            (os.path.join(workdir, 'etc'), '/sim/etc'),
+            (os.path.join(workdir, 'efs'), '/sim/efs'),
+            (os.path.join(node_dir, 'log'), '/var/log'),
+        ],
+        'env': {
+            'PATH': '/sim/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+            'HOME': '/root',
+            'LANG': 'C.UTF-8',
+            'PYTHONNOUSERSITE': '1',
+            # pip of the node installs boto3 from the wheels, into the
+            # overlay even on hosts whose python is externally managed
+            'PIP_NO_INDEX': '1',
+            'PIP_FIND_LINKS': '/sim/wheels',
+            'PIP_BREAK_SYSTEM_PACKAGES': '1',
+            'AWS_ACCESS_KEY_ID': node['name'],
+            'AWS_SECRET_ACCESS_KEY': 'sim',
+            'AWS_ENDPOINT_URL': api,
+            'AWS_CONFIG_FILE': '/sim/etc/aws-config',
+            'AWS_EC2_METADATA_DISABLED': 'true',
+            'CHAINER_CFN_IMDS_ENDPOINT': 'http://%s:%d/latest/meta-data/' % (host_address, IMDS_PORT),
+            'CHAINER_CFN_SIM_API': api,
+        },
+    }
+    spec_path = os.path.join(node_dir, 'spec.json')
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f, indent=2)
+    with open('/proc/uptime') as f:
+        uptime = int(float(f.read().split()[0]))
+    console = open(os.path.join(node_dir, 'console.log'), 'wb')
+    # the time namespace starts the uptime of the node from 0, as the
+    # agent reports the bootstrap duration from it
+    return subprocess.Popen(
+        ['ip', 'netns', 'exec', NETNS_PREFIX + node['name'],
+         'unshare', '--mount', '--uts', '--pid', '--time', '--boottime', str(-uptime),
+         '--fork', '--kill-child',
+         sys.executable, os.path.abspath(__file__), 'node-run', spec_path],
+        stdout=console, stderr=subprocess.STDOUT)
+
+
+def _mount(*args):
+    subprocess.check_call(('mount',) + args)
+
+
+def hide_boto3(env):
+    """Removes boto3 of the host from the root of a node."""
+    out = subprocess.check_output(
+        ['python3', '-c', 'import json, sys; print(json.dumps(sys.path))'], env=env)
+    for d in json.loads(out.decode()):
+        if not os.path.isdir(d):
+            continue
+        for name in os.listdir(d):
+            if not re.match(r'(boto3|botocore)([-.]|$)', name):
+                continue
+            path = os.path.join(d, name)
+            # a whiteout in the overlay; the host keeps it
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def node_run(spec_path):
+    """Runs as PID 1 of a node: builds its root and runs the user data."""
+    with open(spec_path) as f:
+        spec = json.load(f)
+    _mount('--make-rprivate', '/')
+    scratch = spec['scratch']
+    _mount('-t', 'tmpfs', 'tmpfs', scratch)
+    root = os.path.join(scratch, 'root')
+    for d in ['upper', 'work', 'root']:
+        os.mkdir(os.path.join(scratch, d))
+    _mount('-t', 'overlay', 'overlay', '-o', 'lowerdir=/,upperdir=%s,workdir=%s' % (
+        os.path.join(scratch, 'upper'), os.path.join(scratch, 'work')), root)
+    _mount('-t', 'proc', 'proc', root + '/proc')
+    for p in ['/proc/sys', '/proc/irq', '/proc/sysrq-trigger']:
+        if not os.path.exists(root + p):
+            continue
+        _mount('--bind', root + p, root + p)
+        _mount('-o', 'remount,bind,ro', root + p)
+    _mount('-t', 'sysfs', '-o', 'ro', 'sysfs', root + '/sys')
+    _mount('--rbind', '/dev', root + '/dev')
+    for p in ['/run', '/tmp']:
+        _mount('-t', 'tmpfs', 'tmpfs', root + p)
+    os.chmod(root + '/tmp', 0o1777)
+    for src, dst in spec['binds']:
+        os.makedirs(root + dst, exist_ok=True)
+        _mount('--bind', src, root + dst)
+
+    socket.sethostname(spec['hostname'])
+    os.chroot(root)
+    os.chdir('/')
+    with open('/etc/hostname', 'w') as f:
+        f.write(spec['hostname'] + '\n')
+    with open('/etc/hosts', 'w') as f:
+        f.write('127.0.0.1 localhost\n' + spec['hosts'])
+    # the default user of the AMI, whose key is given to the chainer user
+    if subprocess.call(['id', 'ubuntu'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+        subprocess.check_call(['useradd', '-m', '-s', '/bin/bash', 'ubuntu'])
+    os.makedirs('/home/ubuntu/.ssh', exist_ok=True)
+    with open('/home/ubuntu/.ssh/authorized_keys', 'w') as f:
+        f.write('ssh-rsa AAAA sim\n')
+    for name in ['cfn-init', 'cfn-signal']:
+        if os.path.lexists('/usr/local/bin/' + name):
+            os.remove('/usr/local/bin/' + name)
+        os.symlink('/sim/bin/' + name, '/usr/local/bin/' + name)
+    # written to by the bootstrap on the Deep Learning AMI
+    os.makedirs('/usr/local/mpi/etc', exist_ok=True)
+    os.makedirs('/var/lib/cloud', exist_ok=True)
+    with open('/var/lib/cloud/user-data', 'w') as f:
+        f.write(spec['user_data'])
+    os.chmod('/var/lib/cloud/user-data', 0o700)
+    hide_boto3(spec['env'])
+
+    user_data = subprocess.Popen(['/var/lib/cloud/user-data'], env=spec['env'],
+                                 stdin=subprocess.DEVNULL)
+    # reap the daemons the bootstrap leaves behind until the node is stopped
+    while True:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            signal.pause()
+            continue
+        if pid == user_data.pid:
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            sys.stdout.write('user data exited with %d\n' % code)
+            sys.stdout.flush()
+            req = urllib.request.Request(spec['api'] + '/_sim/event', data=json.dumps(
+                {'event': 'user_data', 'detail': {'exit_code': code, 'end': time.time()}}).encode())
+            urllib.request.urlopen(req, timeout=10).close()
+
+
+#
+# Report
+#
+def _per_minute(count, seconds):
+    return count * 60.0 / seconds if seconds > 0 else None
+
+
+def node_report(node, state, started, observe_from, observe_to):
+    name = node['name']
+    configs = sorted((d for t, n, e, d in state.events if n == name and e == 'config'),
+                     key=lambda d: d['start'])
+    exits = [d for t, n, e, d in state.events if n == name and e == 'user_data']
+    signal_at, status = state.signals.get(name, (None, None))
+
+    phases = collections.OrderedDict()
+    last = started
+    if configs:
+        phases['boot'] = configs[0]['start'] - started
+        for c in configs:
+            phases[c['name']] = c['end'] - c['start']
+        last = configs[-1]['end']
+    if signal_at is not None:
+        phases['preflight_signal'] = signal_at - last
+
+    end = signal_at or (exits[0]['end'] if exits else observe_from)
+    calls = [(t, s, a) for t, n, s, a in state.calls if n == name]
+    bootstrap = collections.Counter('%s:%s' % (s, a) for t, s, a in calls if s != 'imds' and t <= end)
+    steady = collections.Counter('%s:%s' % (s, a) for t, s, a in calls
+                                 if s != 'imds' and observe_from <= t < observe_to)
+    steady_imds = len([t for t, s, a in calls if s == 'imds' and observe_from <= t < observe_to])
+    if status == 'SUCCESS':
+        result = 'ready'
+    elif status is not None:
+        result = 'signaled_failure'
+    elif exits:
+        result = 'failed'
+    else:
+        result = 'timeout'
+    return {
+        'role': node['role'],
+        'instance_id': node['instance']['InstanceId'],
+        'status': result,
+        'ready_seconds': signal_at - started if signal_at else None,
+        'phases': phases,
+        'bootstrap_api_calls': sum(bootstrap.values()),
+        'bootstrap_api_calls_per_minute': _per_minute(sum(bootstrap.values()), end - started),
+        'steady_api_calls_per_minute': _per_minute(sum(steady.values()), observe_to - observe_from),
+        'steady_imds_calls_per_minute': _per_minute(steady_imds, observe_to - observe_from),
+        'bootstrap_calls': dict(bootstrap),
+        'steady_calls': dict(steady),
+    }
+
+
+def summary(report):
+    nodes = report['nodes'].values()
+    ready = [n['ready_seconds'] for n in nodes]
+    steady = [n['steady_api_calls_per_minute'] or 0 for n in nodes]
+    return {
+        'ready_seconds': None if None in ready else max(ready),
+        'bootstrap_api_calls': sum(n['bootstrap_api_calls'] for n in nodes),
+        'max_steady_api_calls_per_minute': max(steady),
+        'steady_api_calls_per_minute': sum(steady),
+    }
+
+
+def print_report(report):
+    out = sys.stderr
+    out.write('%-12s %-7s %-16s %8s %10s %9s %12s\n' % (
+        'node', 'role', 'status', 'ready', 'boot calls', 'calls/min', 'steady/min'))
+    for name, n in report['nodes'].items():
+        out.write('%-12s %-7s %-16s %8s %10d %9.1f %12.1f\n' % (
+            name, n['role'], n['status'],
+            '-' if n['ready_seconds'] is None else '%.1fs' % n['ready_seconds'],
+            n['bootstrap_api_calls'], n['bootstrap_api_calls_per_minute'] or 0,
+            n['steady_api_calls_per_minute'] or 0))
+    phases = collections.OrderedDict()
+    for n in report['nodes'].values():
+        for p, s in n['phases'].items():
+            phases[p] = max(phases.get(p, 0), s)
+    out.write('slowest node of each phase:\n')
+    for p, s in phases.items():
+        out.write('  %-20s %7.1fs\n' % (p, s))
+    total = report['total']
+    out.write('time to ready: %s, bootstrap API calls: %d, steady API calls/min: %.1f\n' % (
+        '-' if total['ready_seconds'] is None else '%.1fs' % total['ready_seconds'],
+        total['bootstrap_api_calls'], total['steady_api_calls_per_minute']))
+
+
+def compare(baseline, report, tolerance):
+    """Returns the regressions of ``report`` against ``baseline``."""
+    regressions = []
+    for key, label in [('ready_seconds', 'time to ready'),
+                       ('bootstrap_api_calls', 'API calls during bootstrap'),
+                       ('max_steady_api_calls_per_minute', 'API calls per minute of a node')]:
+        before = baseline['total'][key]
+        after = report['total'][key]
+        if before is None:
+            continue
+        if after is None or after > before * (1 + tolerance):
+            regressions.append('%s: %.1f -> %s' % (label, before, '-' if after is None else '%.1f' % after))
+    return regressions
+
+
+#
+# Main
+#
+def simulate(args):
+    template = cfn.load(args.template) if args.template else cfn.generate()
+    subnet = ipaddress.ip_network(args.subnet)
+    workdir = os.path.abspath(args.workdir)
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    for d in ['etc', 'efs']:
+        os.makedirs(os.path.join(workdir, d))
+    with open(os.path.join(workdir, 'etc', 'aws-config'), 'w') as f:
+        f.write(AWS_CONFIG)
+
+    host_address = str(next(subnet.hosts()))
+    parameters = {
+        'KeyPairName': 'sim',
+        'WorkerSize': str(args.workers),
+        'NodeBundleURL': 'http://%s:%d/_sim/bundle.tar.gz' % (host_address, API_PORT),
+    }
+    parameters.update(dict(p.split('=', 1) for p in args.parameter))
+    nodes, metadata = plan(template, parameters, subnet)
+
+    state = fakeaws.State(STACK_NAME, api_latency=args.api_latency)
+    state.bundle = bundle()
+    state.metadata = metadata
+    for node in nodes:
+        state.instances[node['name']] = node['instance']
+        state.addresses[node['address']] = node['name']
+
+    procs = []
+    servers = []
+    try:
+        setup_network(host_address, subnet, nodes)
+        servers.append(fakeaws.serve(fakeaws.api_handler(state), API_PORT, host_address))
+        servers.append(fakeaws.serve(fakeaws.imds_handler(state), IMDS_PORT, host_address))
+        _log('starting %d nodes: %s', len(nodes), ', '.join(n['name'] for n in nodes))
+        started = time.time()
+        for node in nodes:
+            node['instance']['State']['Name'] = 'running'
+            procs.append(start_node(node, nodes, workdir, host_address, args.site_packages,
+                                    os.path.abspath(args.wheels)))
+
+        deadline = started + args.timeout
+        while time.time() < deadline:
+            finished = set(state.signals) | set(n for t, n, e, d in state.events if e == 'user_data')
+            finished |= set(n['name'] for n, p in zip(nodes, procs) if p.poll() is not None)
+            if len(finished) == len(nodes):
+                break
+            time.sleep(1)
+        _log('bootstrap finished in %.1fs; observing the agents for %ds',
+             time.time() - started, args.observe)
+        observe_from = time.time()
+        time.sleep(args.observe)
+        observe_to = time.time()
+    finally:
+        # unshare ignores SIGTERM; when it is killed, the kernel kills
+        # every process of the node
+        for p in procs:
+            p.kill()
+        for p in procs:
+            p.wait()
+        for s in servers:
+            s.shutdown()
+        teardown_network(nodes)
+
+    report = {
+        'schema_version': SCHEMA_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'template_version': args.template_version,
+        'parameters': parameters,
+        'api_latency': args.api_latency,
+        'observe_seconds': observe_to - observe_from,
+        'nodes': collections.OrderedDict(
+            (n['name'], node_report(n, state, started, observe_from, observe_to)) for n in nodes),
+    }
+    report['total'] = summary(report)
+    return report
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['node-run']:
+        return node_run(argv[1])
+
+    import boto3
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--template', help='generated template (default: run template/main.py)')
+    parser.add_argument('--workers', type=int, default=2, help='WorkerSize of the stack')
+    parser.add_argument('--parameter', action='append', default=[], metavar='KEY=VALUE',
+                        help='stack parameter, e.g. WorkerGroup2Size=1')
+    parser.add_argument('--observe', type=int, default=120,
+                        help='seconds to count the API calls of the agents after bootstrap')
+    parser.add_argument('--timeout', type=int, default=900, help='seconds to wait for the nodes')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='seconds added to each API call')
+    parser.add_argument('--subnet', default='10.211.0.0/24')
+    parser.add_argument('--workdir', default='build/bootstrap-sim/run',
+                        help='logs and files of the nodes; removed at start')
+    parser.add_argument('--site-packages', default=os.path.dirname(os.path.dirname(boto3.__file__)),
+                        help='python packages of the stubs, with boto3 (default: those of this python)')
+    parser.add_argument('--wheels', default='build/bootstrap-sim/wheels',
+                        help='directory of the boto3 wheels installed by the nodes')
+    parser.add_argument('--template-version', help='recorded in the report')
+    parser.add_argument('--out', default='-', help='JSON report; "-" for stdout')
+    parser.add_argument('--baseline', help='report to compare with')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='write the report to the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction by which the run may be worse than the baseline')
+    args = parser.parse_args(argv)
+    if os.geteuid() != 0:
+        parser.error('must run as root to create namespaces')
+    if not os.path.isdir(args.wheels):
+        parser.error('%s does not exist; run pip download -d %s boto3' % (args.wheels, args.wheels))
+
+    report = simulate(args)
+    print_report(report)
+    body = json.dumps(report, indent=2) + '\n'
+    if args.out == '-':
+        sys.stdout.write(body)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(body)
+
+    failed = [name for name, n in report['nodes'].items() if n['status'] != 'ready']
+    for name in failed:
+        _log('%s: %s (see %s)', name, report['nodes'][name]['status'],
+             os.path.join(args.workdir, name, 'console.log'))
+    if args.baseline is None:
+        return 1 if failed else 0
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(body)
+        return 1 if failed else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(baseline, report, args.tolerance)
+    for r in regressions:
+        _log('regression: %s', r)
+    return 1 if failed or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+#!/bin/bash
+# Runs the registry cache against a local registry standing in for the
+# upstream, on any host with docker.  No AWS resources are needed.
+set -xeu -o pipefail
+
+UPSTREAM_PORT=${UPSTREAM_PORT:-15000}
+CACHE_PORT=${CACHE_PORT:-15001}
+UPSTREAM=chainer-cfn-test-upstream
+CACHE=chainer-cfn-test-cache
+STORAGE=$(mktemp -d)
+IMAGE=chainer-cfn-test/busybox:latest
+
+cleanup() {
+    docker rm -f $UPSTREAM $CACHE > /dev/null 2>&1 || true
+    docker rmi localhost:$UPSTREAM_PORT/$IMAGE localhost:$CACHE_PORT/$IMAGE > /dev/null 2>&1 || true
+    sudo rm -rf $STORAGE
+}
+trap cleanup EXIT
+
+cd $(dirname $0)/../node
+
+# upstream stand-in with one image
+docker run -d --name $UPSTREAM -p $UPSTREAM_PORT:5000 registry:2
+docker pull busybox:latest
+docker tag busybox:latest localhost:$UPSTREAM_PORT/$IMAGE
+until curl -sf http://localhost:$UPSTREAM_PORT/v2/ > /dev/null; do sleep 1; done
+docker push localhost:$UPSTREAM_PORT/$IMAGE
+docker rmi localhost:$UPSTREAM_PORT/$IMAGE
+
+# the cache reaches the stand-in through the docker host
+python3 bin/chainer-cfn-registry-cache serve \
+    --upstream http://$(docker inspect -f '{{.NetworkSettings.IPAddress}}' $UPSTREAM):5000 \
+    --storage $STORAGE --port $CACHE_PORT --name $CACHE
+
+# pulling through the cache stores the image in it
+docker pull localhost:$CACHE_PORT/$IMAGE
+curl -sf http://localhost:$CACHE_PORT/v2/_catalog | grep -q chainer-cfn-test/busybox
+
+# and it is served from the cache without the upstream
+docker rmi localhost:$CACHE_PORT/$IMAGE
+docker stop $UPSTREAM
+docker pull localhost:$CACHE_PORT/$IMAGE
+
+# serve is idempotent
+python3 bin/chainer-cfn-registry-cache serve \
+    --upstream http://unused --storage $STORAGE --port $CACHE_PORT --name $CACHE
@@ -0,0 +1,5 @@
+# Node-side helpers of chainer-cfn.
+#
+# This package is shipped to every cluster node as the node bundle and is
+# extracted to /opt/chainer-cfn by cfn-init.  It must keep working with the
+# python3 shipped in Chainer AMI, so please avoid syntax newer than 3.5.
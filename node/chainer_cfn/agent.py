@@ -0,0 +1,285 @@
+"""Long running node agent.
+
+The agent replaces the per-minute cron scripts: it keeps one boto3 session
+and cached instance metadata for its lifetime and runs the periodic tasks
+from an internal scheduler.  The run time of every task is written to
+``STATUS_PATH`` and posted to CloudWatch so that the agent itself can be
+monitored.
+
+Task periods can be overridden in ``/etc/chainer-cfn/agent.json``::
+
+    {"periods": {"hostfile": 30, "netstat": 60}}
+"""
+import argparse
+import heapq
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from chainer_cfn import cloudwatch
+from chainer_cfn import cluster_key
+from chainer_cfn import config
+from chainer_cfn import efs_throughput
+from chainer_cfn import fscache
+from chainer_cfn import gpustat
+from chainer_cfn import hostfile
+from chainer_cfn import imds
+from chainer_cfn import kernel_cache
+from chainer_cfn import netstat
+from chainer_cfn import nfsstat
+from chainer_cfn import preflight
+from chainer_cfn import pyenv
+from chainer_cfn import registry_cache
+from chainer_cfn import resume
+from chainer_cfn import straggler
+from chainer_cfn import task
+from chainer_cfn import tune
+from chainer_cfn import util
+
+AGENT_CONFIG_PATH = '/etc/chainer-cfn/agent.json'
+STATUS_PATH = '/var/run/chainer-cfn/agent-status.json'
+NAMESPACE = 'ChainerCluster/Agent'
+
+TASKS = [
+    hostfile.HostfileTask,
+    cluster_key.ClusterKeyTask,
+    nfsstat.NfsStatTask,
+    efs_throughput.EfsThroughputTask,
+    fscache.FscacheStatTask,
+    gpustat.GpuStatTask,
+    kernel_cache.KernelCacheTask,
+    netstat.NetStatTask,
+    preflight.BandwidthServerTask,
+    pyenv.PyenvSyncTask,
+    registry_cache.RegistryMirrorTask,
+    straggler.StragglerTask,
+    tune.TuningTask,
+]
+
+logger = logging.getLogger('chainer-cfn-agent')
+
+
+class AgentStatsTask(task.Task):
+    """Posts the run time of each task since the last post to CloudWatch."""
+
+    name = 'agent_stats'
+    period = 60
+
+    def __init__(self, conf):
+        super(AgentStatsTask, self).__init__(conf)
+        self.agent = None
+
+    def run(self):
+        dims = dict(
+            ChainerClusterName=self.conf['cluster_name'],
+            ChainerClusterRole=self.conf['role'],
+            InstanceId=imds.instance_id())
+        data = []
+        for name, s in sorted(self.agent.status.items()):
+            if s['max_duration_since_post'] is None:
+                continue
+            data.append({
+                'MetricName': 'TaskDuration',
+                'Dimensions': cloudwatch.dimensions(Task=name, **dims),
+                'Value': s['max_duration_since_post'],
+                'Unit': 'Seconds',
+            })
+            s['max_duration_since_post'] = None
+        if data:
+            cloudwatch.put_metric_data(NAMESPACE, data)
+
+
+def load_periods(path=AGENT_CONFIG_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f).get('periods', {})
+    except IOError:
+        return {}
+
+
+class Agent(object):
+
+    def __init__(self, tasks, periods=None):
+        periods = periods or {}
+        self.tasks = [t for t in tasks if t.enabled()]
+        self.periods = {t.name: periods.get(t.name, t.period) for t in self.tasks}
+        self.status = {t.name: {
+            'period': self.periods[t.name],
+            'runs': 0,
+            'failures': 0,
+            'last_started_at': None,
+            'last_duration': None,
+            'max_duration_since_post': None,
+            'last_error': None,
+            'disabled': False,
+        } for t in self.tasks}
+
+    def start_task(self, t):
+        """Starts ``t``; a task which fails to start is disabled."""
+        try:
+            t.start()
+            return True
+        except Exception as e:
+            logger.exception('task %s failed to start, disabled', t.name)
+            s = self.status[t.name]
+            s['failures'] += 1
+            s['last_error'] = repr(e)
+            s['disabled'] = True
+            return False
+
+    def run_task(self, t):
+        s = self.status[t.name]
+        start = time.time()
+        s['last_started_at'] = start
+        try:
+            t.run()
+            s['last_error'] = None
+        except Exception as e:
+            logger.exception('task %s failed', t.name)
+            s['failures'] += 1
+            s['last_error'] = repr(e)
+        duration = time.time() - start
+        s['runs'] += 1
+        s['last_duration'] = duration
+        s['max_duration_since_post'] = max(duration, s['max_duration_since_post'] or 0)
+
+    def write_status(self):
+        os.makedirs(os.path.dirname(STATUS_PATH), exist_ok=True)
+        util.write_atomically(STATUS_PATH, json.dumps(self.status, indent=2, sort_keys=True))
+
+    def run(self):
+        # one task failing to start must not stop the others.
+        self.tasks = [t for t in self.tasks if self.start_task(t)]
+        self.write_status()
+        now = time.time()
+        queue = [(now, i) for i in range(len(self.tasks))]
+        heapq.heapify(queue)
+        while queue:
+            due, i = heapq.heappop(queue)
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            t = self.tasks[i]
+            self.run_task(t)
+            self.write_status()
+            # Schedule from the due time, not from the end of the run, so
+            # that periods don't drift; skip missed slots after a long run.
+            period = self.periods[t.name]
+            due += period
+            now = time.time()
+            if due < now:
+                due = now + period - (now - due) % period
+            heapq.heappush(queue, (due, i))
+
+
+def build_agent(conf):
+    stats = AgentStatsTask(conf)
+    agent = Agent([cls(conf) for cls in TASKS] + [stats], load_periods())
+    stats.agent = agent
+    return agent
+
+
+def run(args):
+    agent = build_agent(config.load())
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info('starting tasks: %s', ', '.join(
+        '%s(%ds)' % (t.name, agent.periods[t.name]) for t in agent.tasks))
+    agent.run()
+    return 0
+
+
+def once(args):
+    """Runs the given tasks once in the foreground, e.g. from cfn-init."""
+    conf = config.load()
+    classes = {cls.name: cls for cls in TASKS}
+    for name in args.tasks:
+        classes[name](conf).run()
+    return 0
+
+
+def supervise(args):
+    """Runs the agent in a child process and restarts it when it dies.
+
+    A node which was stopped and started again is refreshed first.
+    """
+    resume.on_boot(config.load())
+    child = None
+    stopped = []
+
+    def stop(signum, frame):
+        stopped.append(signum)
+        if child is not None and child.poll() is None:
+            child.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    backoff = 1
+    while not stopped:
+        started = time.time()
+        child = subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0]), 'run'])
+        code = child.wait()
+        if stopped:
+            break
+        logger.error('agent exited with %d, restarting in %ds', code, backoff)
+        if time.time() - started > 600:
+            backoff = 1
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 60)
+    return 0
+
+
+def report_bootstrap(args):
+    """Posts the time from boot to now, run right after cfn-signal."""
+    conf = config.load()
+    with open('/proc/uptime') as f:
+        uptime = float(f.read().split()[0])
+    dims = cloudwatch.dimensions(
+        ChainerClusterName=conf['cluster_name'],
+        ChainerClusterRole=conf['role'],
+        InstanceId=imds.instance_id())
+    cloudwatch.put_metric_data(NAMESPACE, cloudwatch.metric_data(
+        [('BootstrapDuration', uptime, 'Seconds')], dims))
+    logger.info('bootstrap took %ds', uptime)
+    return 0
+
+
+def refresh(args):
+    """Refreshes the node as after a restart, e.g. when it failed at boot."""
+    conf = config.load()
+    failed = resume.refresh(conf)
+    resume.report(conf, failed)
+    return 1 if failed else 0
+
+
+def status(args):
+    with open(STATUS_PATH) as f:
+        sys.stdout.write(f.read())
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='chainer-cfn node agent')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('run', help='run the scheduler in the foreground')
+    sub.add_parser('supervise', help='run and restart the agent when it dies')
+    p = sub.add_parser('once', help='run tasks once')
+    p.add_argument('tasks', nargs='+')
+    sub.add_parser('status', help='show run time of each task')
+    sub.add_parser('report-bootstrap', help='post the time from boot to now')
+    sub.add_parser('refresh', help='restore the mounts, keys and hostfiles after a restart')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    commands = {'run': run, 'supervise': supervise, 'once': once, 'status': status,
+                'report-bootstrap': report_bootstrap, 'refresh': refresh}
+    return commands[args.command or 'run'](args)
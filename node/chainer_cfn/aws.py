@@ -0,0 +1,24 @@
+"""A process-wide boto3 session.
+
+Clients are created once and reused so that long running programs (e.g.
+the node agent) keep their connections and credentials around.
+"""
+import boto3
+
+from chainer_cfn import config
+
+_session = None
+_clients = {}
+
+
+def session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session(region_name=config.load()['region'])
+    return _session
+
+
+def client(service):
+    if service not in _clients:
+        _clients[service] = session().client(service)
+    return _clients[service]
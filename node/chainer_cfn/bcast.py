@@ -0,0 +1,326 @@
+"""Pipelined broadcast of a file to the local disk of every node.
+
+``chainer-bcast SRC [DEST]`` sends a file from this node along a chain (or
+a tree with ``--fanout``) of the nodes in a hostfile over ssh.  Each node
+forwards every chunk to the next ones before writing it to its own disk,
+so the source sends the file only ``fanout`` times and the total time is
+about the time of one copy plus a small delay per hop, whatever the
+number of nodes.
+
+The SHA-256 of the file is verified on every node before the file is
+renamed into place, and recorded in ``DEST.sha256`` after that.  Nodes
+which already have the file are skipped, and a broadcast which was
+interrupted resumes from the smallest partial file (``DEST.part``, whose
+SHA-256 is in ``DEST.part.sha256``) of the remaining nodes.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from chainer_cfn import cssh
+
+CHUNK_SIZE = 4 << 20
+RELAY_COMMAND = 'python3 /opt/chainer-cfn/bin/chainer-bcast'
+RESULT_PREFIX = 'RESULT '
+
+
+def _sha256(path, limit=None):
+    h = hashlib.sha256()
+    remaining = os.path.getsize(path) if limit is None else limit
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            h.update(data)
+            remaining -= len(data)
+    return h
+
+
+def file_sha256(path):
+    return _sha256(path).hexdigest()
+
+
+def split_tree(hosts, fanout):
+    """Returns ``[(child, descendants)]`` of the node sending to ``hosts``."""
+    subtrees = []
+    n = len(hosts)
+    start = 0
+    for i in range(min(fanout, n)):
+        end = start + (n - start) // (min(fanout, n) - i)
+        subtrees.append((hosts[start], hosts[start + 1:end]))
+        start = end
+    return subtrees
+
+
+#
+# State of the destination on each node
+#
+def _sidecar(path):
+    return path + '.sha256'
+
+
+def _recorded(path):
+    """Returns the SHA-256 recorded for ``path``, or ``None``."""
+    try:
+        with open(_sidecar(path)) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def probe(dest, sha256):
+    """Returns ``'done'`` if ``dest`` is the file, otherwise bytes received so far."""
+    if _recorded(dest) == sha256 and os.path.exists(dest):
+        return 'done'
+    part = dest + '.part'
+    if _recorded(part) == sha256 and os.path.exists(part):
+        return os.path.getsize(part)
+    return 0
+
+
+def _ssh(host, command, **kwargs):
+    return subprocess.Popen(['ssh'] + cssh.SSH_OPTIONS + [host, command], **kwargs)
+
+
+def probe_hosts(hosts, dest, sha256):
+    procs = [(h, _ssh(h, '%s probe %s %s' % (RELAY_COMMAND, shlex.quote(dest), sha256),
+                      stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)) for h in hosts]
+    states = {}
+    for h, p in procs:
+        out = p.communicate()[0].decode().strip()
+        if p.returncode != 0:
+            states[h] = 0
+        else:
+            states[h] = out if out == 'done' else int(out)
+    return states
+
+
+#
+# Transfer
+#
+class Relay(object):
+    """Forwards the stream to the children and writes it to ``dest``."""
+
+    def __init__(self, name, header, dest, children, fanout, out):
+        self.name = name
+        self.header = header
+        self.dest = dest
+        self.out = out
+        self.lock = threading.Lock()
+        self.children = []
+        self.threads = []
+        for child, descendants in children:
+            command = '%s relay --name %s --fanout %d %s %s' % (
+                RELAY_COMMAND, shlex.quote(child), fanout, shlex.quote(header['dest']),
+                shlex.quote(','.join(descendants)))
+            proc = _ssh(child, command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            t = threading.Thread(target=self._forward_results, args=(proc,))
+            t.daemon = True
+            t.start()
+            self.children.append([child, proc])
+            self.threads.append(t)
+        self.send((json.dumps(header) + '\n').encode())
+
+    def result(self, status):
+        with self.lock:
+            self.out.write('%s%s %s\n' % (RESULT_PREFIX, self.name, status))
+            self.out.flush()
+
+    def _forward_results(self, proc):
+        for line in proc.stdout:
+            line = line.decode('utf-8', 'replace')
+            if line.startswith(RESULT_PREFIX):
+                with self.lock:
+                    self.out.write(line)
+                    self.out.flush()
+
+    def send(self, data):
+        for c in self.children:
+            if c[1] is None:
+                continue
+            try:
+                c[1].stdin.write(data)
+            except (BrokenPipeError, OSError):
+                # the subtree is reported missing by the source; the
+                # others go on.
+                c[1] = None
+
+    def run(self, chunks):
+        part = None
+        h = None
+        if self.dest is not None:
+            os.makedirs(os.path.dirname(self.dest) or '.', exist_ok=True)
+            # the old DEST stays until the new one is complete, so only the
+            # partial file is marked with the new hash.
+            with open(_sidecar(self.dest + '.part'), 'w') as f:
+                f.write(self.header['sha256'] + '\n')
+            offset = self.header['offset']
+            if offset:
+                h = _sha256(self.dest + '.part', offset)
+                part = open(self.dest + '.part', 'r+b')
+                part.truncate(offset)
+                part.seek(offset)
+            else:
+                h = hashlib.sha256()
+                part = open(self.dest + '.part', 'wb')
+        try:
+            for data in chunks:
+                self.send(data)
+                if part is not None:
+                    part.write(data)
+                    h.update(data)
+        finally:
+            for c in self.children:
+                if c[1] is not None:
+                    try:
+                        c[1].stdin.close()
+                    except (BrokenPipeError, OSError):
+                        pass
+            if part is not None:
+                part.close()
+        if part is not None:
+            self._finish(h.hexdigest())
+        for t in self.threads:
+            t.join()
+        for c in self.children:
+            if c[1] is not None:
+                c[1].wait()
+
+    def _finish(self, digest):
+        part = self.dest + '.part'
+        if digest != self.header['sha256']:
+            os.remove(part)
+            _remove(_sidecar(part))
+            self.result('checksum-mismatch')
+            return
+        os.chmod(part, self.header['mode'])
+        os.rename(part, self.dest)
+        with open(_sidecar(self.dest), 'w') as f:
+            f.write(self.header['sha256'] + '\n')
+        _remove(_sidecar(part))
+        self.result('ok')
+
+
+def _read_stream(stream, size):
+    while size > 0:
+        data = stream.read(min(CHUNK_SIZE, size))
+        if not data:
+            raise IOError('stream ended with %d bytes left' % size)
+        size -= len(data)
+        yield data
+
+
+def relay(name, dest, hosts, fanout):
+    stdin = sys.stdin.buffer
+    header = json.loads(stdin.readline().decode())
+    r = Relay(name, header, dest, split_tree(hosts, fanout), fanout, sys.stdout)
+    r.run(_read_stream(stdin, header['size'] - header['offset']))
+    return 0
+
+
+def _is_local(host):
+    try:
+        address = socket.gethostbyname(host)
+    except socket.error:
+        return False
+    if address.startswith('127.'):
+        return True
+    local = subprocess.check_output(['hostname', '-I']).decode().split()
+    return address in local
+
+
+def broadcast(src, dest, hosts, fanout):
+    """Returns ``{host: status}`` of every host."""
+    hosts = [h for h in hosts if not _is_local(h)]
+    sha256 = file_sha256(src)
+    states = probe_hosts(hosts, dest, sha256)
+    status = {h: 'ok (already there)' for h, s in states.items() if s == 'done'}
+    targets = [h for h in hosts if states[h] != 'done']
+    if not targets:
+        return status
+    offset = min(states[h] for h in targets)
+    size = os.path.getsize(src)
+    header = {'size': size, 'offset': offset, 'sha256': sha256, 'dest': dest,
+              'mode': os.stat(src).st_mode & 0o777}
+
+    class Collector(object):
+        def write(self, line):
+            host, s = line[len(RESULT_PREFIX):].split(None, 1)
+            status[host] = s.strip()
+
+        def flush(self):
+            pass
+
+    def chunks():
+        with open(src, 'rb') as f:
+            f.seek(offset)
+            for data in _read_stream(f, size - offset):
+                yield data
+    Relay(None, header, None, split_tree(targets, fanout), fanout, Collector()).run(chunks())
+    for h in targets:
+        status.setdefault(h, 'missing')
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Broadcast a file to the local disk of every node.',
+        usage='%(prog)s [options] SRC [DEST]')
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['relay']:
+        p = argparse.ArgumentParser()
+        p.add_argument('--name', required=True)
+        p.add_argument('--fanout', type=int, default=1)
+        p.add_argument('dest')
+        p.add_argument('hosts')
+        args = p.parse_args(argv[1:])
+        return relay(args.name, args.dest, [h for h in args.hosts.split(',') if h], args.fanout)
+    if argv[:1] == ['probe']:
+        print(probe(argv[1], argv[2]))
+        return 0
+
+    parser.add_argument('--hostfile', help='default: /etc/chainer-cfn/hostfiles/all')
+    parser.add_argument('--group', help='use the hostfile of this node group')
+    parser.add_argument('-w', '--hosts', help='comma separated host names or patterns to select')
+    parser.add_argument('-x', '--exclude', help='comma separated host names or patterns to exclude')
+    parser.add_argument('--fanout', type=int, default=1,
+                        help='number of nodes each node sends to (default: 1, a chain)')
+    parser.add_argument('src')
+    parser.add_argument('dest', nargs='?', help='absolute path on the nodes (default: SRC)')
+    args = parser.parse_args(argv)
+
+    src = os.path.abspath(args.src)
+    dest = args.dest or src
+    if not os.path.isabs(dest):
+        parser.error('DEST must be an absolute path')
+    hosts = cssh.select_hosts(args)
+    start = time.time()
+    status = broadcast(src, dest, hosts, args.fanout)
+    elapsed = time.time() - start
+    failed = sorted(h for h, s in status.items() if not s.startswith('ok'))
+    for h in failed:
+        sys.stderr.write('  %s: %s\n' % (h, status[h]))
+    size = os.path.getsize(src)
+    sys.stderr.write('%d ok, %d failed, %.1f MiB in %.1fs (%.1f MiB/s)\n' % (
+        len(status) - len(failed), len(failed), size / 2.0 ** 20, elapsed,
+        size / 2.0 ** 20 / elapsed if elapsed else 0))
+    if failed:
+        sys.stderr.write('run the same command again to resume\n')
+        return 1
+    return 0
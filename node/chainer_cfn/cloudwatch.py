@@ -0,0 +1,25 @@
+from chainer_cfn import aws
+
+# PutMetricData accepts at most 20 metrics per request.
+MAX_METRICS_PER_REQUEST = 20
+
+
+def dimensions(**kwargs):
+    return [{'Name': k, 'Value': v} for k, v in sorted(kwargs.items())]
+
+
+def put_metric_data(namespace, metric_data):
+    cw = aws.client('cloudwatch')
+    for i in range(0, len(metric_data), MAX_METRICS_PER_REQUEST):
+        cw.put_metric_data(
+            Namespace=namespace,
+            MetricData=metric_data[i:i + MAX_METRICS_PER_REQUEST])
+
+
+def metric_data(metrics, dims):
+    return [{
+        'MetricName': name,
+        'Dimensions': dims,
+        'Value': value,
+        'Unit': unit,
+    } for name, value, unit in metrics]
@@ -0,0 +1,57 @@
+import os
+import pwd
+
+from chainer_cfn import aws
+from chainer_cfn import task
+from chainer_cfn import util
+
+KEY_FILES = [
+    ('id_rsa', 0o600),
+    ('id_rsa.pub', 0o644),
+    ('authorized_keys', 0o600),
+]
+
+
+class ClusterKeyTask(task.Task):
+    """Pulls the cluster ssh key of the chainer user from the asset bucket.
+
+    Objects are only downloaded again when their ETag changed.
+    """
+
+    name = 'cluster_key'
+    period = 60
+
+    def __init__(self, conf):
+        super(ClusterKeyTask, self).__init__(conf)
+        self.etags = {}
+
+    def enabled(self):
+        return self.conf['role'] != 'Master'
+
+    def run(self):
+        s3 = aws.client('s3')
+        user = pwd.getpwnam('chainer')
+        ssh_dir = os.path.join(user.pw_dir, '.ssh')
+        if not os.path.isdir(ssh_dir):
+            os.makedirs(ssh_dir)
+        os.chmod(ssh_dir, 0o755)
+        os.chown(ssh_dir, user.pw_uid, user.pw_gid)
+
+        for name, mode in KEY_FILES:
+            key = '.ssh/' + name
+            kwargs = {}
+            if key in self.etags:
+                kwargs['IfNoneMatch'] = self.etags[key]
+            try:
+                obj = s3.get_object(Bucket=self.conf['asset_bucket'], Key=key, **kwargs)
+            except s3.exceptions.ClientError as e:
+                if e.response['Error']['Code'] == '304':
+                    continue
+                raise
+            body = obj['Body'].read()
+            if name == 'authorized_keys':
+                with open(os.path.expanduser('~ubuntu/.ssh/authorized_keys'), 'rb') as f:
+                    body += f.read()
+            util.write_atomically(os.path.join(ssh_dir, name), body,
+                                  mode=mode, uid=user.pw_uid, gid=user.pw_gid)
+            self.etags[key] = obj['ETag']
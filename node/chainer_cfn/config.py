@@ -0,0 +1,16 @@
+import json
+
+NODE_CONFIG_PATH = '/etc/chainer-cfn/node.json'
+# environment of every rank, written by chainer-cfn-tune
+RANK_ENV_PATH = '/etc/chainer-cfn/rank.env'
+
+
+def load(path=NODE_CONFIG_PATH):
+    """Loads the node configuration rendered by cfn-init."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def flag(value):
+    """Booleans of the template mappings are rendered as ``"true"``/``"false"``."""
+    return str(value).lower() == 'true'
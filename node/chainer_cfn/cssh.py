@@ -0,0 +1,186 @@
+"""Parallel cluster shell.
+
+``chainer-cssh run`` runs a command on the nodes in a hostfile over ssh
+concurrently, with bounded parallelism and a timeout per host, and prints
+the output of each host line by line labelled with the host name.
+``chainer-cssh gather`` copies files from every node into
+``DEST/<host>/``.
+
+ssh connections are multiplexed with ``ControlMaster`` and kept for
+``CONTROL_PERSIST`` seconds, so repeated invocations don't pay for a new
+ssh handshake.
+"""
+import argparse
+import asyncio
+import fnmatch
+import os
+import shlex
+import sys
+import time
+
+from chainer_cfn import hostfile
+
+CONTROL_PERSIST = 600
+
+SSH_OPTIONS = [
+    '-o', 'BatchMode=yes',
+    '-o', 'ConnectTimeout=10',
+    '-o', 'StrictHostKeyChecking=no',
+    '-o', 'UserKnownHostsFile=/dev/null',
+    '-o', 'LogLevel=ERROR',
+    '-o', 'ControlMaster=auto',
+    '-o', 'ControlPath=~/.ssh/cssh-%C',
+    '-o', 'ControlPersist=%d' % CONTROL_PERSIST,
+]
+
+
+def read_hosts(path):
+    with open(path) as f:
+        return [l.split()[0] for l in f if l.strip() and not l.startswith('#')]
+
+
+def select_hosts(args):
+    if args.group:
+        path = os.path.join(hostfile.HOSTFILE_DIR, args.group)
+    elif args.hostfile:
+        path = args.hostfile
+    else:
+        path = os.path.join(hostfile.HOSTFILE_DIR, 'all')
+        if not os.path.exists(path):
+            path = hostfile.HOSTFILE_PATH
+    hosts = read_hosts(path)
+    if args.hosts:
+        patterns = args.hosts.split(',')
+        hosts = [h for h in hosts if any(fnmatch.fnmatch(h, p) for p in patterns)]
+    if args.exclude:
+        patterns = args.exclude.split(',')
+        hosts = [h for h in hosts if not any(fnmatch.fnmatch(h, p) for p in patterns)]
+    return hosts
+
+
+class Result(object):
+
+    def __init__(self, host):
+        self.host = host
+        self.returncode = None
+        self.timed_out = False
+        self.elapsed = None
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+
+class ClusterShell(object):
+
+    def __init__(self, hosts, parallel, timeout, out=sys.stdout):
+        self.hosts = hosts
+        self.semaphore = asyncio.Semaphore(parallel)
+        self.timeout = timeout
+        self.out = out
+        self.width = max([len(h) for h in hosts] or [0])
+
+    def _print(self, host, line):
+        self.out.write('%-*s | %s\n' % (self.width, host, line.rstrip('\n')))
+        self.out.flush()
+
+    async def _pump(self, host, stream):
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            self._print(host, line.decode('utf-8', 'replace'))
+
+    async def _execute(self, host, proc, result, streams):
+        start = time.time()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(proc.wait(), *streams), self.timeout)
+        except asyncio.TimeoutError:
+            result.timed_out = True
+            proc.kill()
+            await proc.wait()
+            self._print(host, '*** timed out after %ds' % self.timeout)
+        result.returncode = proc.returncode
+        result.elapsed = time.time() - start
+
+    async def _run_one(self, host, command):
+        result = Result(host)
+        async with self.semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                'ssh', *(SSH_OPTIONS + [host, command]),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            await self._execute(host, proc, result, [
+                self._pump(host, proc.stdout), self._pump(host, proc.stderr)])
+        return result
+
+    async def _gather_one(self, host, paths, dest):
+        result = Result(host)
+        target = os.path.join(dest, host)
+        os.makedirs(target, exist_ok=True)
+        remote = 'tar -C / -cf - ' + ' '.join(shlex.quote(p.lstrip('/')) for p in paths)
+        command = ' '.join(
+            [shlex.quote(a) for a in ['ssh'] + SSH_OPTIONS + [host, remote]] +
+            ['|', 'tar', '-C', shlex.quote(target), '-xf', '-'])
+        async with self.semaphore:
+            proc = await asyncio.create_subprocess_shell(
+                command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE)
+            await self._execute(host, proc, result, [self._pump(host, proc.stderr)])
+        return result
+
+    def run(self, command):
+        return self._all([self._run_one(h, command) for h in self.hosts])
+
+    def gather(self, paths, dest):
+        return self._all([self._gather_one(h, paths, dest) for h in self.hosts])
+
+    def _all(self, coroutines):
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(asyncio.gather(*coroutines))
+
+
+def summarize(results):
+    failed = [r for r in results if not r.ok]
+    sys.stderr.write('%d ok, %d failed\n' % (len(results) - len(failed), len(failed)))
+    for r in failed:
+        sys.stderr.write('  %s: %s\n' % (
+            r.host, 'timed out' if r.timed_out else 'exit %d' % r.returncode))
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run commands on the cluster nodes in parallel.')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--hostfile', help='default: /etc/chainer-cfn/hostfiles/all')
+    common.add_argument('--group', help='use the hostfile of this node group')
+    common.add_argument('-w', '--hosts', help='comma separated host names or patterns to select')
+    common.add_argument('-x', '--exclude', help='comma separated host names or patterns to exclude')
+    common.add_argument('-p', '--parallel', type=int, default=32, help='maximum concurrent hosts')
+    common.add_argument('-t', '--timeout', type=float, default=300, help='timeout per host in seconds')
+    sub = parser.add_subparsers(dest='subcommand')
+    p = sub.add_parser('run', parents=[common], help='run a command on each host')
+    p.add_argument('command', nargs=argparse.REMAINDER)
+    p = sub.add_parser('gather', parents=[common], help='copy files from each host into DEST/<host>/')
+    p.add_argument('--dest', default='.', help='local directory (default: current directory)')
+    p.add_argument('paths', nargs='+', help='absolute paths on the hosts')
+    args = parser.parse_args(argv)
+
+    if args.subcommand is None:
+        parser.error('subcommand is required')
+    hosts = select_hosts(args)
+    if not hosts:
+        sys.stderr.write('no hosts selected\n')
+        return 1
+    shell = ClusterShell(hosts, args.parallel, args.timeout)
+    if args.subcommand == 'run':
+        if not args.command:
+            parser.error('command is required')
+        command = args.command[1:] if args.command[0] == '--' else args.command
+        results = shell.run(' '.join(command))
+    else:
+        results = shell.gather(args.paths, args.dest)
+    return summarize(results)
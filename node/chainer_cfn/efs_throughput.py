@@ -0,0 +1,43 @@
+"""Switches the EFS filesystem to provisioned throughput on low burst credits.
+
+In bursting mode the throughput of a small filesystem drops to its
+baseline once burst credits are exhausted, which can happen partway
+through a long training.  When enabled, the agent on the master watches
+the burst credit alarm and switches the filesystem to provisioned mode
+before that happens.
+"""
+import logging
+
+from chainer_cfn import aws
+from chainer_cfn import task
+
+logger = logging.getLogger('chainer-cfn-agent')
+
+
+class EfsThroughputTask(task.Task):
+    """Switches to provisioned mode while the burst credit alarm is in ALARM."""
+
+    name = 'efs_throughput'
+    period = 300
+
+    def enabled(self):
+        conf = self.conf.get('efs_throughput', {})
+        return self.conf['role'] == 'Master' and conf.get('auto_provision') == 'True'
+
+    def run(self):
+        conf = self.conf['efs_throughput']
+        alarms = aws.client('cloudwatch').describe_alarms(
+            AlarmNames=[conf['alarm_name']])['MetricAlarms']
+        if not alarms or alarms[0]['StateValue'] != 'ALARM':
+            return
+
+        efs = aws.client('efs')
+        fs = efs.describe_file_systems(FileSystemId=conf['file_system_id'])['FileSystems'][0]
+        if fs.get('ThroughputMode') == 'provisioned':
+            return
+        logger.warning('%s is running out of burst credits, switching to %s MiB/s provisioned throughput',
+                       conf['file_system_id'], conf['provisioned_mibps'])
+        efs.update_file_system(
+            FileSystemId=conf['file_system_id'],
+            ThroughputMode='provisioned',
+            ProvisionedThroughputInMibps=float(conf['provisioned_mibps']))
@@ -0,0 +1,232 @@
+"""Local read cache of the EFS mount with FS-Cache.
+
+``chainer-cfn-fscache setup`` prepares the cache device (a dedicated EBS
+volume or the instance store), configures and starts ``cachefilesd``
+before EFS is mounted with the ``fsc`` option.  Pages read over NFS are
+then kept on the local disk, and later epochs are served from it.
+
+Hit and miss counters are read from ``/proc/fs/fscache/stats`` and posted
+to CloudWatch by the agent.
+"""
+import argparse
+import logging
+import os
+import subprocess
+
+from chainer_cfn import config
+from chainer_cfn import task
+
+# Modules using boto3 are imported lazily, because setup runs from cfn-init
+# before boto3 is installed.
+
+NAMESPACE = 'EFS'
+STATS_PATH = '/proc/fs/fscache/stats'
+CACHE_MOUNT_POINT = '/var/cache/fscache'
+CACHEFILESD_CONF_PATH = '/etc/cachefilesd.conf'
+CACHEFILESD_DEFAULT_PATH = '/etc/default/cachefilesd'
+
+# Device names given in the block device mappings of the template.
+EBS_DEVICES = ['/dev/xvdf', '/dev/sdf']
+INSTANCE_STORE_DEVICES = ['/dev/xvdb', '/dev/sdb']
+NVME_MODELS = {
+    'EBS': 'Amazon Elastic Block Store',
+    'InstanceStore': 'Amazon EC2 NVMe Instance Storage',
+}
+
+logger = logging.getLogger('chainer-cfn-fscache')
+
+
+#
+# Statistics
+#
+def read_stats(path=STATS_PATH):
+    """Returns ``{section: {counter: value}}``, e.g. ``stats['Retrvls']['ok']``."""
+    stats = {}
+    with open(path) as f:
+        for line in f:
+            if ':' not in line:
+                continue
+            section, values = line.split(':', 1)
+            counters = stats.setdefault(section.strip(), {})
+            for kv in values.split():
+                k, _, v = kv.partition('=')
+                if v.isdigit():
+                    counters[k] = int(v)
+    return stats
+
+
+def hits_and_misses(stats):
+    """Returns the number of page retrievals served from and missed by the cache."""
+    r = stats.get('Retrvls', {})
+    return r.get('ok', 0), r.get('nod', 0) + r.get('nbf', 0)
+
+
+class FscacheStatTask(task.Task):
+    """Posts FS-Cache hits, misses and hit ratio of the interval."""
+
+    name = 'fscache'
+    period = 60
+
+    def __init__(self, conf):
+        super(FscacheStatTask, self).__init__(conf)
+        self.prev = None
+
+    def enabled(self):
+        return (bool(self.conf.get('efs_mount_point')) and
+                self.conf.get('fscache', {}).get('mode', 'None') != 'None')
+
+    def run(self):
+        from chainer_cfn import cloudwatch
+        from chainer_cfn import imds
+        if not os.path.exists(STATS_PATH):
+            return
+        cur = hits_and_misses(read_stats())
+        prev, self.prev = self.prev, cur
+        if prev is None or cur[0] < prev[0]:
+            return
+        hits, misses = cur[0] - prev[0], cur[1] - prev[1]
+        metrics = [
+            ('FSCacheHits', hits, 'Count'),
+            ('FSCacheMisses', misses, 'Count'),
+        ]
+        if hits + misses > 0:
+            metrics.append(('FSCacheHitRatio', 100.0 * hits / (hits + misses), 'Percent'))
+        dims = cloudwatch.dimensions(
+            ChainerClusterName=self.conf['cluster_name'],
+            ChainerClusterRole=self.conf['role'],
+            InstanceId=imds.instance_id())
+        cloudwatch.put_metric_data(NAMESPACE, cloudwatch.metric_data(metrics, dims))
+
+
+#
+# Setup
+#
+def _mounts():
+    with open('/proc/mounts') as f:
+        return {l.split()[0]: l.split()[1] for l in f}
+
+
+def _nvme_devices(model):
+    devices = []
+    for name in sorted(os.listdir('/sys/block')):
+        if not name.startswith('nvme'):
+            continue
+        try:
+            with open('/sys/block/%s/device/model' % name) as f:
+                if f.read().strip() == model:
+                    devices.append('/dev/' + name)
+        except IOError:
+            continue
+    return devices
+
+
+def find_device(mode, instance=None):
+    """Returns the block device of the cache, or ``None`` if there is none.
+
+    ``instance`` is the capabilities of the instance type in node.json.  They
+    tell whether the volumes of ``mode`` are NVMe devices and whether the
+    type has an instance store at all; both kinds of devices are probed
+    when they are unknown.
+    """
+    instance = instance or {}
+    nvme_key = 'ebs_nvme' if mode == 'EBS' else 'instance_store_nvme'
+    if mode == 'InstanceStore' and int(instance.get('instance_store', 1)) == 0:
+        logger.warning('the instance type has no instance store')
+        return None
+    nvme = config.flag(instance[nvme_key]) if nvme_key in instance else None
+    candidates = []
+    if nvme is not True:
+        candidates += EBS_DEVICES if mode == 'EBS' else INSTANCE_STORE_DEVICES
+    if nvme is not False:
+        candidates += _nvme_devices(NVME_MODELS[mode])
+
+    mounts = _mounts()
+    for dev in candidates:
+        if not os.path.exists(dev):
+            continue
+        # skip the root volume and its partitions.
+        if any(m == '/' for d, m in mounts.items() if d.startswith(dev)):
+            continue
+        return dev
+    return None
+
+
+def prepare_cache_dir(mode, instance=None):
+    """Mounts the cache device and returns the cache directory."""
+    dev = find_device(mode, instance)
+    if dev is None:
+        logger.warning('no %s device for the cache, falling back to the root volume', mode)
+        os.makedirs(CACHE_MOUNT_POINT, exist_ok=True)
+        return CACHE_MOUNT_POINT
+
+    mounted = _mounts().get(dev)
+    if mounted is not None:
+        # e.g. the instance store mounted on /mnt by cloud-init.
+        cache_dir = os.path.join(mounted, 'fscache')
+        os.makedirs(cache_dir, exist_ok=True)
+        return cache_dir
+
+    if subprocess.call(['blkid', dev], stdout=subprocess.DEVNULL) != 0:
+        subprocess.check_call(['mkfs.ext4', '-q', '-L', 'fscache', dev])
+    os.makedirs(CACHE_MOUNT_POINT, exist_ok=True)
+    subprocess.check_call(['mount', '-o', 'noatime,user_xattr', dev, CACHE_MOUNT_POINT])
+    with open('/etc/fstab') as f:
+        registered = any(l.split()[:1] == [dev] for l in f)
+    if not registered:
+        with open('/etc/fstab', 'a') as f:
+            f.write('%s %s ext4 noatime,user_xattr,nofail 0 2\n' % (dev, CACHE_MOUNT_POINT))
+    return CACHE_MOUNT_POINT
+
+
+def cachefilesd_conf(cache_dir, cull):
+    """Renders cachefilesd.conf.  ``cull`` is ``"brun,bcull,bstop"`` in percent of free space."""
+    brun, bcull, bstop = [int(x) for x in cull.split(',')]
+    if not brun > bcull > bstop >= 0:
+        raise ValueError('cull thresholds must be brun > bcull > bstop: %s' % cull)
+    lines = ['dir %s' % cache_dir, 'tag chainer-cfn']
+    # the same thresholds apply to free files (inodes) as to free blocks.
+    for prefix in ['b', 'f']:
+        lines += ['%srun %d%%' % (prefix, brun),
+                  '%scull %d%%' % (prefix, bcull),
+                  '%sstop %d%%' % (prefix, bstop)]
+    return '\n'.join(lines) + '\n'
+
+
+def setup(conf):
+    fsc = conf.get('fscache', {})
+    if fsc.get('mode', 'None') == 'None':
+        return 0
+    if subprocess.call(['which', 'cachefilesd'], stdout=subprocess.DEVNULL) != 0:
+        subprocess.check_call(['apt-get', 'update', '-q'])
+        subprocess.check_call(['apt-get', 'install', '-y', '-q', 'cachefilesd'])
+
+    cache_dir = prepare_cache_dir(fsc['mode'], conf.get('instance'))
+    with open(CACHEFILESD_CONF_PATH, 'w') as f:
+        f.write(cachefilesd_conf(cache_dir, fsc['cull']))
+    with open(CACHEFILESD_DEFAULT_PATH, 'w') as f:
+        f.write('RUN=yes\n')
+    subprocess.check_call(['service', 'cachefilesd', 'restart'])
+    logger.info('cachefilesd is running on %s', cache_dir)
+    return 0
+
+
+def print_stats():
+    stats = read_stats()
+    hits, misses = hits_and_misses(stats)
+    total = hits + misses
+    print('hits %d misses %d hit ratio %.1f%%' % (
+        hits, misses, 100.0 * hits / total if total else 0.0))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='FS-Cache of the EFS mount')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('setup', help='prepare the cache device and start cachefilesd')
+    sub.add_parser('stats', help='show hit and miss counters')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.command == 'setup':
+        return setup(config.load())
+    return print_stats()
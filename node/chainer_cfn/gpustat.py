@@ -0,0 +1,79 @@
+"""GPU utilization telemetry.
+
+``nvidia-smi`` is sampled every ``SAMPLE_INTERVAL`` seconds between runs so
+that the posted values are averages over the period rather than a single
+instant.  The mean and the minimum over the GPUs of the node are posted;
+a low minimum shows an idle GPU among busy ones.
+"""
+import shutil
+import subprocess
+import threading
+
+from chainer_cfn import cloudwatch
+from chainer_cfn import imds
+from chainer_cfn import task
+
+NAMESPACE = 'ChainerCluster/GPU'
+SAMPLE_INTERVAL = 5
+
+
+def query():
+    """Returns ``[(utilization %, memory utilization %)]`` of each GPU."""
+    out = subprocess.check_output([
+        'nvidia-smi', '--query-gpu=utilization.gpu,memory.used,memory.total',
+        '--format=csv,noheader,nounits']).decode('utf-8')
+    gpus = []
+    for line in out.strip().splitlines():
+        util, used, total = [float(x) for x in line.split(',')]
+        gpus.append((util, 100.0 * used / total if total else 0.0))
+    return gpus
+
+
+class GpuStatTask(task.Task):
+
+    name = 'gpustat'
+    period = 60
+
+    def __init__(self, conf):
+        super(GpuStatTask, self).__init__(conf)
+        self.lock = threading.Lock()
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def enabled(self):
+        return shutil.which('nvidia-smi') is not None
+
+    def start(self):
+        t = threading.Thread(target=self._sample)
+        t.daemon = True
+        t.start()
+
+    def _sample(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            try:
+                gpus = query()
+            except (subprocess.CalledProcessError, ValueError):
+                continue
+            with self.lock:
+                self.samples.append(gpus)
+
+    def run(self):
+        with self.lock:
+            samples, self.samples = self.samples, []
+        if not samples:
+            return
+        ngpus = len(samples[0])
+        samples = [s for s in samples if len(s) == ngpus]
+        # average over time of each GPU
+        util = [sum(s[i][0] for s in samples) / len(samples) for i in range(ngpus)]
+        mem = [sum(s[i][1] for s in samples) / len(samples) for i in range(ngpus)]
+        metrics = [
+            ('GPUUtilization', sum(util) / ngpus, 'Percent'),
+            ('MinGPUUtilization', min(util), 'Percent'),
+            ('GPUMemoryUtilization', sum(mem) / ngpus, 'Percent'),
+        ]
+        dims = cloudwatch.dimensions(
+            ChainerClusterName=self.conf['cluster_name'],
+            ChainerClusterRole=self.conf['role'],
+            InstanceId=imds.instance_id())
+        cloudwatch.put_metric_data(NAMESPACE, cloudwatch.metric_data(metrics, dims))
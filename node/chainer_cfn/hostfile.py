@@ -0,0 +1,96 @@
+import os
+import pwd
+
+from chainer_cfn import aws
+from chainer_cfn import placement
+from chainer_cfn import task
+from chainer_cfn import util
+
+HOSTFILE_PATH = '/usr/local/mpi/etc/openmpi-default-hostfile'
+# one hostfile per node group and "all" of them
+HOSTFILE_DIR = '/etc/chainer-cfn/hostfiles'
+NODE_GROUP_TAG = 'ChainerClusterNodeGroup'
+
+
+def cluster_instances(cluster_name, role=None):
+    """Returns instances tagged with ``ChainerClusterName`` (and ``ChainerClusterRole``).
+
+    Stopped instances, e.g. of a paused cluster, are not members.
+    """
+    filters = [{'Name': 'tag:ChainerClusterName', 'Values': [cluster_name]},
+               {'Name': 'instance-state-name', 'Values': ['pending', 'running']}]
+    if role is not None:
+        filters.append({'Name': 'tag:ChainerClusterRole', 'Values': [role]})
+    paginator = aws.client('ec2').get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=filters)
+    for page in pages:
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                if instance.get('PrivateDnsName'):
+                    yield instance
+
+
+def node_group(instance):
+    tags = {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+    if NODE_GROUP_TAG in tags:
+        return tags[NODE_GROUP_TAG]
+    # instances launched before node groups were introduced
+    return 'master' if tags.get('ChainerClusterRole') == 'Master' else 'workers'
+
+
+def render(hosts, slots=None):
+    if slots:
+        return ''.join('%s slots=%d\n' % (h, slots) for h in hosts)
+    return ''.join(h + '\n' for h in hosts)
+
+
+class HostfileTask(task.Task):
+    """Regenerates the MPI hostfiles from the cluster members.
+
+    The default hostfile lists only the nodes with GPUs, with one slot per
+    GPU, so that GPU ranks never land on CPU nodes.  Hostfiles of each node
+    group are written to ``HOSTFILE_DIR``.  Hosts are ordered by placement
+    group (and partition) so that neighbouring ranks share a placement,
+    and the placement of every node is written to
+    ``placement.PLACEMENT_PATH``.
+    """
+
+    name = 'hostfile'
+    period = 60
+
+    def run(self):
+        gpus = {g['name']: int(g['gpus']) for g in self.conf.get('node_groups', [])}
+        groups = {}
+        placements = {}
+        for i in cluster_instances(self.conf['cluster_name']):
+            host = i['PrivateDnsName']
+            groups.setdefault(node_group(i), []).append(host)
+            placements[host] = placement.placement_of(i) + (node_group(i),)
+
+        def ordered(hosts):
+            return sorted(hosts, key=lambda h: (placement.sort_key(*placements[h][:2]), h))
+
+        user = pwd.getpwnam('chainer')
+        os.makedirs(HOSTFILE_DIR, exist_ok=True)
+        for name, hosts in groups.items():
+            util.write_atomically(os.path.join(HOSTFILE_DIR, name),
+                                  render(ordered(hosts), gpus.get(name)),
+                                  uid=user.pw_uid, gid=user.pw_gid)
+        # groups which were removed or scaled in to no instances
+        for name in os.listdir(HOSTFILE_DIR):
+            if name != 'all' and name not in groups:
+                os.remove(os.path.join(HOSTFILE_DIR, name))
+        util.write_atomically(os.path.join(HOSTFILE_DIR, 'all'),
+                              render(ordered(placements)),
+                              uid=user.pw_uid, gid=user.pw_gid)
+        util.write_atomically(placement.PLACEMENT_PATH, placement.render(placements))
+
+        gpu_hosts = [h for h in placements if gpus.get(placements[h][2])]
+        if gpu_hosts:
+            # by placement, then by node group as groups usually differ in GPUs
+            gpu_hosts.sort(key=lambda h: (placement.sort_key(*placements[h][:2]), placements[h][2], h))
+            content = ''.join('%s slots=%d\n' % (h, gpus[placements[h][2]]) for h in gpu_hosts)
+        else:
+            # a CPU only cluster
+            content = render(ordered(placements))
+        util.write_atomically(HOSTFILE_PATH, content, uid=user.pw_uid, gid=user.pw_gid)
@@ -0,0 +1,43 @@
+"""Instance metadata (IMDS) accessors.
+
+Values which never change during the lifetime of an instance are fetched
+once per process and cached, so that periodic tasks don't hit IMDS again.
+"""
+import os
+import urllib.request
+
+# overridden by the bootstrap simulator (e2e/bootstrap-sim)
+IMDS_ENDPOINT = os.environ.get('CHAINER_CFN_IMDS_ENDPOINT', 'http://169.254.169.254/latest/meta-data/')
+
+_cache = {}
+
+
+def get(path, timeout=2):
+    with urllib.request.urlopen(IMDS_ENDPOINT + path, timeout=timeout) as res:
+        return res.read().decode('utf-8')
+
+
+def cached(path):
+    if path not in _cache:
+        _cache[path] = get(path)
+    return _cache[path]
+
+
+def instance_id():
+    return cached('instance-id')
+
+
+def instance_type():
+    return cached('instance-type')
+
+
+def local_hostname():
+    return cached('local-hostname')
+
+
+def local_ipv4():
+    return cached('local-ipv4')
+
+
+def availability_zone():
+    return cached('placement/availability-zone')
@@ -0,0 +1,243 @@
+"""CuPy kernel cache shared by the nodes of the cluster.
+
+CuPy compiles each kernel the first time a process uses it and keeps the
+binary in ``CUPY_CACHE_DIR``.  Without a shared cache every rank of every
+fresh node compiles the same kernels again during the first iterations.
+
+The cache of a node is ``CACHE_LINK``, which every rank started by
+``chainer-mpirun`` gets as ``CUPY_CACHE_DIR``.  It points to a directory per
+:func:`cache_key` (CUDA version, driver version and GPU architecture), so
+that different instance types never share binaries:
+
+- ``EFS``: ``<EFS>/.chainer-cfn/kernel-cache/<key>``, shared right away.
+- ``AssetBucket``: ``LOCAL_ROOT/<key>`` on the local disk, restored from
+  ``s3://<AssetBucket>/kernel-cache/<key>/`` at bootstrap and merged back
+  (both ways) by the agent every ``KernelCacheTask.period`` seconds.
+
+Concurrent writers are safe in both modes.  CuPy writes a kernel to a
+temporary file and renames it into place, and checks the hash stored in
+the file when loading it.  Cache files are named after the hash of the
+kernel, so two nodes uploading the same object upload the same kernel,
+and downloads are renamed into place too.
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import pwd
+import re
+import shutil
+import subprocess
+import tempfile
+
+from chainer_cfn import config
+from chainer_cfn import task
+
+# Modules using boto3 are imported lazily, because key works without it.
+
+CACHE_LINK = '/var/lib/chainer-cfn/kernel-cache/current'
+LOCAL_ROOT = '/var/lib/chainer-cfn/kernel-cache'
+EFS_DIR = '.chainer-cfn/kernel-cache'
+S3_PREFIX = 'kernel-cache/'
+PARALLEL = 16
+
+logger = logging.getLogger('chainer-cfn-kernel-cache')
+
+
+def _slug(text):
+    return re.sub(r'[^a-z0-9.]+', '-', text.lower()).strip('-')
+
+
+def cuda_version(cuda_home='/usr/local/cuda'):
+    try:
+        with open(os.path.join(cuda_home, 'version.json')) as f:
+            return json.load(f)['cuda']['version']
+    except (IOError, ValueError, KeyError):
+        pass
+    try:
+        # e.g. "CUDA Version 9.0.176"
+        with open(os.path.join(cuda_home, 'version.txt')) as f:
+            return f.read().split()[-1]
+    except (IOError, IndexError):
+        return 'unknown'
+
+
+def _nvidia_smi(query):
+    out = subprocess.check_output(['nvidia-smi', '--query-gpu=' + query,
+                                   '--format=csv,noheader'], stderr=subprocess.DEVNULL)
+    return out.decode('utf-8').splitlines()[0].strip()
+
+
+def cache_key():
+    """Returns e.g. ``cuda9.0.176-driver396.44-sm7.0``, or ``None`` without GPUs."""
+    try:
+        driver = _nvidia_smi('driver_version')
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        return None
+    try:
+        arch = 'sm' + _nvidia_smi('compute_cap')
+    except (subprocess.CalledProcessError, IndexError):
+        # drivers older than 510 don't know compute_cap
+        arch = _slug(_nvidia_smi('name'))
+    return _slug('cuda%s-driver%s-%s' % (cuda_version(), driver, arch))
+
+
+def mode(conf):
+    m = conf.get('kernel_cache', {}).get('mode', 'None')
+    if m == 'EFS' and not conf.get('efs_mount_point'):
+        return 'AssetBucket'
+    return m
+
+
+def cache_dir(conf, key):
+    if mode(conf) == 'EFS':
+        return os.path.join(conf['efs_mount_point'], EFS_DIR, key)
+    return os.path.join(LOCAL_ROOT, key)
+
+
+def _cache_files(directory):
+    """Kernels in ``directory``; CuPy's temporary files start with ``tmp``."""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return set()
+    return set(n for n in names
+               if not n.startswith(('tmp', '.')) and os.path.isfile(os.path.join(directory, n)))
+
+
+def setup(conf):
+    """Creates the cache directory of this node and points ``CACHE_LINK`` to it."""
+    key = cache_key()
+    if key is None or mode(conf) == 'None':
+        return None
+    directory = cache_dir(conf, key)
+    user = pwd.getpwnam('chainer')
+    os.makedirs(directory, exist_ok=True)
+    os.chown(directory, user.pw_uid, user.pw_gid)
+    link = CACHE_LINK
+    # not created by cache_dir in EFS mode
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+    if os.path.realpath(link) != os.path.realpath(directory):
+        tmp = '%s.%d' % (link, os.getpid())
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(directory, tmp)
+        os.rename(tmp, link)
+    return directory
+
+
+#
+# AssetBucket mode
+#
+def _s3():
+    from chainer_cfn import aws
+    return aws.client('s3')
+
+
+def remote_files(bucket, key):
+    prefix = '%s%s/' % (S3_PREFIX, key)
+    names = set()
+    for page in _s3().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            names.add(obj['Key'][len(prefix):])
+    return names
+
+
+def _download(bucket, key, directory, name):
+    fd, tmp = tempfile.mkstemp(prefix='tmp', dir=directory)
+    os.close(fd)
+    try:
+        _s3().download_file(bucket, '%s%s/%s' % (S3_PREFIX, key, name), tmp)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, os.path.join(directory, name))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _upload(bucket, key, directory, name):
+    _s3().upload_file(os.path.join(directory, name), bucket, '%s%s/%s' % (S3_PREFIX, key, name))
+
+
+def sync(bucket, key, directory):
+    """Downloads kernels only in the bucket and uploads kernels only on this node.
+
+    Returns ``(downloaded, uploaded)``.
+    """
+    remote = remote_files(bucket, key)
+    local = _cache_files(directory)
+    downloads = sorted(remote - local)
+    uploads = sorted(local - remote)
+    with concurrent.futures.ThreadPoolExecutor(PARALLEL) as executor:
+        futures = [executor.submit(_download, bucket, key, directory, n) for n in downloads]
+        futures += [executor.submit(_upload, bucket, key, directory, n) for n in uploads]
+        for f in futures:
+            f.result()
+    return len(downloads), len(uploads)
+
+
+class KernelCacheTask(task.Task):
+    """Merges the kernel cache of this node with the one in the asset bucket."""
+
+    name = 'kernel_cache'
+    period = 600
+
+    def __init__(self, conf):
+        super(KernelCacheTask, self).__init__(conf)
+        self.directory = None
+
+    def enabled(self):
+        return mode(self.conf) == 'AssetBucket' and shutil.which('nvidia-smi') is not None
+
+    def start(self):
+        self.directory = setup(self.conf)
+
+    def run(self):
+        if self.directory is None:
+            return
+        key = os.path.basename(self.directory)
+        downloaded, uploaded = sync(self.conf['asset_bucket'], key, self.directory)
+        if downloaded or uploaded:
+            logger.info('kernel cache %s: %d downloaded, %d uploaded', key, downloaded, uploaded)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CuPy kernel cache shared by the cluster')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('setup', help='prepare the cache of this node and restore it from the asset bucket')
+    sub.add_parser('sync', help='merge the cache of this node with the asset bucket now')
+    sub.add_parser('key', help='show the cache key of this node')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.command is None:
+        parser.print_help()
+        return 1
+    if args.command == 'key':
+        key = cache_key()
+        if key is None:
+            return 1
+        print(key)
+        return 0
+    conf = config.load()
+    if args.command == 'setup':
+        directory = setup(conf)
+        if directory is None:
+            logger.info('kernel cache is disabled or this node has no GPU')
+            return 0
+        logger.info('kernel cache is %s', directory)
+    else:
+        directory = os.path.realpath(CACHE_LINK)
+        if not os.path.isdir(directory):
+            logger.error('%s is not set up', CACHE_LINK)
+            return 1
+    if mode(conf) == 'AssetBucket':
+        try:
+            downloaded, uploaded = sync(conf['asset_bucket'], os.path.basename(directory), directory)
+        except Exception:
+            # a cold cache only costs compilation time
+            logger.exception('failed to sync the kernel cache')
+            return 0 if args.command == 'setup' else 1
+        logger.info('%d kernels downloaded, %d uploaded', downloaded, uploaded)
+    return 0
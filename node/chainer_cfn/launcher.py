@@ -0,0 +1,327 @@
+"""Cluster aware MPI launcher.
+
+``chainer-mpirun`` reads the generated hostfile and the GPU/NUMA layout of
+the node, computes the number of ranks (one per GPU), and runs ``mpiexec``
+with ``--map-by``/``--bind-to`` so that each rank stays on the NUMA node of
+its GPU.  Every rank is started through ``chainer-cfn-rank``, which sets
+``CUDA_VISIBLE_DEVICES`` so that device ``CHAINER_CFN_GPU`` (= the local
+rank) is the GPU next to the CPUs the rank is bound to, and
+``CUPY_CACHE_DIR`` to the cluster-wide kernel cache of the node.
+
+The environment of the launcher (``PATH``, ``NCCL_*``, ``CHAINER_*`` ...)
+and the tuned environment in ``RANK_ENV_PATH`` are forwarded to every
+rank.  The default hostfile lists only the nodes with GPUs with one slot
+per GPU; ``--group`` selects the hostfile of a node group instead.  When
+the nodes have the same layout as the launching node, mpiexec binds the
+ranks; otherwise (e.g. launched from a CPU master) mpiexec binds them by the
+GPUs and NUMA nodes of their node group in node.json, and each rank finds
+the GPU order of its own node.
+
+The hosts are ordered by placement group; the placements of the job are
+exported to the ranks as described in ``chainer_cfn.placement``.
+
+With ``--profile``, every rank runs under the sampling profiler of
+``chainer_cfn.profiler`` and a report of compute, data loading and
+communication time of each host is written after the job.
+"""
+import argparse
+import glob
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+from chainer_cfn import config
+from chainer_cfn import hostfile
+from chainer_cfn import kernel_cache
+from chainer_cfn import placement
+from chainer_cfn import profiler
+
+MPIEXEC = '/usr/local/mpi/bin/mpiexec'
+RANK_WRAPPER = '/opt/chainer-cfn/bin/chainer-cfn-rank'
+RANK_ENV_PATH = config.RANK_ENV_PATH
+
+FORWARDED_ENV = ['PATH', 'LD_LIBRARY_PATH', 'PYTHONPATH', 'OMP_NUM_THREADS']
+FORWARDED_ENV_PREFIXES = ('NCCL_', 'CHAINER_', 'CUPY_', 'CUDA_CACHE_')
+
+
+#
+# Node layout
+#
+def _parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes(sysfs='/sys/devices/system/node'):
+    """Returns ``{numa_node: [cpu, ...]}``."""
+    nodes = {}
+    for path in glob.glob(os.path.join(sysfs, 'node[0-9]*')):
+        with open(os.path.join(path, 'cpulist')) as f:
+            nodes[int(os.path.basename(path)[4:])] = _parse_cpulist(f.read())
+    return nodes or {0: list(range(os.cpu_count()))}
+
+
+def gpus():
+    """Returns ``[(gpu_index, numa_node), ...]`` of the GPUs on this node."""
+    try:
+        out = subprocess.check_output([
+            'nvidia-smi', '--query-gpu=index,pci.bus_id', '--format=csv,noheader'])
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    result = []
+    for line in out.decode('utf-8').splitlines():
+        index, bus_id = [x.strip() for x in line.split(',')]
+        # nvidia-smi reports an 8 digit PCI domain, sysfs uses 4 digits.
+        bus_id = bus_id.lower()[-12:]
+        try:
+            with open('/sys/bus/pci/devices/%s/numa_node' % bus_id) as f:
+                numa = max(int(f.read()), 0)
+        except IOError:
+            numa = 0
+        result.append((int(index), numa))
+    return result
+
+
+def layout():
+    """Returns the GPU order (grouped by NUMA node) and ranks per NUMA node.
+
+    ``ranks_per_numa`` is ``None`` when GPUs are not evenly distributed over
+    NUMA nodes.
+    """
+    nodes = numa_nodes()
+    gs = sorted(gpus(), key=lambda g: (g[1], g[0]))
+    per_numa = {}
+    for _, numa in gs:
+        per_numa[numa] = per_numa.get(numa, 0) + 1
+    counts = set(per_numa.values())
+    ranks_per_numa = None
+    if len(counts) == 1 and len(per_numa) == len(nodes):
+        ranks_per_numa = counts.pop()
+    return {
+        'gpus': gs,
+        'numa_nodes': nodes,
+        'ranks_per_numa': ranks_per_numa,
+    }
+
+
+#
+# Launcher
+#
+def read_hostfile(path=hostfile.HOSTFILE_PATH):
+    """Returns ``[(host, slots or None), ...]``."""
+    hosts = []
+    with open(path) as f:
+        for line in f:
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            slots = [int(w[6:]) for w in words[1:] if w.startswith('slots=')]
+            hosts.append((words[0], slots[0] if slots else None))
+    return hosts
+
+
+def group_layout(hosts, conf):
+    """Returns ``(gpus, ranks_per_numa)`` of ``hosts`` from their node groups.
+
+    The capabilities of the instance type of each node group are in
+    node.json.  ``None`` unless all the hosts have the same number of GPUs
+    evenly spread over their NUMA nodes.
+    """
+    try:
+        known = placement.load()['hosts']
+    except (IOError, ValueError):
+        return None
+    groups = {g['name']: g for g in conf.get('node_groups', [])}
+    layouts = set()
+    for h, _ in hosts:
+        g = groups.get(known.get(h, {}).get('node_group'))
+        if g is None or 'numa_nodes' not in g:
+            return None
+        layouts.add((int(g['gpus']), int(g['numa_nodes'])))
+    if len(layouts) != 1:
+        return None
+    gpus, numa = layouts.pop()
+    if gpus == 0 or gpus % numa:
+        return None
+    return gpus, gpus // numa
+
+
+def read_env_file(path=RANK_ENV_PATH):
+    env = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#') and '=' in line:
+                    k, v = line.split('=', 1)
+                    env[k] = v
+    except IOError:
+        pass
+    return env
+
+
+def build_command(args, lay, hosts, environ, groups=None):
+    ngpus = len(lay['gpus'])
+    nodes = args.nodes or len(hosts)
+    if nodes > len(hosts):
+        raise ValueError('%d nodes requested but hostfile has only %d hosts' % (nodes, len(hosts)))
+    hosts = hosts[:nodes]
+    slots = set(s for _, s in hosts if s)
+    # ranks of each host: one per slot (GPU) unless --ppn is given
+    ranks = [args.ppn or s or ngpus or 1 for _, s in hosts]
+    ppn = max(ranks)
+    # whether the nodes look like the launching node
+    same_layout = ngpus > 0 and slots <= {ngpus}
+
+    cmd = [MPIEXEC, '-n', str(sum(ranks)), '--host',
+           ','.join('%s:%d' % (h, n) for (h, _), n in zip(hosts, ranks))]
+    if len(set(ranks)) > 1:
+        # e.g. "all" of groups with different GPUs; ranks fill the slots of
+        # each host and bind themselves in chainer-cfn-rank.
+        cmd += ['--map-by', 'slot', '--bind-to', 'none']
+    elif same_layout and ppn == ngpus and lay['ranks_per_numa']:
+        cmd += ['--map-by', 'ppr:%d:numa' % lay['ranks_per_numa'], '--bind-to', 'numa']
+    elif not same_layout and groups and ppn == groups[0]:
+        # ranks take the GPUs of their NUMA node in chainer-cfn-rank.
+        cmd += ['--map-by', 'ppr:%d:numa' % groups[1], '--bind-to', 'numa']
+    else:
+        # ranks bind themselves to the NUMA node of their GPU in chainer-cfn-rank.
+        cmd += ['--map-by', 'ppr:%d:node' % ppn, '--bind-to', 'none']
+    cmd += ['--mca', 'btl_tcp_if_exclude', 'lo,docker0']
+    if args.display_map:
+        cmd += ['--display-map']
+
+    env = read_env_file()
+    for k, v in environ.items():
+        if k in FORWARDED_ENV or k.startswith(FORWARDED_ENV_PREFIXES):
+            env[k] = v
+    if 'OMP_NUM_THREADS' not in env:
+        cpus = sum(len(c) for c in lay['numa_nodes'].values())
+        env['OMP_NUM_THREADS'] = str(max(cpus // ppn, 1))
+    if same_layout:
+        env['CHAINER_CFN_GPU_ORDER'] = ','.join(str(g) for g, _ in lay['gpus'])
+    placements = placement.placements_of([h for h, _ in hosts])
+    if placements:
+        env[placement.ENV_PLACEMENTS] = ','.join(placements)
+    if getattr(args, 'profile_dir', None):
+        env.update(profiler.rank_env(args.profile_dir, args.profile_start, args.profile_duration,
+                                     args.profile_interval, args.profile_nvtx))
+    for k in sorted(env):
+        cmd += ['-x', '%s=%s' % (k, env[k])]
+
+    cmd += [sys.executable, RANK_WRAPPER] + args.command
+    return cmd
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run an MPI job on the cluster with one rank per GPU.',
+        usage='%(prog)s [options] command [args...]')
+    parser.add_argument('--hostfile', default=hostfile.HOSTFILE_PATH)
+    parser.add_argument('--group', help='run on the nodes of this node group (e.g. workers, master, all)')
+    parser.add_argument('--nodes', type=int, help='number of nodes to use (default: all)')
+    parser.add_argument('--ppn', type=int, help='ranks per node (default: number of GPUs)')
+    parser.add_argument('--display-map', action='store_true')
+    parser.add_argument('--dry-run', action='store_true', help='print mpiexec command and exit')
+    p = parser.add_argument_group('profiling')
+    p.add_argument('--profile', action='store_true',
+                   help='profile every rank and report compute/data/comm time of each host')
+    p.add_argument('--profile-start', type=float, default=30,
+                   help='seconds after the start of each rank to start profiling')
+    p.add_argument('--profile-duration', type=float, default=60, help='seconds to profile')
+    p.add_argument('--profile-interval', type=float, default=0.01, help='sampling interval in seconds')
+    p.add_argument('--profile-nvtx', action='store_true', help='also capture CUDA/NVTX with nvprof')
+    p.add_argument('--profile-dir', help='default: <EFS>/chainer-cfn-profiles/<time> or '
+                   '/tmp/chainer-cfn-profiles/<time> gathered from the hosts')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.error('command is required')
+
+    path = os.path.join(hostfile.HOSTFILE_DIR, args.group) if args.group else args.hostfile
+    hosts = read_hostfile(path)
+    if args.nodes and args.nodes > len(hosts):
+        parser.error('%d nodes requested but %s has only %d hosts' % (args.nodes, path, len(hosts)))
+    try:
+        conf = config.load()
+    except IOError:
+        conf = {}
+    shared = None
+    if args.profile:
+        shared = conf.get('efs_mount_point') or None
+        if args.profile_dir is None:
+            name = time.strftime('%Y%m%d-%H%M%S')
+            if shared:
+                args.profile_dir = os.path.join(shared, 'chainer-cfn-profiles', name)
+            else:
+                args.profile_dir = os.path.join('/tmp/chainer-cfn-profiles', name)
+    cmd = build_command(args, layout(), hosts, os.environ,
+                        group_layout(hosts[:args.nodes or len(hosts)], conf))
+    if args.dry_run:
+        print(' '.join(shlex.quote(c) for c in cmd))
+        return 0
+    if not args.profile:
+        os.execv(cmd[0], cmd)
+    code = subprocess.call(cmd)
+    return report_profiles(args.profile_dir, hosts[:args.nodes or len(hosts)], shared) or code
+
+
+def report_profiles(directory, hosts, shared):
+    if not (shared and os.path.abspath(directory).startswith(shared)):
+        profiler.collect(directory, [h for h, _ in hosts])
+        prefix = 'profiles/%s/' % os.path.basename(directory)
+        try:
+            bucket = config.load()['asset_bucket']
+            profiler.upload(directory, bucket, prefix)
+            sys.stderr.write('profiles are uploaded to s3://%s/%s\n' % (bucket, prefix))
+        except Exception as e:
+            sys.stderr.write('failed to upload profiles: %s\n' % e)
+    text = profiler.write_report(directory)
+    if text is None:
+        return 1
+    sys.stdout.write(text)
+    sys.stderr.write('profiles and report are in %s\n' % directory)
+    return 0
+
+
+#
+# Per-rank wrapper
+#
+def rank_main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    local_rank = int(os.environ.get('OMPI_COMM_WORLD_LOCAL_RANK', 0))
+    order = [g for g in os.environ.get('CHAINER_CFN_GPU_ORDER', '').split(',') if g]
+    lay = None
+    if not order:
+        lay = layout()
+        order = [str(g) for g, _ in lay['gpus']]
+    if order:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(order)
+        os.environ['CHAINER_CFN_GPU'] = str(local_rank % len(order))
+        lay = lay or layout()
+        gpu_numa = dict(lay['gpus'])
+        numa = gpu_numa.get(int(order[local_rank % len(order)]))
+        # bind only when mpiexec did not, i.e. the rank may use any cpu.
+        if numa is not None and len(os.sched_getaffinity(0)) == os.cpu_count():
+            os.sched_setaffinity(0, lay['numa_nodes'][numa])
+    os.environ['CHAINER_CFN_LOCAL_RANK'] = str(local_rank)
+    if 'CUPY_CACHE_DIR' not in os.environ and os.path.isdir(kernel_cache.CACHE_LINK):
+        os.environ['CUPY_CACHE_DIR'] = kernel_cache.CACHE_LINK
+    placements = [p for p in os.environ.get(placement.ENV_PLACEMENTS, '').split(',') if p]
+    local = placement.local_placement() if placements else None
+    if local in placements:
+        os.environ[placement.ENV_PLACEMENT] = local
+        os.environ[placement.ENV_INDEX] = str(placements.index(local))
+    if os.environ.get(profiler.ENV_DIR):
+        argv = profiler.wrap_rank_command(argv, os.environ)
+    os.execvp(argv[0], argv)
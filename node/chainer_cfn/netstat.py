@@ -0,0 +1,143 @@
+"""Network throughput, retransmit and ENA allowance telemetry.
+
+Counters are sampled from ``/proc/net/dev``, ``/proc/net/snmp`` and
+``ethtool -S`` and converted into per-interval rates against the previous
+sample.
+"""
+import subprocess
+import time
+
+from chainer_cfn import cloudwatch
+from chainer_cfn import imds
+from chainer_cfn import task
+
+NAMESPACE = 'ChainerCluster/Network'
+
+IGNORED_INTERFACE_PREFIXES = ('lo', 'docker', 'veth', 'virbr', 'br-')
+
+# ENA increments these when the instance exceeds its network allowances.
+ENA_ALLOWANCE_COUNTERS = {
+    'bw_in_allowance_exceeded': 'BwInAllowanceExceeded',
+    'bw_out_allowance_exceeded': 'BwOutAllowanceExceeded',
+    'pps_allowance_exceeded': 'PpsAllowanceExceeded',
+    'conntrack_allowance_exceeded': 'ConntrackAllowanceExceeded',
+    'linklocal_allowance_exceeded': 'LinklocalAllowanceExceeded',
+}
+
+
+def interfaces(path='/proc/net/dev'):
+    with open(path) as f:
+        lines = f.readlines()[2:]
+    names = [l.split(':', 1)[0].strip() for l in lines]
+    return [n for n in names if not n.startswith(IGNORED_INTERFACE_PREFIXES)]
+
+
+def read_net_dev(path='/proc/net/dev'):
+    """Returns rx/tx byte, packet and drop counters summed over interfaces."""
+    totals = dict.fromkeys(
+        ['RxBytes', 'RxPackets', 'RxDrop', 'TxBytes', 'TxPackets', 'TxDrop'], 0)
+    with open(path) as f:
+        lines = f.readlines()[2:]
+    for line in lines:
+        name, values = line.split(':', 1)
+        if name.strip().startswith(IGNORED_INTERFACE_PREFIXES):
+            continue
+        v = [int(x) for x in values.split()]
+        totals['RxBytes'] += v[0]
+        totals['RxPackets'] += v[1]
+        totals['RxDrop'] += v[3]
+        totals['TxBytes'] += v[8]
+        totals['TxPackets'] += v[9]
+        totals['TxDrop'] += v[11]
+    return totals
+
+
+def read_tcp_snmp(path='/proc/net/snmp'):
+    with open(path) as f:
+        tcp = [l.split()[1:] for l in f if l.startswith('Tcp:')]
+    stats = dict(zip(tcp[0], (int(x) for x in tcp[1])))
+    return {
+        'TcpOutSegs': stats['OutSegs'],
+        'TcpRetransSegs': stats['RetransSegs'],
+    }
+
+
+def read_ena_allowances(ifaces):
+    totals = dict.fromkeys(ENA_ALLOWANCE_COUNTERS.values(), 0)
+    for iface in ifaces:
+        try:
+            out = subprocess.check_output(
+                ['ethtool', '-S', iface], stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        for line in out.decode('utf-8').splitlines():
+            key, _, value = line.strip().partition(':')
+            if key in ENA_ALLOWANCE_COUNTERS:
+                totals[ENA_ALLOWANCE_COUNTERS[key]] += int(value)
+    return totals
+
+
+def sample():
+    counters = {}
+    counters.update(read_net_dev())
+    counters.update(read_tcp_snmp())
+    counters.update(read_ena_allowances(interfaces()))
+    return {'time': time.time(), 'counters': counters}
+
+
+def rates(prev, cur):
+    """Converts two samples into metric values for the interval between them.
+
+    Byte/packet/drop counters become per-second rates, allowance counters
+    are reported as the number of events in the interval.  Returns ``None``
+    when the counters went backwards (e.g. after a reboot).
+    """
+    elapsed = cur['time'] - prev['time']
+    if elapsed <= 0:
+        return None
+    delta = {}
+    for k, v in cur['counters'].items():
+        if k not in prev['counters']:
+            continue
+        d = v - prev['counters'][k]
+        if d < 0:
+            return None
+        delta[k] = d
+
+    metrics = []
+    for k in ['RxBytes', 'TxBytes']:
+        metrics.append((k + 'PerSec', delta[k] / elapsed, 'Bytes/Second'))
+    for k in ['RxPackets', 'TxPackets', 'RxDrop', 'TxDrop']:
+        metrics.append((k + 'PerSec', delta[k] / elapsed, 'Count/Second'))
+    metrics.append(('TcpRetransSegsPerSec', delta['TcpRetransSegs'] / elapsed, 'Count/Second'))
+    retrans_ratio = 0.0
+    if delta['TcpOutSegs'] > 0:
+        retrans_ratio = 100.0 * delta['TcpRetransSegs'] / delta['TcpOutSegs']
+    metrics.append(('TcpRetransPercent', retrans_ratio, 'Percent'))
+    for k in ENA_ALLOWANCE_COUNTERS.values():
+        metrics.append((k, delta.get(k, 0), 'Count'))
+    return metrics
+
+
+class NetStatTask(task.Task):
+
+    name = 'netstat'
+    period = 60
+
+    def __init__(self, conf):
+        super(NetStatTask, self).__init__(conf)
+        self.prev = None
+
+    def run(self):
+        cur = sample()
+        prev, self.prev = self.prev, cur
+        if prev is None:
+            return
+        metrics = rates(prev, cur)
+        if metrics is None:
+            return
+        dims = cloudwatch.dimensions(
+            ChainerClusterName=self.conf['cluster_name'],
+            ChainerClusterRole=self.conf['role'],
+            InstanceId=imds.instance_id())
+        cloudwatch.put_metric_data(NAMESPACE, cloudwatch.metric_data(metrics, dims))
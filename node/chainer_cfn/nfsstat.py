@@ -0,0 +1,104 @@
+"""NFS client throughput and latency of the EFS mount.
+
+Statistics are read from ``/proc/self/mountstats`` instead of running
+``nfsstat``, so that no process is spawned per sample.
+"""
+import time
+
+from chainer_cfn import cloudwatch
+from chainer_cfn import imds
+from chainer_cfn import task
+
+NAMESPACE = 'EFS'
+MOUNTSTATS_PATH = '/proc/self/mountstats'
+
+# Field order of the per-op statistics lines.
+OP_FIELDS = ['ops', 'trans', 'timeouts', 'bytes_sent', 'bytes_recv',
+             'queue_ms', 'rtt_ms', 'execute_ms']
+
+
+def read_mountstats(mount_point, path=MOUNTSTATS_PATH):
+    """Returns ``{'bytes': {...}, 'ops': {OP: {...}}}`` of the NFS mount at ``mount_point``."""
+    stats = None
+    in_ops = False
+    with open(path) as f:
+        for line in f:
+            if line.startswith('device '):
+                if stats is not None:
+                    break
+                words = line.split()
+                if words[3] == 'on' and words[4] == mount_point and words[7].startswith('nfs'):
+                    stats = {'bytes': {}, 'ops': {}}
+                    in_ops = False
+                continue
+            if stats is None:
+                continue
+            line = line.strip()
+            if line.startswith('bytes:'):
+                v = [int(x) for x in line.split()[1:]]
+                stats['bytes'] = {'read': v[4], 'write': v[5]}
+            elif line == 'per-op statistics':
+                in_ops = True
+            elif in_ops and ':' in line:
+                op, values = line.split(':', 1)
+                v = [int(x) for x in values.split()[:len(OP_FIELDS)]]
+                stats['ops'][op] = dict(zip(OP_FIELDS, v))
+    return stats
+
+
+def _op_group(op):
+    if op == 'READ':
+        return 'Read'
+    if op == 'WRITE':
+        return 'Write'
+    return 'Metadata'
+
+
+def rates(prev, cur, elapsed):
+    metrics = [
+        ('ReadBytesPerSec', (cur['bytes']['read'] - prev['bytes']['read']) / elapsed, 'Bytes/Second'),
+        ('WriteBytesPerSec', (cur['bytes']['write'] - prev['bytes']['write']) / elapsed, 'Bytes/Second'),
+    ]
+    ops = {}
+    rtt = {}
+    for op, s in cur['ops'].items():
+        p = prev['ops'].get(op)
+        if p is None:
+            continue
+        g = _op_group(op)
+        ops[g] = ops.get(g, 0) + s['ops'] - p['ops']
+        rtt[g] = rtt.get(g, 0) + (s['queue_ms'] + s['rtt_ms']) - (p['queue_ms'] + p['rtt_ms'])
+    for g in ['Read', 'Write', 'Metadata']:
+        n = ops.get(g, 0)
+        metrics.append((g + 'OpsPerSec', n / elapsed, 'Count/Second'))
+        metrics.append((g + 'Latency', rtt[g] / n if n > 0 else 0.0, 'Milliseconds'))
+    return metrics
+
+
+class NfsStatTask(task.Task):
+
+    name = 'nfsstat'
+    period = 60
+
+    def __init__(self, conf):
+        super(NfsStatTask, self).__init__(conf)
+        self.prev = None
+
+    def enabled(self):
+        return bool(self.conf.get('efs_mount_point'))
+
+    def run(self):
+        cur = read_mountstats(self.conf['efs_mount_point'])
+        if cur is None:
+            self.prev = None
+            return
+        cur['time'] = time.time()
+        prev, self.prev = self.prev, cur
+        if prev is None or cur['bytes']['read'] < prev['bytes']['read']:
+            return
+        metrics = rates(prev, cur, cur['time'] - prev['time'])
+        dims = cloudwatch.dimensions(
+            ChainerClusterName=self.conf['cluster_name'],
+            ChainerClusterRole=self.conf['role'],
+            InstanceId=imds.instance_id())
+        cloudwatch.put_metric_data(NAMESPACE, cloudwatch.metric_data(metrics, dims))
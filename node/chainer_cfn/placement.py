@@ -0,0 +1,95 @@
+"""Placement of the nodes in placement groups.
+
+A cluster may span several placement groups (``PlacementStrategy`` of
+the template): one cluster placement group for each worker group, or the
+partitions of a partition placement group.  Latency and bandwidth are
+best within a placement, so the hostfile task orders every hostfile by
+placement and records the placement of each node in ``PLACEMENT_PATH``::
+
+    {"placements": ["pg-a", "pg-b"],
+     "hosts": {"ip-10-0-0-1.ec2.internal":
+               {"placement_group": "pg-a", "partition": null,
+                "node_group": "workers", "placement": "pg-a"}, ...}}
+
+A placement is named after its placement group, with ``/<partition>`` for
+a partition placement group.  ``chainer-mpirun`` exports the placements of
+the hosts of a job in ``CHAINER_CFN_PLACEMENTS`` and every rank gets the
+index of its own one in ``CHAINER_CFN_PLACEMENT_INDEX``, so that a training
+script can e.g. do hierarchical communication per placement with
+``split(comm.mpi_comm)``.
+"""
+import json
+import os
+
+from chainer_cfn import imds
+
+PLACEMENT_PATH = '/etc/chainer-cfn/placement.json'
+ENV_PLACEMENTS = 'CHAINER_CFN_PLACEMENTS'
+ENV_PLACEMENT = 'CHAINER_CFN_PLACEMENT'
+ENV_INDEX = 'CHAINER_CFN_PLACEMENT_INDEX'
+
+
+def placement_of(instance):
+    """Returns ``(placement group name, partition number or None)`` of an instance."""
+    p = instance.get('Placement', {})
+    return p.get('GroupName') or '', p.get('PartitionNumber')
+
+
+def name(group, partition):
+    if partition is None:
+        return group
+    return '%s/%d' % (group, partition)
+
+
+def sort_key(group, partition):
+    return group, partition or 0
+
+
+def render(hosts):
+    """Returns the content of ``PLACEMENT_PATH``.
+
+    ``hosts`` is ``{host: (placement group, partition, node group)}``.
+    """
+    keys = sorted(set((g, p) for g, p, _ in hosts.values()), key=lambda k: sort_key(*k))
+    return json.dumps({
+        'placements': [name(*k) for k in keys],
+        'hosts': {h: {
+            'placement_group': g,
+            'partition': p,
+            'node_group': n,
+            'placement': name(g, p),
+        } for h, (g, p, n) in hosts.items()},
+    }, indent=2, sort_keys=True) + '\n'
+
+
+def load(path=PLACEMENT_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def placements_of(hosts, path=PLACEMENT_PATH):
+    """Returns the placements of ``hosts`` in order, or ``[]`` if unknown."""
+    try:
+        known = load(path)['hosts']
+    except (IOError, ValueError):
+        return []
+    result = []
+    for h in hosts:
+        p = known.get(h, {}).get('placement')
+        if p is not None and p not in result:
+            result.append(p)
+    return result
+
+
+def local_placement(path=PLACEMENT_PATH):
+    """Returns the placement of this node, or ``None`` if unknown."""
+    try:
+        return load(path)['hosts'][imds.local_hostname()]['placement']
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def split(mpi_comm):
+    """Splits an MPI communicator into one communicator per placement."""
+    color = int(os.environ.get(ENV_INDEX, 0))
+    return mpi_comm.Split(color, mpi_comm.rank)
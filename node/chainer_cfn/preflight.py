@@ -0,0 +1,307 @@
+"""Pre-flight burn-in of a cluster node.
+
+This runs between cfn-init and cfn-signal.  It checks GPU matmul
+throughput, ECC errors, hardware XID events, loopback TCP bandwidth and
+TCP bandwidth to the master, and compares them with the per-instance-type
+thresholds in ``/etc/chainer-cfn/node.json``.  Results are written to
+``RESULT_PATH``, uploaded to the asset bucket and posted to CloudWatch.
+
+A worker which fails is marked unhealthy so that the auto scaling group
+replaces it, and the command exits with non-zero status so that the node
+never signals.  A check which cannot run (e.g. CUDA fails to initialize)
+fails, and so does the whole pre-flight on an unexpected error; only an
+unreachable master is not counted against the node.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import threading
+import time
+
+from chainer_cfn import aws
+from chainer_cfn import cloudwatch
+from chainer_cfn import config
+from chainer_cfn import hostfile
+from chainer_cfn import imds
+from chainer_cfn import task
+
+NAMESPACE = 'ChainerCluster/Preflight'
+RESULT_PATH = '/var/log/chainer-cfn/preflight.json'
+BANDWIDTH_PORT = 18700
+CHUNK = b'\0' * (1 << 20)
+
+# XIDs which indicate hardware or driver problems rather than application
+# faults (e.g. 13, 31 and 43 are usually caused by user programs).
+HARDWARE_XIDS = {48, 61, 62, 63, 64, 74, 79, 92, 94, 95}
+
+logger = logging.getLogger('chainer-cfn-preflight')
+
+
+#
+# GPU
+#
+def gpu_matmul_tflops(n=4096, iterations=20):
+    """Returns the float32 matmul throughput (TFLOPS) of each GPU."""
+    import cupy
+    results = []
+    for i in range(cupy.cuda.runtime.getDeviceCount()):
+        with cupy.cuda.Device(i):
+            a = cupy.random.rand(n, n, dtype=cupy.float32)
+            b = cupy.random.rand(n, n, dtype=cupy.float32)
+            cupy.matmul(a, b)
+            cupy.cuda.Device(i).synchronize()
+            start = time.time()
+            for _ in range(iterations):
+                cupy.matmul(a, b)
+            cupy.cuda.Device(i).synchronize()
+            elapsed = time.time() - start
+        results.append(2.0 * n ** 3 * iterations / elapsed / 1e12)
+    return results
+
+
+def ecc_errors():
+    """Returns uncorrected volatile ECC errors of each GPU (0 if ECC is unsupported)."""
+    out = subprocess.check_output([
+        'nvidia-smi',
+        '--query-gpu=ecc.errors.uncorrected.volatile.total',
+        '--format=csv,noheader,nounits'])
+    errors = []
+    for line in out.decode('utf-8').splitlines():
+        line = line.strip()
+        errors.append(int(line) if line.isdigit() else 0)
+    return errors
+
+
+def xid_events():
+    """Returns XID numbers reported by the NVIDIA driver since boot."""
+    out = subprocess.check_output(['dmesg'])
+    return [int(x) for x in re.findall(r'NVRM: Xid \([^)]*\): (\d+)', out.decode('utf-8', 'replace'))]
+
+
+#
+# Network
+#
+class BandwidthServer(object):
+    """Discards whatever is sent and replies the number of bytes received."""
+
+    def __init__(self, host='0.0.0.0', port=BANDWIDTH_PORT):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(64)
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.sock.accept()
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        received = 0
+        buf = bytearray(len(CHUNK))
+        with conn:
+            while True:
+                n = conn.recv_into(buf)
+                if n == 0:
+                    break
+                received += n
+            conn.sendall(str(received).encode('ascii'))
+
+
+class BandwidthServerTask(task.Task):
+    """Runs the bandwidth server on the master so that workers can check against it."""
+
+    name = 'bandwidth_server'
+    period = 3600
+
+    def enabled(self):
+        return self.conf['role'] == 'Master'
+
+    def start(self):
+        threading.Thread(target=BandwidthServer().serve_forever, daemon=True).start()
+
+    def run(self):
+        pass
+
+
+def _send(host, port, duration, result, index):
+    sock = socket.create_connection((host, port), timeout=10)
+    with sock:
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            sock.sendall(CHUNK)
+        sock.shutdown(socket.SHUT_WR)
+        result[index] = int(sock.recv(64).decode('ascii'))
+
+
+def tcp_bandwidth_gbps(host, port=BANDWIDTH_PORT, streams=4, duration=3.0):
+    """Measures TCP throughput to ``host`` with parallel streams, counted by the receiver."""
+    result = [0] * streams
+    threads = [threading.Thread(target=_send, args=(host, port, duration, result, i))
+               for i in range(streams)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    return sum(result) * 8 / elapsed / 1e9
+
+
+def loopback_bandwidth_gbps(**kwargs):
+    server = BandwidthServer(host='127.0.0.1', port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return tcp_bandwidth_gbps('127.0.0.1', port=server.port, **kwargs)
+
+
+def master_address(cluster_name):
+    for instance in hostfile.cluster_instances(cluster_name, role='Master'):
+        if instance['State']['Name'] == 'running':
+            return instance['PrivateIpAddress']
+    return None
+
+
+def wait_for_master(cluster_name, timeout):
+    """Returns the master address once its bandwidth server accepts connections."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            address = master_address(cluster_name)
+        except Exception:
+            # e.g. throttled; the master is looked up again.
+            logger.exception('failed to look up the master')
+            address = None
+        if address is not None:
+            try:
+                socket.create_connection((address, BANDWIDTH_PORT), timeout=5).close()
+                return address
+            except (OSError, socket.timeout):
+                pass
+        time.sleep(10)
+    return None
+
+
+#
+# Checks
+#
+def check(results, name, measure, passes):
+    try:
+        value = measure()
+    except Exception as e:
+        # a broken GPU or driver often shows up as an error here.
+        logger.exception('check %s could not run', name)
+        results[name] = {'value': None, 'passed': False, 'error': repr(e)}
+        return
+    results[name] = {'value': value, 'passed': passes(value)}
+    logger.info('%s: %r (%s)', name, value, 'ok' if results[name]['passed'] else 'FAILED')
+
+
+def run_checks(conf, master_timeout):
+    thresholds = conf['preflight']
+    results = {}
+    if int(thresholds['GpuCount']) > 0:
+        min_tflops = float(thresholds['MinGpuTflops'])
+        check(results, 'gpu_matmul_tflops', gpu_matmul_tflops,
+              lambda v: len(v) == int(thresholds['GpuCount']) and min(v) >= min_tflops)
+        check(results, 'gpu_ecc_errors', ecc_errors, lambda v: sum(v) == 0)
+        check(results, 'gpu_hardware_xids', xid_events,
+              lambda v: not HARDWARE_XIDS.intersection(v))
+    check(results, 'loopback_gbps', loopback_bandwidth_gbps,
+          lambda v: v >= float(thresholds['MinLoopbackGbps']))
+    if conf['role'] != 'Master':
+        address = wait_for_master(conf['cluster_name'], master_timeout)
+        if address is None:
+            # the master being unreachable is not a problem of this node.
+            results['master_gbps'] = {'value': None, 'passed': None,
+                                      'error': 'master is not reachable'}
+        else:
+            check(results, 'master_gbps', lambda: tcp_bandwidth_gbps(address),
+                  lambda v: v >= float(thresholds['MinMasterGbps']))
+    return results
+
+
+def record(conf, report):
+    os.makedirs(os.path.dirname(RESULT_PATH), exist_ok=True)
+    body = json.dumps(report, indent=2, sort_keys=True)
+    with open(RESULT_PATH, 'w') as f:
+        f.write(body)
+    aws.client('s3').put_object(
+        Bucket=conf['asset_bucket'],
+        Key='preflight/%s.json' % report['instance_id'],
+        Body=body.encode('utf-8'))
+
+    dims = cloudwatch.dimensions(
+        ChainerClusterName=conf['cluster_name'],
+        ChainerClusterRole=conf['role'],
+        InstanceType=report['instance_type'])
+    data = [('PreflightPassed', 1 if report['passed'] else 0, 'Count')]
+    for name, r in sorted(report['checks'].items()):
+        if isinstance(r['value'], (int, float)):
+            data.append((name, r['value'], 'None'))
+        elif isinstance(r['value'], list) and r['value'] and name == 'gpu_matmul_tflops':
+            data.append(('min_' + name, min(r['value']), 'None'))
+    cloudwatch.put_metric_data(NAMESPACE, cloudwatch.metric_data(data, dims))
+
+
+def mark_unhealthy(instance_id):
+    aws.client('autoscaling').set_instance_health(
+        InstanceId=instance_id,
+        HealthStatus='Unhealthy',
+        ShouldRespectGracePeriod=False)
+
+
+def run_preflight(args):
+    conf = config.load()
+    checks = run_checks(conf, args.master_timeout)
+    report = {
+        'instance_id': imds.instance_id(),
+        'instance_type': imds.instance_type(),
+        'hostname': imds.local_hostname(),
+        'role': conf['role'],
+        'time': time.time(),
+        'thresholds': conf['preflight'],
+        'checks': checks,
+        'passed': all(c['passed'] is not False for c in checks.values()),
+    }
+    try:
+        record(conf, report)
+    except Exception:
+        logger.exception('failed to record the result')
+
+    if report['passed']:
+        return 0
+    logger.error('pre-flight check failed: %s', ', '.join(
+        name for name, c in sorted(checks.items()) if c['passed'] is False))
+    if args.mark_unhealthy:
+        mark_unhealthy(report['instance_id'])
+    return 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='chainer-cfn node pre-flight check')
+    parser.add_argument('--mark-unhealthy', action='store_true',
+                        help='mark this instance unhealthy in its auto scaling group on failure')
+    parser.add_argument('--master-timeout', type=float, default=900,
+                        help='seconds to wait for the master to become reachable')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    try:
+        return run_preflight(args)
+    except Exception:
+        # without this the node would neither signal nor be replaced, and
+        # the stack would wait for the whole creation timeout.
+        logger.exception('pre-flight check failed with an unexpected error')
+        if args.mark_unhealthy:
+            try:
+                mark_unhealthy(imds.instance_id())
+            except Exception:
+                logger.exception('failed to mark this instance unhealthy')
+        return 1
@@ -0,0 +1,326 @@
+"""Distributed sampling profiler of ChainerMN jobs.
+
+``chainer-mpirun --profile`` runs every Python rank under a sampler thread
+which records the stack of the main thread every ``interval`` seconds
+during a bounded window (``--profile-start`` seconds after the start, for
+``--profile-duration`` seconds).  Each sample is classified from the
+modules on the stack:
+
+- ``comm``: ChainerMN communicators, mpi4py and NCCL
+- ``data``: iterators, datasets and image decoding
+- ``compute``: anything else (forward, backward, optimizer ...)
+
+and its wall time is added to the category, so that time spent in C code
+which holds the GIL is not lost.  Note that CUDA kernels run
+asynchronously; GPU time shows up where the host waits for the GPU,
+typically in ``comm``.  With ``--profile-nvtx`` the window is also captured
+by ``nvprof`` as an NVTX range.
+
+Profiles of all ranks are written to a directory on EFS, or gathered from
+the hosts into the launching node (and uploaded to the asset bucket) when
+EFS is not mounted, and merged into one report of each host.
+"""
+import argparse
+import collections
+import glob
+import json
+import os
+import runpy
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ENV_DIR = 'CHAINER_CFN_PROFILE_DIR'
+ENV_START = 'CHAINER_CFN_PROFILE_START'
+ENV_DURATION = 'CHAINER_CFN_PROFILE_DURATION'
+ENV_INTERVAL = 'CHAINER_CFN_PROFILE_INTERVAL'
+ENV_NVTX = 'CHAINER_CFN_PROFILE_NVTX'
+
+PROFILER_BIN = '/opt/chainer-cfn/bin/chainer-cfn-profile'
+CATEGORIES = ['compute', 'data', 'comm']
+# checked in this order; a sample is in the first category found anywhere
+# on the stack.
+CATEGORY_PATTERNS = [
+    ('comm', ['/chainermn/communicators/', '/chainermn/functions/', '/mpi4py/', 'nccl']),
+    ('data', ['/chainer/iterators/', '/chainer/dataset/', '/chainer/datasets/',
+              '/chainermn/datasets/', '/chainermn/iterators/', '/multiprocessing/',
+              '/PIL/', '/cv2/']),
+]
+MAX_DEPTH = 64
+TOP_STACKS = 100
+
+
+def classify(filenames):
+    for category, patterns in CATEGORY_PATTERNS:
+        for f in filenames:
+            if any(p in f for p in patterns):
+                return category
+    return 'compute'
+
+
+class Sampler(object):
+    """Samples the stack of the main thread of this process."""
+
+    def __init__(self, start, duration, interval, nvtx=False):
+        self.start_at = time.time() + start
+        self.end_at = self.start_at + duration
+        self.interval = interval
+        self.nvtx = nvtx
+        self.seconds = collections.Counter()
+        self.stacks = collections.Counter()
+        self.window = None
+        self.main = threading.main_thread().ident
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _cuda_profiler(self, start):
+        if not self.nvtx:
+            return
+        try:
+            from cupy.cuda import nvtx
+            from cupy.cuda import profiler
+        except ImportError:
+            return
+        if start:
+            profiler.start()
+            nvtx.RangePush('chainer-cfn-profile')
+        else:
+            nvtx.RangePop()
+            profiler.stop()
+
+    def _run(self):
+        if self.stopped.wait(max(self.start_at - time.time(), 0)):
+            return
+        self._cuda_profiler(True)
+        last = time.time()
+        self.window = [last, last]
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            frame = sys._current_frames().get(self.main)
+            if frame is not None:
+                self._record(frame, now - last)
+            last = now
+            self.window[1] = now
+            if now >= self.end_at:
+                break
+        self._cuda_profiler(False)
+
+    def _record(self, frame, elapsed):
+        names = []
+        files = []
+        while frame is not None and len(names) < MAX_DEPTH:
+            code = frame.f_code
+            files.append(code.co_filename)
+            names.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        self.seconds[classify(files)] += elapsed
+        self.stacks[';'.join(reversed(names))] += elapsed
+
+    def result(self):
+        return {
+            'host': socket.gethostname(),
+            'rank': int(os.environ.get('OMPI_COMM_WORLD_RANK', 0)),
+            'local_rank': int(os.environ.get('OMPI_COMM_WORLD_LOCAL_RANK', 0)),
+            'window': self.window,
+            'interval': self.interval,
+            'seconds': {c: self.seconds.get(c, 0.0) for c in CATEGORIES},
+            'stacks': dict(self.stacks.most_common(TOP_STACKS)),
+        }
+
+    def write(self, directory):
+        r = self.result()
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, '%s-rank%d' % (r['host'], r['rank']))
+        with open(name + '.json', 'w') as f:
+            json.dump(r, f, indent=2, sort_keys=True)
+        # for flamegraph.pl, in milliseconds
+        with open(name + '.collapsed', 'w') as f:
+            for stack, seconds in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, int(seconds * 1000)))
+
+
+def run_target(argv):
+    """Runs a Python script (or ``-m module``) under the sampler."""
+    sampler = Sampler(float(os.environ.get(ENV_START, 0)),
+                      float(os.environ.get(ENV_DURATION, 60)),
+                      float(os.environ.get(ENV_INTERVAL, 0.01)),
+                      os.environ.get(ENV_NVTX) == '1')
+    sampler.start()
+    try:
+        if argv[0] == '-m':
+            sys.argv = argv[1:]
+            runpy.run_module(argv[1], run_name='__main__', alter_sys=True)
+        else:
+            sys.argv = argv
+            sys.path[0] = os.path.dirname(os.path.abspath(argv[0]))
+            runpy.run_path(argv[0], run_name='__main__')
+    finally:
+        sampler.stop()
+        sampler.write(os.environ[ENV_DIR])
+
+
+#
+# Launcher side
+#
+def rank_env(directory, start, duration, interval, nvtx):
+    return {
+        ENV_DIR: directory,
+        ENV_START: str(start),
+        ENV_DURATION: str(duration),
+        ENV_INTERVAL: str(interval),
+        ENV_NVTX: '1' if nvtx else '0',
+    }
+
+
+def wrap_rank_command(argv, environ):
+    """Returns the command of a rank which runs ``argv`` under the profiler."""
+    if not os.path.basename(argv[0]).startswith('python'):
+        sys.stderr.write('chainer-cfn-profile: %s is not a Python command, not profiled\n' % argv[0])
+        return argv
+    options = []
+    rest = argv[1:]
+    while rest and rest[0].startswith('-') and rest[0] != '-m':
+        if rest[0] == '-c':
+            sys.stderr.write('chainer-cfn-profile: python -c is not profiled\n')
+            return argv
+        options.append(rest.pop(0))
+    if not rest:
+        return argv
+    cmd = [argv[0]] + options + [PROFILER_BIN, 'run', '--'] + rest
+    if environ.get(ENV_NVTX) == '1':
+        if shutil.which('nvprof') is None:
+            sys.stderr.write('chainer-cfn-profile: nvprof is not found, NVTX is not captured\n')
+        else:
+            cmd = ['nvprof', '--quiet', '--profile-from-start', 'off', '--export-profile',
+                   os.path.join(environ[ENV_DIR], '%h-rank%q{OMPI_COMM_WORLD_RANK}.nvvp')] + cmd
+    return cmd
+
+
+def collect(directory, hosts, parallel=32, timeout=600):
+    """Gathers the profiles written on the local disk of the hosts into ``directory/<host>/``."""
+    from chainer_cfn import cssh
+    directory = os.path.abspath(directory)
+    # no rank may have written on this node, e.g. a master without GPUs.
+    os.makedirs(directory, exist_ok=True)
+    work = tempfile.mkdtemp()
+    try:
+        shell = cssh.ClusterShell(hosts, parallel, timeout, out=sys.stderr)
+        shell.gather([directory], work)
+        for host in hosts:
+            gathered = os.path.join(work, host, directory.lstrip('/'))
+            for root, _, files in os.walk(gathered):
+                for name in files:
+                    path = os.path.join(root, name)
+                    target = os.path.join(directory, host, os.path.relpath(path, gathered))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.move(path, target)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def upload(directory, bucket, prefix):
+    from chainer_cfn import aws
+    s3 = aws.client('s3')
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            s3.upload_file(path, bucket, prefix + os.path.relpath(path, directory))
+
+
+#
+# Report
+#
+def load_profiles(directory):
+    profiles = {}
+    # written directly or gathered into <host>/; the same rank may be in both.
+    paths = (glob.glob(os.path.join(directory, '*-rank*.json')) +
+             glob.glob(os.path.join(directory, '*', '*-rank*.json')))
+    for path in paths:
+        with open(path) as f:
+            p = json.load(f)
+        profiles[p['rank']] = p
+    return [profiles[r] for r in sorted(profiles)]
+
+
+def merge(profiles):
+    hosts = collections.OrderedDict()
+    stacks = collections.Counter()
+    for p in profiles:
+        h = hosts.setdefault(p['host'], {'ranks': 0, 'seconds': collections.Counter()})
+        h['ranks'] += 1
+        h['seconds'].update(p['seconds'])
+        stacks.update(p['stacks'])
+    report = {'hosts': [], 'ranks': len(profiles),
+              'top_stacks': stacks.most_common(10)}
+    for host, h in hosts.items():
+        total = sum(h['seconds'].values())
+        report['hosts'].append({
+            'host': host,
+            'ranks': h['ranks'],
+            # mean of the ranks of the host
+            'seconds': {c: h['seconds'][c] / h['ranks'] for c in CATEGORIES},
+            'percent': {c: 100.0 * h['seconds'][c] / total if total else 0.0 for c in CATEGORIES},
+        })
+    return report
+
+
+def format_report(report):
+    lines = ['%-40s %5s %16s %16s %16s' % ('host', 'ranks', 'compute s (%)', 'data s (%)', 'comm s (%)')]
+    for h in report['hosts']:
+        lines.append('%-40s %5d %s' % (h['host'], h['ranks'], ' '.join(
+            '%9.1f (%4.1f)' % (h['seconds'][c], h['percent'][c]) for c in CATEGORIES)))
+    for c in ['data', 'comm']:
+        if len(report['hosts']) > 1:
+            worst = max(report['hosts'], key=lambda h: h['percent'][c])
+            lines.append('most %s bound: %s (%.1f%%)' % (c, worst['host'], worst['percent'][c]))
+    lines.append('top stacks (seconds over all ranks):')
+    for stack, seconds in report['top_stacks']:
+        lines.append('  %8.1f  %s' % (seconds, ' <- '.join(reversed(stack.split(';')[-4:]))))
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(directory):
+    profiles = load_profiles(directory)
+    if not profiles:
+        sys.stderr.write('no profiles in %s\n' % directory)
+        return None
+    report = merge(profiles)
+    with open(os.path.join(directory, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    text = format_report(report)
+    with open(os.path.join(directory, 'report.txt'), 'w') as f:
+        f.write(text)
+    return text
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['run']:
+        rest = argv[1:]
+        if rest[:1] == ['--']:
+            rest = rest[1:]
+        return run_target(rest)
+    parser = argparse.ArgumentParser(description='Merge per-rank profiles into a report.')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('report', help='merge the profiles in a directory')
+    p.add_argument('directory')
+    args = parser.parse_args(argv)
+    if args.command != 'report':
+        parser.print_help()
+        return 1
+    text = write_report(args.directory)
+    if text is None:
+        return 1
+    sys.stdout.write(text)
+    return 0
@@ -0,0 +1,303 @@
+"""Python environment shared by all the nodes.
+
+``chainer-cfn-pyenv build -r requirements.txt`` on the master builds a
+virtualenv once, packs it into an archive in the asset bucket and makes
+it the current environment of the cluster.  Wheels are cached on EFS
+when it is mounted, so rebuilding after a small change only builds what
+changed.  The environment is identified by the fingerprint of the
+requirements and the Python version; an unchanged environment is reused
+without building.
+
+Every node extracts the archive to the same path,
+``ENV_ROOT/<fingerprint>``, and ``ENV_ROOT/current`` points to the
+current one.  The agent pulls a new current environment in the
+background, and ``build`` (or ``distribute``) pulls it on all the nodes in
+parallel right away, so every rank runs the same versions::
+
+    source /var/lib/chainer-cfn/pyenv/current/bin/activate
+    chainer-mpirun python train.py
+"""
+import argparse
+import hashlib
+import logging
+import os
+import platform
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from chainer_cfn import config
+from chainer_cfn import task
+
+ENV_ROOT = '/var/lib/chainer-cfn/pyenv'
+S3_PREFIX = 'pyenv/'
+CURRENT_KEY = S3_PREFIX + 'current'
+
+logger = logging.getLogger('chainer-cfn-pyenv')
+
+
+def _s3():
+    # imported lazily so that fingerprint works without boto3.
+    from chainer_cfn import aws
+    return aws.client('s3')
+
+
+def normalize_requirements(text):
+    lines = set()
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line:
+            lines.add(' '.join(line.split()).lower())
+    return sorted(lines)
+
+
+def fingerprint(requirements, python=sys.executable, system_site_packages=True):
+    """Returns the id of the environment built from ``requirements``."""
+    version = subprocess.check_output(
+        [python, '-c', 'import sys; print(sys.version.split()[0])']).decode().strip()
+    h = hashlib.sha256()
+    for x in ['python ' + version, platform.machine(),
+              'system-site-packages %s' % system_site_packages] + normalize_requirements(requirements):
+        h.update(x.encode('utf-8') + b'\n')
+    return h.hexdigest()[:16]
+
+
+def env_dir(fp):
+    return os.path.join(ENV_ROOT, fp)
+
+
+def archive_key(fp):
+    return '%s%s.tar.gz' % (S3_PREFIX, fp)
+
+
+def local_current():
+    try:
+        return os.path.basename(os.readlink(os.path.join(ENV_ROOT, 'current')))
+    except OSError:
+        return None
+
+
+def set_local_current(fp):
+    link = os.path.join(ENV_ROOT, 'current')
+    tmp = '%s.%d' % (link, os.getpid())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(fp, tmp)
+    os.rename(tmp, link)
+
+
+def remote_current(bucket):
+    s3 = _s3()
+    try:
+        return s3.get_object(Bucket=bucket, Key=CURRENT_KEY)['Body'].read().decode().strip()
+    except s3.exceptions.NoSuchKey:
+        return None
+
+
+def _archive_exists(bucket, fp):
+    s3 = _s3()
+    try:
+        s3.head_object(Bucket=bucket, Key=archive_key(fp))
+        return True
+    except s3.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise
+
+
+#
+# Build (master)
+#
+def wheel_cache_dir(conf):
+    if conf.get('efs_mount_point'):
+        return os.path.join(conf['efs_mount_point'], '.pip-wheels')
+    return os.path.join(ENV_ROOT, 'wheels')
+
+
+def build(conf, requirements_path, python, system_site_packages, force):
+    with open(requirements_path) as f:
+        requirements = f.read()
+    fp = fingerprint(requirements, python, system_site_packages)
+    bucket = conf['asset_bucket']
+    if not force and _archive_exists(bucket, fp):
+        logger.info('environment %s is up to date', fp)
+    else:
+        _build_env(fp, requirements_path, python, system_site_packages, wheel_cache_dir(conf))
+        _upload(bucket, fp, requirements)
+    _s3().put_object(Bucket=bucket, Key=CURRENT_KEY, Body=fp.encode())
+    if not os.path.isdir(env_dir(fp)):
+        pull(bucket, fp)
+    set_local_current(fp)
+    logger.info('current environment is %s', env_dir(fp))
+    return fp
+
+
+def _build_env(fp, requirements_path, python, system_site_packages, wheels):
+    target = env_dir(fp)
+    os.makedirs(wheels, exist_ok=True)
+    # built at the final path because virtualenvs are not relocatable.
+    shutil.rmtree(target, ignore_errors=True)
+    venv = [python, '-m', 'venv', target]
+    if system_site_packages:
+        venv.insert(3, '--system-site-packages')
+    subprocess.check_call(venv)
+    pip = [os.path.join(target, 'bin', 'python'), '-m', 'pip']
+    subprocess.check_call(pip + ['install', '-q', '--upgrade', 'pip', 'wheel'])
+    # wheels already in the cache are not downloaded nor built again.
+    subprocess.check_call(pip + ['wheel', '-q', '-w', wheels, '--find-links', wheels,
+                                 '-r', requirements_path])
+    subprocess.check_call(pip + ['install', '-q', '--no-index', '--find-links', wheels,
+                                 '-r', requirements_path])
+
+
+def _upload(bucket, fp, requirements):
+    with tempfile.NamedTemporaryFile(suffix='.tar.gz', dir=ENV_ROOT) as f:
+        subprocess.check_call(['tar', '-C', ENV_ROOT, '-czf', f.name, fp])
+        logger.info('uploading %s (%d MiB)', archive_key(fp), os.path.getsize(f.name) >> 20)
+        s3 = _s3()
+        s3.upload_file(f.name, bucket, archive_key(fp))
+        s3.put_object(Bucket=bucket, Key='%s%s.txt' % (S3_PREFIX, fp), Body=requirements.encode())
+
+
+#
+# Pull (all nodes)
+#
+def pull(bucket, fp):
+    """Extracts the environment ``fp`` into ``ENV_ROOT`` unless it is there."""
+    target = env_dir(fp)
+    if os.path.isdir(target):
+        return False
+    os.makedirs(ENV_ROOT, exist_ok=True)
+    with tempfile.NamedTemporaryFile(suffix='.tar.gz', dir=ENV_ROOT) as f:
+        # download_file fetches parts of the archive concurrently.
+        _s3().download_file(bucket, archive_key(fp), f.name)
+        work = tempfile.mkdtemp(dir=ENV_ROOT)
+        try:
+            subprocess.check_call(['tar', '-C', work, '-xzf', f.name])
+            try:
+                os.rename(os.path.join(work, fp), target)
+            except OSError:
+                # pulled concurrently by the agent and by distribute.
+                if not os.path.isdir(target):
+                    raise
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+    logger.info('pulled environment %s', fp)
+    return True
+
+
+def sync(bucket):
+    """Pulls the current environment of the cluster and makes it current locally."""
+    fp = remote_current(bucket)
+    if fp is None or fp == local_current():
+        return fp
+    pull(bucket, fp)
+    set_local_current(fp)
+    return fp
+
+
+def distribute(parallel, timeout):
+    from chainer_cfn import cssh
+    from chainer_cfn import hostfile
+    path = os.path.join(hostfile.HOSTFILE_DIR, 'all')
+    hosts = cssh.read_hosts(path if os.path.exists(path) else hostfile.HOSTFILE_PATH)
+    if not hosts:
+        return 0
+    shell = cssh.ClusterShell(hosts, parallel, timeout)
+    return cssh.summarize(shell.run('python3 /opt/chainer-cfn/bin/chainer-cfn-pyenv pull'))
+
+
+def prepare_root():
+    """Creates ``ENV_ROOT`` writable by the chainer user, who builds and pulls."""
+    os.makedirs(ENV_ROOT, exist_ok=True)
+    user = pwd.getpwnam('chainer')
+    os.chown(ENV_ROOT, user.pw_uid, user.pw_gid)
+
+
+class PyenvSyncTask(task.Task):
+    """Pulls the current environment of the cluster when it changes.
+
+    The download runs in a thread so that it does not delay other tasks.
+    """
+
+    name = 'pyenv'
+    period = 60
+
+    def __init__(self, conf):
+        super(PyenvSyncTask, self).__init__(conf)
+        self.thread = None
+
+    def start(self):
+        prepare_root()
+
+    def run(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._sync)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _sync(self):
+        try:
+            sync(self.conf['asset_bucket'])
+        except Exception:
+            logger.exception('failed to pull the environment')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Python environment shared by all the nodes')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('build', help='build (or reuse) the environment and make it current')
+    p.add_argument('-r', '--requirement', required=True)
+    p.add_argument('--python', default='python3')
+    p.add_argument('--no-system-site-packages', action='store_true',
+                   help='do not inherit Chainer, CuPy and others installed in the AMI')
+    p.add_argument('--force', action='store_true', help='build even if the archive exists')
+    p.add_argument('--no-distribute', action='store_true',
+                   help='let the agent of each node pull the environment in the background')
+    p.add_argument('-p', '--parallel', type=int, default=32)
+    p.add_argument('-t', '--timeout', type=float, default=1800)
+    p = sub.add_parser('fingerprint', help='show the fingerprint of requirements')
+    p.add_argument('-r', '--requirement', required=True)
+    p.add_argument('--python', default='python3')
+    p.add_argument('--no-system-site-packages', action='store_true')
+    p = sub.add_parser('pull', help='pull an environment to this node (default: make the current one current)')
+    p.add_argument('fingerprint', nargs='?', help='default: the current environment of the cluster')
+    p = sub.add_parser('distribute', help='pull the current environment on all the nodes now')
+    p.add_argument('-p', '--parallel', type=int, default=32)
+    p.add_argument('-t', '--timeout', type=float, default=1800)
+    sub.add_parser('current', help='show the current environment')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.command == 'fingerprint':
+        with open(args.requirement) as f:
+            print(fingerprint(f.read(), args.python, not args.no_system_site_packages))
+        return 0
+    if args.command is None:
+        parser.print_help()
+        return 1
+    conf = config.load()
+    bucket = conf['asset_bucket']
+    if args.command == 'build':
+        build(conf, args.requirement, args.python, not args.no_system_site_packages, args.force)
+        if args.no_distribute:
+            return 0
+        return distribute(args.parallel, args.timeout)
+    if args.command == 'pull':
+        if args.fingerprint:
+            pull(bucket, args.fingerprint)
+        else:
+            sync(bucket)
+        return 0
+    fp = remote_current(bucket)
+    if fp is None:
+        sys.stderr.write('no environment has been built\n')
+        return 1
+    if args.command == 'distribute':
+        return distribute(args.parallel, args.timeout)
+    print(env_dir(fp))
+    return 0
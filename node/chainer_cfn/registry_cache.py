@@ -0,0 +1,188 @@
+"""Pull-through container registry cache on the master.
+
+The master runs ``registry:2`` in proxy mode in front of the upstream
+registry, storing layers on the local disk or on EFS.  Every node uses it
+as a registry mirror of the docker daemon, so an image is downloaded from
+the upstream only once for the whole cluster.  The mirror follows the
+master when it is replaced.
+
+``chainer-cfn-registry-cache prepull IMAGE...`` warms the cache on the
+master and then pulls the images on all the nodes in parallel.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import time
+import urllib.request
+
+from chainer_cfn import config
+from chainer_cfn import task
+
+REGISTRY_IMAGE = 'registry:2'
+CONTAINER_NAME = 'chainer-cfn-registry-cache'
+PORT = 5000
+DAEMON_JSON_PATH = '/etc/docker/daemon.json'
+LOCAL_STORAGE = '/var/lib/chainer-cfn/registry-cache'
+
+logger = logging.getLogger('chainer-cfn-registry-cache')
+
+
+def _enabled(conf):
+    return conf.get('registry_cache', {}).get('enabled') == 'True'
+
+
+def storage_dir(conf):
+    rc = conf['registry_cache']
+    if rc['storage'] == 'EFS' and conf.get('efs_mount_point'):
+        return os.path.join(conf['efs_mount_point'], '.registry-cache')
+    return LOCAL_STORAGE
+
+
+#
+# Cache (master)
+#
+def serve(upstream, storage, port=PORT, name=CONTAINER_NAME):
+    """Starts the pull-through cache container unless it is running."""
+    running = subprocess.check_output(
+        ['docker', 'ps', '-q', '--filter', 'name=^/%s$' % name]).strip()
+    if running:
+        return
+    subprocess.call(['docker', 'rm', '-f', name], stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+    os.makedirs(storage, exist_ok=True)
+    subprocess.check_call([
+        'docker', 'run', '-d', '--restart=always', '--name', name,
+        '-p', '%d:5000' % port,
+        '-v', '%s:/var/lib/registry' % storage,
+        '-e', 'REGISTRY_PROXY_REMOTEURL=%s' % upstream,
+        REGISTRY_IMAGE])
+
+
+def wait_until_ready(url, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url + '/v2/', timeout=5):
+                return True
+        except Exception:
+            if time.time() > deadline:
+                return False
+            time.sleep(2)
+
+
+#
+# Mirror (all nodes)
+#
+def configure_mirror(mirror, path=DAEMON_JSON_PATH):
+    """Sets the registry mirror of the docker daemon.  Returns whether it changed."""
+    try:
+        with open(path) as f:
+            daemon = json.load(f)
+    except IOError:
+        daemon = {}
+    if daemon.get('registry-mirrors') == [mirror]:
+        return False
+    host = mirror.split('://', 1)[1]
+    daemon['registry-mirrors'] = [mirror]
+    daemon['insecure-registries'] = sorted(
+        set(r for r in daemon.get('insecure-registries', [])
+            if not r.endswith(':%d' % PORT)) | {host})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(daemon, f, indent=2, sort_keys=True)
+    return True
+
+
+class RegistryMirrorTask(task.Task):
+    """Points the docker daemon at the cache on the (current) master."""
+
+    name = 'registry_mirror'
+    period = 300
+
+    def enabled(self):
+        return _enabled(self.conf)
+
+    def run(self):
+        self.update(restart=False)
+
+    def update(self, restart):
+        from chainer_cfn import preflight
+        address = preflight.master_address(self.conf['cluster_name'])
+        if address is None:
+            return
+        if configure_mirror('http://%s:%d' % (address, PORT)):
+            logger.info('registry mirror is now %s', address)
+            if restart:
+                subprocess.check_call(['service', 'docker', 'restart'])
+            else:
+                # reload without stopping running containers.
+                subprocess.check_call(['pkill', '-HUP', '-x', 'dockerd'])
+
+
+def setup(conf, master_timeout):
+    if not _enabled(conf):
+        return 0
+    # so that jobs and prepull can run containers as chainer.
+    subprocess.check_call(['usermod', '-aG', 'docker', 'chainer'])
+    rc = conf['registry_cache']
+    if conf['role'] == 'Master':
+        serve(rc['upstream'], storage_dir(conf))
+        if not wait_until_ready('http://127.0.0.1:%d' % PORT, 60):
+            logger.error('registry cache did not start')
+            return 1
+    else:
+        from chainer_cfn import preflight
+        # the mirror only needs the address of the master; docker falls
+        # back to the upstream while the cache is not up yet.
+        deadline = time.time() + master_timeout
+        while preflight.master_address(conf['cluster_name']) is None and time.time() < deadline:
+            time.sleep(10)
+    RegistryMirrorTask(conf).update(restart=True)
+    if conf['role'] == 'Master':
+        # the restart stopped the cache; it comes back with --restart=always.
+        wait_until_ready('http://127.0.0.1:%d' % PORT, 60)
+    return 0
+
+
+def prepull(images, args):
+    from chainer_cfn import cssh
+    for image in images:
+        logger.info('warming the cache with %s', image)
+        subprocess.check_call(['docker', 'pull', image])
+    args.hostfile = args.group = args.hosts = args.exclude = None
+    hosts = cssh.select_hosts(args)
+    if not hosts:
+        return 0
+    shell = cssh.ClusterShell(hosts, args.parallel, args.timeout)
+    results = shell.run(' && '.join('docker pull %s' % i for i in images))
+    return cssh.summarize(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='cluster local container registry cache')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('setup', help='start the cache on the master and configure the mirror')
+    p.add_argument('--master-timeout', type=float, default=900)
+    p = sub.add_parser('serve', help='start the cache container with explicit settings')
+    p.add_argument('--upstream', required=True)
+    p.add_argument('--storage', required=True)
+    p.add_argument('--port', type=int, default=PORT)
+    p.add_argument('--name', default=CONTAINER_NAME)
+    p = sub.add_parser('prepull', help='pull images on all the nodes through the cache')
+    p.add_argument('-p', '--parallel', type=int, default=32)
+    p.add_argument('-t', '--timeout', type=float, default=1800)
+    p.add_argument('images', nargs='+')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.command == 'setup':
+        return setup(config.load(), args.master_timeout)
+    if args.command == 'serve':
+        serve(args.upstream, args.storage, args.port, args.name)
+        return 0 if wait_until_ready('http://127.0.0.1:%d' % args.port, 60) else 1
+    if args.command == 'prepull':
+        return prepull(args.images, args)
+    parser.print_help()
+    return 1
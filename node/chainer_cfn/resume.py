@@ -0,0 +1,123 @@
+"""Refreshes a node which was stopped and started again.
+
+cfn-init runs only on the first boot.  When a paused cluster is resumed
+(see ``chainer_cfn.stack``), or a node is rebooted, the agent finds a new
+boot id and refreshes only what does not survive a stop before it starts
+the periodic tasks:
+
+- the FS-Cache device (the instance store is wiped) and the EFS mount
+- the cluster ssh key, the hostfiles and the host tuning
+- the link to the kernel cache
+
+Then the time from boot to ready is posted as ``ResumeDuration`` and
+written to ``s3://<AssetBucket>/cluster-state/resumed/<instance id>.json``,
+which ``chainer-cfn-stack resume`` waits for.
+"""
+import json
+import logging
+import os
+import subprocess
+import time
+
+from chainer_cfn import fscache
+from chainer_cfn import kernel_cache
+from chainer_cfn import tune
+
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+LAST_BOOT_ID_PATH = '/var/lib/chainer-cfn/boot_id'
+STATE_PREFIX = 'cluster-state/'
+RESUMED_PREFIX = STATE_PREFIX + 'resumed/'
+
+logger = logging.getLogger('chainer-cfn-agent')
+
+
+def boot_id():
+    with open(BOOT_ID_PATH) as f:
+        return f.read().strip()
+
+
+def is_restarted():
+    """Returns whether this boot is not the first one, and records the boot."""
+    current = boot_id()
+    try:
+        with open(LAST_BOOT_ID_PATH) as f:
+            last = f.read().strip()
+    except IOError:
+        last = None
+    os.makedirs(os.path.dirname(LAST_BOOT_ID_PATH), exist_ok=True)
+    with open(LAST_BOOT_ID_PATH, 'w') as f:
+        f.write(current + '\n')
+    return last is not None and last != current
+
+
+def mount_efs(conf):
+    mount_point = conf.get('efs_mount_point')
+    if not mount_point or os.path.ismount(mount_point):
+        return
+    efs = conf['efs_mount']
+    os.makedirs(mount_point, exist_ok=True)
+    subprocess.check_call(['mount', '-t', 'nfs4', '-o', efs['options'], efs['source'], mount_point])
+    logger.info('mounted %s on %s', efs['source'], mount_point)
+
+
+def refresh(conf):
+    """Restores the state of the node lost by a stop.  Returns the failed steps."""
+    # imported here to avoid an import cycle with the agent
+    from chainer_cfn import agent
+
+    steps = [
+        ('fscache', lambda: fscache.setup(conf)),
+        ('efs', lambda: mount_efs(conf)),
+        ('kernel_cache', lambda: kernel_cache.setup(conf)),
+        ('tuning', lambda: tune.write_report(tune.tune(conf['tuning']))),
+    ]
+    classes = {cls.name: cls for cls in agent.TASKS}
+    for name in ['cluster_key', 'hostfile']:
+        t = classes[name](conf)
+        if t.enabled():
+            steps.append((name, t.run))
+    failed = []
+    for name, step in steps:
+        try:
+            step()
+        except Exception:
+            logger.exception('failed to refresh %s', name)
+            failed.append(name)
+    return failed
+
+
+def report(conf, failed):
+    from chainer_cfn import agent
+    from chainer_cfn import aws
+    from chainer_cfn import cloudwatch
+    from chainer_cfn import imds
+    with open('/proc/uptime') as f:
+        uptime = float(f.read().split()[0])
+    dims = cloudwatch.dimensions(
+        ChainerClusterName=conf['cluster_name'],
+        ChainerClusterRole=conf['role'],
+        InstanceId=imds.instance_id())
+    cloudwatch.put_metric_data(agent.NAMESPACE, cloudwatch.metric_data(
+        [('ResumeDuration', uptime, 'Seconds')], dims))
+    aws.client('s3').put_object(
+        Bucket=conf['asset_bucket'],
+        Key='%s%s.json' % (RESUMED_PREFIX, imds.instance_id()),
+        Body=json.dumps({
+            'boot_id': boot_id(),
+            'ready_at': time.time(),
+            'seconds_since_boot': uptime,
+            'failed': failed,
+        }).encode())
+    logger.info('node refreshed %ds after boot%s', uptime,
+                ', failed: %s' % ', '.join(failed) if failed else '')
+
+
+def on_boot(conf):
+    """Refreshes the node if it was restarted; called before the agent starts."""
+    if not is_restarted():
+        return
+    failed = refresh(conf)
+    try:
+        report(conf, failed)
+    except Exception:
+        logger.exception('failed to report the refresh')
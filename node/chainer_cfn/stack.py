@@ -0,0 +1,242 @@
+"""Pauses and resumes a cluster without deleting the stack.
+
+Run from anywhere with AWS credentials, e.g. from this repository::
+
+    python3 node/bin/chainer-cfn-stack pause my-cluster
+    python3 node/bin/chainer-cfn-stack resume my-cluster
+
+``pause`` suspends all the processes of the worker AutoScalingGroups, so
+that they neither replace stopped instances nor launch new ones, and stops
+the workers and the master.  The instance ids are written to
+``s3://<AssetBucket>/cluster-state/paused.json``.  The VPC, EFS, the
+buckets and the root volumes are kept; only the instances stop being
+charged.
+If ``pause`` fails before all the instances have stopped, ``status``
+shows ``pausing``; running ``pause`` again stops the rest.
+
+``resume`` starts the instances, resumes the AutoScalingGroups, and waits
+until every node has refreshed its mounts, keys and hostfiles (see
+``chainer_cfn.resume``).  The time of each phase is printed together with
+the time CloudFormation took to create the stack.
+
+Don't update the stack while it is paused.  The public DNS name of the
+master changes on resume; ``status`` shows the current one.
+"""
+import argparse
+import json
+import sys
+import time
+
+import boto3
+
+from chainer_cfn import resume
+
+PAUSED_KEY = resume.STATE_PREFIX + 'paused.json'
+
+_session = None
+
+
+def _client(service):
+    return _session.client(service)
+
+
+def stack_resources(stack_name):
+    """Returns the master instance id, the worker ASG names and the asset bucket."""
+    master = None
+    asgs = []
+    bucket = None
+    paginator = _client('cloudformation').get_paginator('list_stack_resources')
+    for page in paginator.paginate(StackName=stack_name):
+        for r in page['StackResourceSummaries']:
+            if r['ResourceStatus'].startswith('DELETE'):
+                continue
+            if r['LogicalResourceId'] == 'ClusterMaster':
+                master = r['PhysicalResourceId']
+            elif r['LogicalResourceId'] == 'AssetBucket':
+                bucket = r['PhysicalResourceId']
+            elif r['ResourceType'] == 'AWS::AutoScaling::AutoScalingGroup':
+                asgs.append(r['PhysicalResourceId'])
+    return master, sorted(asgs), bucket
+
+
+def asg_instances(asgs):
+    if not asgs:
+        return {}
+    res = _client('autoscaling').describe_auto_scaling_groups(AutoScalingGroupNames=asgs)
+    return {g['AutoScalingGroupName']: sorted(i['InstanceId'] for i in g['Instances'])
+            for g in res['AutoScalingGroups']}
+
+
+def read_state(bucket):
+    s3 = _client('s3')
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=PAUSED_KEY)['Body'].read().decode())
+    except s3.exceptions.NoSuchKey:
+        return None
+
+
+def write_state(bucket, state):
+    _client('s3').put_object(Bucket=bucket, Key=PAUSED_KEY, Body=json.dumps(state).encode())
+
+
+def _log(message, *args):
+    sys.stderr.write('[%s] %s\n' % (time.strftime('%H:%M:%S'), message % args))
+
+
+def pause(stack_name):
+    master, asgs, bucket = stack_resources(stack_name)
+    autoscaling = _client('autoscaling')
+    state = read_state(bucket)
+    if state is None:
+        for name in asgs:
+            # all processes: no launch, no termination, no health check
+            autoscaling.suspend_processes(AutoScalingGroupName=name)
+        workers = asg_instances(asgs)
+        # recorded before stopping so that an interrupted pause can be
+        # finished or resumed.
+        state = {'paused_at': time.time(), 'master': master, 'asgs': workers, 'stopped_at': None}
+        write_state(bucket, state)
+    else:
+        # a previous pause may have failed before the instances stopped;
+        # stopping them again is harmless.
+        _log('%s is already paused, making sure its instances are stopped', stack_name)
+        for name in state['asgs']:
+            autoscaling.suspend_processes(AutoScalingGroupName=name)
+    ids = [state['master']] + [i for g in state['asgs'].values() for i in g]
+    _log('stopping %d instances', len(ids))
+    ec2 = _client('ec2')
+    ec2.stop_instances(InstanceIds=ids)
+    ec2.get_waiter('instance_stopped').wait(InstanceIds=ids)
+    if not state.get('stopped_at'):
+        state['stopped_at'] = time.time()
+        write_state(bucket, state)
+    _log('%s is paused', stack_name)
+    return 0
+
+
+def wait_ready(bucket, ids, since, timeout, interval=5):
+    """Returns ``{instance id: report}`` of the nodes refreshed after ``since``."""
+    s3 = _client('s3')
+    ready = {}
+    deadline = time.time() + timeout
+    while len(ready) < len(ids) and time.time() < deadline:
+        for i in ids:
+            if i in ready:
+                continue
+            try:
+                body = s3.get_object(Bucket=bucket, Key='%s%s.json' % (resume.RESUMED_PREFIX, i))['Body']
+            except s3.exceptions.NoSuchKey:
+                continue
+            r = json.loads(body.read().decode())
+            if r['ready_at'] >= since:
+                ready[i] = r
+        if len(ready) < len(ids):
+            time.sleep(interval)
+    return ready
+
+
+def create_duration(stack_name):
+    """Returns seconds CloudFormation took to create the stack, or ``None``."""
+    cfn = _client('cloudformation')
+    created = None
+    completed = None
+    for page in cfn.get_paginator('describe_stack_events').paginate(StackName=stack_name):
+        for e in page['StackEvents']:
+            if e['LogicalResourceId'] != stack_name or e['ResourceType'] != 'AWS::CloudFormation::Stack':
+                continue
+            if e['ResourceStatus'] == 'CREATE_IN_PROGRESS':
+                created = e['Timestamp']
+            elif e['ResourceStatus'] == 'CREATE_COMPLETE':
+                completed = e['Timestamp']
+    if created is None or completed is None:
+        return None
+    return (completed - created).total_seconds()
+
+
+def resume_stack(stack_name, timeout):
+    _, _, bucket = stack_resources(stack_name)
+    state = read_state(bucket)
+    if state is None:
+        _log('%s is not paused', stack_name)
+        return 1
+    ids = [state['master']] + [i for g in state['asgs'].values() for i in g]
+    ec2 = _client('ec2')
+    start = time.time()
+    ec2.start_instances(InstanceIds=ids)
+    ec2.get_waiter('instance_running').wait(InstanceIds=ids)
+    running = time.time()
+    _log('%d instances are running', len(ids))
+    autoscaling = _client('autoscaling')
+    for name in state['asgs']:
+        autoscaling.resume_processes(AutoScalingGroupName=name)
+    ready = wait_ready(bucket, ids, start, timeout)
+    end = time.time()
+    _client('s3').delete_object(Bucket=bucket, Key=PAUSED_KEY)
+
+    timing = {
+        'start_instances': running - start,
+        'refresh': end - running,
+        'total': end - start,
+        'create_stack': create_duration(stack_name),
+        'slowest_node_since_boot': max([r['seconds_since_boot'] for r in ready.values()] or [0]),
+    }
+    print(json.dumps(timing, indent=2, sort_keys=True))
+    if timing['create_stack']:
+        _log('resumed in %ds (create-stack took %ds, %.1fx)', timing['total'],
+             timing['create_stack'], timing['create_stack'] / timing['total'])
+    failed = sorted(i for i, r in ready.items() if r['failed'])
+    missing = sorted(set(ids) - set(ready))
+    for i in failed:
+        _log('%s failed to refresh %s; run chainer-cfn-agent refresh on it', i, ', '.join(ready[i]['failed']))
+    for i in missing:
+        _log('%s did not report within %ds', i, timeout)
+    return 1 if failed or missing else 0
+
+
+def status(stack_name):
+    master, asgs, bucket = stack_resources(stack_name)
+    state = read_state(bucket)
+    instances = [master] + [i for g in asg_instances(asgs).values() for i in g]
+    res = _client('ec2').describe_instances(InstanceIds=instances)
+    counts = {}
+    dns = None
+    for r in res['Reservations']:
+        for i in r['Instances']:
+            counts[i['State']['Name']] = counts.get(i['State']['Name'], 0) + 1
+            if i['InstanceId'] == master:
+                dns = i.get('PublicDnsName')
+    if state is None:
+        print('active')
+    elif state.get('stopped_at', True):
+        print('paused')
+    else:
+        # e.g. pause was interrupted; running it again stops the rest.
+        print('pausing')
+    print('instances: %s' % ', '.join('%d %s' % (n, s) for s, n in sorted(counts.items())))
+    print('master: %s' % (dns or '-'))
+    return 0
+
+
+def main(argv=None):
+    global _session
+    parser = argparse.ArgumentParser(description='Pause and resume a cluster')
+    parser.add_argument('--region', help='default: the region of the AWS CLI configuration')
+    parser.add_argument('--profile', help='AWS CLI profile')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('pause', help='stop all the nodes')
+    p.add_argument('stack_name')
+    p = sub.add_parser('resume', help='start all the nodes and wait until they are ready')
+    p.add_argument('stack_name')
+    p.add_argument('--timeout', type=float, default=900, help='seconds to wait for the nodes')
+    p = sub.add_parser('status', help='show whether the cluster is paused')
+    p.add_argument('stack_name')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    _session = boto3.session.Session(region_name=args.region, profile_name=args.profile)
+    if args.command == 'pause':
+        return pause(args.stack_name)
+    if args.command == 'resume':
+        return resume_stack(args.stack_name, args.timeout)
+    return status(args.stack_name)
@@ -0,0 +1,286 @@
+"""Straggler detection across hosts.
+
+Training processes report their step time and data wait time with
+:class:`StepReporter` (or the :class:`StragglerReport` Chainer extension).
+The reporter only accumulates numbers per iteration and sends a summary to
+the node agent over local UDP every few seconds, so it is cheap enough to
+be called every iteration.
+
+The agent on each node merges the summaries of its ranks and forwards them
+to the agent on the master.  The master publishes per-host step time and
+the cross-host spread to CloudWatch and, when the spread exceeds the
+threshold, puts the straggler alarm into ALARM naming the slowest host.
+"""
+import json
+import logging
+import os
+import socket
+import statistics
+import threading
+import time
+
+from chainer_cfn import task
+
+# Modules using boto3 are imported lazily in the agent side code, so that
+# training scripts can import this module without boto3.
+
+NAMESPACE = 'ChainerCluster/Training'
+REPORT_PORT = 18701
+FORWARD_PORT = 18702
+STATUS_PATH = '/var/run/chainer-cfn/straggler.json'
+
+logger = logging.getLogger('chainer-cfn-agent')
+
+
+class StepReporter(object):
+    """Reports step time and data wait time of a rank to the local agent.
+
+    Args:
+        rank (int): Rank of this process.  Defaults to the MPI world rank.
+        interval (float): Seconds between summaries sent to the agent.
+    """
+
+    def __init__(self, rank=None, interval=5.0, port=REPORT_PORT):
+        if rank is None:
+            rank = int(os.environ.get('OMPI_COMM_WORLD_RANK', 0))
+        self.rank = rank
+        self.interval = interval
+        self.address = ('127.0.0.1', port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self._reset(time.time())
+
+    def _reset(self, now):
+        self.count = 0
+        self.step_sum = 0.0
+        self.step_max = 0.0
+        self.wait_sum = 0.0
+        self.next_flush = now + self.interval
+
+    def report(self, step_time, data_wait=0.0):
+        self.count += 1
+        self.step_sum += step_time
+        self.wait_sum += data_wait
+        if step_time > self.step_max:
+            self.step_max = step_time
+        now = time.time()
+        if now >= self.next_flush:
+            self.flush(now)
+
+    def flush(self, now=None):
+        if self.count:
+            message = json.dumps({
+                'rank': self.rank,
+                'count': self.count,
+                'step_sum': self.step_sum,
+                'step_max': self.step_max,
+                'wait_sum': self.wait_sum,
+            }).encode('utf-8')
+            try:
+                self.sock.sendto(message, self.address)
+            except OSError:
+                # the agent is not running; training must not be affected.
+                pass
+        self._reset(now or time.time())
+
+
+try:
+    import chainer
+except ImportError:
+    chainer = None
+
+if chainer is not None:
+    class StragglerReport(chainer.training.Extension):
+        """Chainer extension which reports step time of every iteration.
+
+        Data wait time is the time spent in ``next()`` of the ``main``
+        iterator of the updater.
+
+        Args:
+            comm: ChainerMN communicator.  Its rank is used if given.
+        """
+
+        trigger = 1, 'iteration'
+        priority = chainer.training.PRIORITY_WRITER
+
+        def __init__(self, comm=None, interval=5.0):
+            rank = comm.rank if comm is not None else None
+            self.reporter = StepReporter(rank=rank, interval=interval)
+            self.last = None
+            self.wait = 0.0
+
+        def initialize(self, trainer):
+            iterator = trainer.updater.get_iterator('main')
+            original_next = iterator.next
+
+            def timed_next():
+                start = time.time()
+                try:
+                    return original_next()
+                finally:
+                    self.wait += time.time() - start
+            iterator.next = timed_next
+            self.last = time.time()
+
+        def __call__(self, trainer):
+            now = time.time()
+            self.reporter.report(now - self.last, self.wait)
+            self.last = now
+            self.wait = 0.0
+
+        def finalize(self):
+            self.reporter.flush()
+
+
+def spread(host_step_times):
+    """Returns ``(spread_percent, slowest_host)``.
+
+    The spread is how much slower the slowest host is than the median host.
+    """
+    median = statistics.median(host_step_times.values())
+    slowest = max(host_step_times, key=host_step_times.get)
+    if median <= 0:
+        return 0.0, slowest
+    return 100.0 * (host_step_times[slowest] - median) / median, slowest
+
+
+class _Summaries(object):
+    """Thread-safe accumulator of summaries keyed by host."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def add(self, host, summary):
+        with self.lock:
+            s = self.data.setdefault(host, {'count': 0, 'step_sum': 0.0, 'step_max': 0.0,
+                                            'wait_sum': 0.0, 'ranks': set()})
+            s['count'] += summary['count']
+            s['step_sum'] += summary['step_sum']
+            s['wait_sum'] += summary['wait_sum']
+            s['step_max'] = max(s['step_max'], summary['step_max'])
+            s['ranks'].update(summary.get('ranks', [summary.get('rank')]))
+
+    def pop(self):
+        with self.lock:
+            data, self.data = self.data, {}
+        return data
+
+
+class StragglerTask(task.Task):
+    """Collects step time reports of local ranks and detects stragglers on the master."""
+
+    name = 'straggler'
+    period = 60
+
+    def __init__(self, conf):
+        super(StragglerTask, self).__init__(conf)
+        self.local = _Summaries()
+        self.hosts = _Summaries()
+        self.latest = {}
+        self.master = None
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', REPORT_PORT))
+        threading.Thread(target=self._receive_local, args=(sock,), daemon=True).start()
+        if self.conf['role'] == 'Master':
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(('0.0.0.0', FORWARD_PORT))
+            server.listen(64)
+            threading.Thread(target=self._receive_forwarded, args=(server,), daemon=True).start()
+
+    def _receive_local(self, sock):
+        while True:
+            data, _ = sock.recvfrom(65536)
+            try:
+                self.local.add(None, json.loads(data.decode('utf-8')))
+            except (ValueError, KeyError):
+                continue
+
+    def _receive_forwarded(self, server):
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                chunks = []
+                while True:
+                    b = conn.recv(65536)
+                    if not b:
+                        break
+                    chunks.append(b)
+            try:
+                message = json.loads(b''.join(chunks).decode('utf-8'))
+                self.hosts.add(message['host'], message)
+            except (ValueError, KeyError):
+                continue
+
+    def run(self):
+        from chainer_cfn import imds
+        summary = self.local.pop().get(None)
+        if summary is not None:
+            message = dict(summary, host=imds.local_hostname(), ranks=sorted(summary['ranks']))
+            if self.conf['role'] == 'Master':
+                self.hosts.add(message['host'], message)
+            else:
+                self._forward(message)
+        if self.conf['role'] == 'Master':
+            # Workers forward asynchronously with the same period, so keep
+            # the latest summary of each host and drop hosts gone quiet.
+            now = time.time()
+            for host, s in self.hosts.pop().items():
+                self.latest[host] = (now, s)
+            for host, (received, _) in list(self.latest.items()):
+                if now - received > 2 * self.period:
+                    del self.latest[host]
+            self._detect({h: s for h, (_, s) in self.latest.items()})
+
+    def _forward(self, message):
+        from chainer_cfn import preflight
+        if self.master is None:
+            self.master = preflight.master_address(self.conf['cluster_name'])
+            if self.master is None:
+                return
+        try:
+            with socket.create_connection((self.master, FORWARD_PORT), timeout=5) as sock:
+                sock.sendall(json.dumps(message).encode('utf-8'))
+        except (OSError, socket.timeout):
+            # the master might have been replaced; look it up again next time.
+            self.master = None
+            raise
+
+    def _detect(self, hosts):
+        from chainer_cfn import aws
+        from chainer_cfn import cloudwatch
+        if not hosts:
+            return
+        cluster = self.conf['cluster_name']
+        step = {h: s['step_sum'] / s['count'] for h, s in hosts.items() if s['count']}
+        data = []
+        for h, s in sorted(hosts.items()):
+            dims = cloudwatch.dimensions(ChainerClusterName=cluster, Host=h)
+            data.append({'MetricName': 'StepTime', 'Dimensions': dims,
+                         'Value': step[h], 'Unit': 'Seconds'})
+            data.append({'MetricName': 'DataWaitTime', 'Dimensions': dims,
+                         'Value': s['wait_sum'] / s['count'], 'Unit': 'Seconds'})
+        percent, slowest = spread(step)
+        data.append({'MetricName': 'StepTimeSpread',
+                     'Dimensions': cloudwatch.dimensions(ChainerClusterName=cluster),
+                     'Value': percent, 'Unit': 'Percent'})
+        cloudwatch.put_metric_data(NAMESPACE, data)
+
+        status = {'time': time.time(), 'spread_percent': percent, 'slowest_host': slowest,
+                  'step_time': step}
+        os.makedirs(os.path.dirname(STATUS_PATH), exist_ok=True)
+        with open(STATUS_PATH, 'w') as f:
+            json.dump(status, f, indent=2, sort_keys=True)
+
+        threshold = float(self.conf['straggler']['threshold_percent'])
+        if len(step) > 1 and percent > threshold:
+            reason = '%s is %.1f%% slower than the median host (step time %.3fs, ranks %s)' % (
+                slowest, percent, step[slowest], sorted(hosts[slowest]['ranks']))
+            logger.warning('straggler detected: %s', reason)
+            aws.client('cloudwatch').set_alarm_state(
+                AlarmName=self.conf['straggler']['alarm_name'],
+                StateValue='ALARM',
+                StateReason=reason)
@@ -0,0 +1,22 @@
+class Task(object):
+    """A periodic job run by the node agent.
+
+    ``period`` is the default interval in seconds, which can be overridden
+    per task in the agent configuration.
+    """
+
+    name = None
+    period = 60
+
+    def __init__(self, conf):
+        self.conf = conf
+
+    def enabled(self):
+        return True
+
+    def start(self):
+        """Called once before the first run, e.g. to start listener threads."""
+        pass
+
+    def run(self):
+        raise NotImplementedError
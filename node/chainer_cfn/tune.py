@@ -0,0 +1,278 @@
+"""Host OS performance tuning.
+
+Settings come from the tuning profile of the instance type in
+``/etc/chainer-cfn/node.json``.  Each setting is read first and only
+applied when it differs, then read again to verify it.  What changed is
+printed and written to ``REPORT_PATH``.
+
+This runs from cfn-init and from the agent periodically, so the settings
+which don't survive a reboot (MTU, GPU clocks, IRQ affinity ...) are
+restored after the node is stopped and started.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import subprocess
+
+# Modules using boto3 must not be imported, because this runs from
+# cfn-init before boto3 is installed.
+from chainer_cfn import config
+from chainer_cfn import task
+from chainer_cfn import util
+
+REPORT_PATH = '/var/log/chainer-cfn/tuning.json'
+SYSCTL_PATH = '/etc/sysctl.d/60-chainer-cfn.conf'
+
+CPU_GOVERNOR = 'performance'
+TRANSPARENT_HUGEPAGE = 'madvise'
+TCP_CONGESTION_CONTROL = 'cubic'
+
+logger = logging.getLogger('chainer-cfn-tune')
+
+
+class Setting(object):
+    """A tunable whose current value can be read and changed."""
+
+    def __init__(self, name, desired, read, apply):
+        self.name = name
+        self.desired = desired
+        self.read = read
+        self.apply = apply
+
+    def tune(self):
+        before = self.read()
+        if before is None:
+            return {'desired': self.desired, 'status': 'unsupported'}
+        changed = before != self.desired
+        if changed:
+            self.apply(self.desired)
+        after = self.read()
+        return {
+            'desired': self.desired,
+            'before': before,
+            'after': after,
+            'changed': changed,
+            'status': 'ok' if after == self.desired else 'failed',
+        }
+
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def _write_file(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def _nvidia_smi(*args):
+    return subprocess.check_output(('nvidia-smi',) + args).decode('utf-8').strip()
+
+
+#
+# GPU
+#
+def gpu_settings(profile):
+    try:
+        _nvidia_smi('-L')
+    except (OSError, subprocess.CalledProcessError):
+        return []
+
+    def read_persistence():
+        modes = set(_nvidia_smi('--query-gpu=persistence_mode', '--format=csv,noheader').split())
+        return 'Enabled' if modes == {'Enabled'} else 'Disabled'
+
+    settings = [Setting('gpu_persistence_mode', 'Enabled', read_persistence,
+                        lambda v: _nvidia_smi('-pm', '1'))]
+
+    if profile.get('GpuClocks'):
+        def read_clocks():
+            clocks = set(_nvidia_smi(
+                '--query-gpu=clocks.applications.memory,clocks.applications.graphics',
+                '--format=csv,noheader,nounits').replace(' ', '').splitlines())
+            return clocks.pop() if len(clocks) == 1 else ','.join(sorted(clocks))
+        settings.append(Setting('gpu_application_clocks', profile['GpuClocks'], read_clocks,
+                                lambda v: _nvidia_smi('-ac', v)))
+    return settings
+
+
+#
+# Network
+#
+def primary_interface():
+    with open('/proc/net/route') as f:
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if fields[1] == '00000000':
+                return fields[0]
+    return None
+
+
+def network_settings(profile):
+    settings = []
+    iface = primary_interface()
+    if iface is not None:
+        mtu_path = '/sys/class/net/%s/mtu' % iface
+        settings.append(Setting(
+            'mtu', str(profile['Mtu']), lambda: _read_file(mtu_path),
+            lambda v: subprocess.check_call(['ip', 'link', 'set', 'dev', iface, 'mtu', v])))
+
+    max_buffer = int(profile['TcpMaxBuffer'])
+    sysctls = [
+        ('net.core.rmem_max', str(max_buffer)),
+        ('net.core.wmem_max', str(max_buffer)),
+        ('net.ipv4.tcp_rmem', '4096\t87380\t%d' % max_buffer),
+        ('net.ipv4.tcp_wmem', '4096\t65536\t%d' % max_buffer),
+        ('net.core.netdev_max_backlog', '30000'),
+        ('net.ipv4.tcp_congestion_control', TCP_CONGESTION_CONTROL),
+        ('net.ipv4.tcp_mtu_probing', '1'),
+    ]
+    for key, value in sysctls:
+        path = '/proc/sys/' + key.replace('.', '/')
+        settings.append(Setting(
+            key, value,
+            (lambda p: lambda: _normalize_ws(_read_file(p)))(path),
+            (lambda p: lambda v: _write_file(p, v))(path)))
+    return settings, sysctls
+
+
+def _normalize_ws(value):
+    return None if value is None else '\t'.join(value.split())
+
+
+def irq_setting(profile):
+    iface = primary_interface()
+    count = int(profile['IrqCpuCount'])
+    if iface is None or count <= 0:
+        return []
+    # NIC interrupts are moved to the last cores, away from the cores data
+    # loaders and ranks are scheduled to first.
+    cpus = list(range(os.cpu_count()))[-count:]
+    desired = '%d-%d' % (cpus[0], cpus[-1])
+
+    def irqs():
+        with open('/proc/interrupts') as f:
+            return [l.split(':', 1)[0].strip() for l in f if iface in l or 'ena-mgmnt' in l]
+
+    def read():
+        values = set(_read_file('/proc/irq/%s/smp_affinity_list' % i) for i in irqs())
+        if not values:
+            return None
+        return values.pop() if len(values) == 1 else ','.join(sorted(values))
+
+    def apply(value):
+        # irqbalance would move them back.
+        subprocess.call(['service', 'irqbalance', 'stop'])
+        for i in irqs():
+            try:
+                _write_file('/proc/irq/%s/smp_affinity_list' % i, value)
+            except IOError:
+                pass
+    return [Setting('nic_irq_affinity', desired, read, apply)]
+
+
+#
+# CPU and memory
+#
+def cpu_settings():
+    governors = glob.glob('/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_governor')
+
+    def read_governor():
+        if not governors:
+            return None
+        values = set(_read_file(p) for p in governors)
+        return values.pop() if len(values) == 1 else ','.join(sorted(values))
+
+    def apply_governor(value):
+        for p in governors:
+            _write_file(p, value)
+
+    thp = '/sys/kernel/mm/transparent_hugepage/enabled'
+
+    def read_thp():
+        value = _read_file(thp)
+        if value is None:
+            return None
+        # e.g. "always [madvise] never"
+        return value.split('[', 1)[1].split(']', 1)[0]
+
+    return [
+        Setting('cpu_governor', CPU_GOVERNOR, read_governor, apply_governor),
+        Setting('transparent_hugepage', TRANSPARENT_HUGEPAGE, read_thp,
+                lambda v: _write_file(thp, v)),
+    ]
+
+
+def rank_env():
+    """Environment forwarded to every rank by chainer-mpirun."""
+    env = {'NCCL_IB_DISABLE': '1'}
+    iface = primary_interface()
+    if iface is not None:
+        env['NCCL_SOCKET_IFNAME'] = iface
+    return ''.join('%s=%s\n' % kv for kv in sorted(env.items()))
+
+
+def tune(profile):
+    net, sysctls = network_settings(profile)
+    settings = gpu_settings(profile) + net + irq_setting(profile) + cpu_settings()
+    report = {}
+    for s in settings:
+        try:
+            report[s.name] = s.tune()
+        except Exception as e:
+            logger.exception('failed to tune %s', s.name)
+            report[s.name] = {'desired': s.desired, 'status': 'failed', 'error': repr(e)}
+
+    # persist sysctls so that they survive reboots before the agent starts.
+    util.write_atomically(SYSCTL_PATH, ''.join(
+        '%s = %s\n' % (k, v.replace('\t', ' ')) for k, v in sysctls))
+    util.write_atomically(config.RANK_ENV_PATH, rank_env())
+    return report
+
+
+def write_report(report):
+    os.makedirs(os.path.dirname(REPORT_PATH), exist_ok=True)
+    with open(REPORT_PATH, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+class TuningTask(task.Task):
+    """Re-applies the tuning profile, e.g. after the instance was restarted."""
+
+    name = 'tuning'
+    period = 3600
+
+    def run(self):
+        report = tune(self.conf['tuning'])
+        write_report(report)
+        for name, r in sorted(report.items()):
+            if r.get('changed'):
+                logger.info('tuning %s changed: %r -> %r', name, r['before'], r['after'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='apply the host tuning profile')
+    parser.add_argument('--strict', action='store_true',
+                        help='exit with non-zero status if a setting could not be applied')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    report = tune(config.load()['tuning'])
+    write_report(report)
+    for name, r in sorted(report.items()):
+        if r['status'] == 'unsupported':
+            line = 'unsupported'
+        elif r.get('changed'):
+            line = 'changed %r -> %r' % (r['before'], r['after'])
+        else:
+            line = 'unchanged %r' % (r.get('after'),)
+        print('%-32s %-6s %s' % (name, r['status'], line))
+    if args.strict and any(r['status'] == 'failed' for r in report.values()):
+        return 1
+    return 0
@@ -0,0 +1,25 @@
+import os
+
+
+def write_atomically(path, content, mode=0o644, uid=None, gid=None):
+    """Replaces ``path`` with ``content`` if it differs.
+
+    ``content`` may be either ``str`` or ``bytes``.  Returns whether the file
+    was written.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.chmod(tmp, mode)
+    if uid is not None:
+        os.chown(tmp, uid, gid)
+    os.rename(tmp, path)
+    return True
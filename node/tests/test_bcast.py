@@ -0,0 +1,66 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from chainer_cfn import bcast
+
+OLD = b'old' * 1000
+NEW = b'new' * 1000
+
+
+def header(data, dest, offset=0):
+    return {'size': len(data), 'offset': offset, 'sha256': hashlib.sha256(data).hexdigest(),
+            'dest': dest, 'mode': 0o644}
+
+
+def interrupted(data, n):
+    yield data[:n]
+    raise IOError('stream ended')
+
+
+class TestRelay(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.dest = os.path.join(self.dir, 'data.bin')
+        self.run_relay(OLD, [OLD])
+
+    def run_relay(self, data, chunks, offset=0):
+        out = io.StringIO()
+        relay = bcast.Relay('node', header(data, self.dest, offset), self.dest, [], 1, out)
+        relay.run(iter(chunks))
+        return out.getvalue().split()[-1]
+
+    def probe(self, data):
+        return bcast.probe(self.dest, hashlib.sha256(data).hexdigest())
+
+    def test_done(self):
+        self.assertEqual(self.probe(OLD), 'done')
+        self.assertEqual(self.probe(NEW), 0)
+
+    def test_interrupted_resumes(self):
+        with self.assertRaises(IOError):
+            self.run_relay(NEW, interrupted(NEW, 1000))
+        # the old file is still in place and must not be taken for the new one.
+        self.assertEqual(self.probe(NEW), 1000)
+        self.assertEqual(self.probe(OLD), 'done')
+
+        self.assertEqual(self.run_relay(NEW, [NEW[1000:]], offset=1000), 'ok')
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), NEW)
+        self.assertEqual(self.probe(NEW), 'done')
+        self.assertFalse(os.path.exists(self.dest + '.part.sha256'))
+
+    def test_checksum_mismatch(self):
+        self.assertEqual(self.run_relay(NEW, [OLD]), 'checksum-mismatch')
+        self.assertEqual(self.probe(NEW), 0)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), OLD)
+
+
+if __name__ == '__main__':
+    unittest.main()
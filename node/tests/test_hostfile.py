@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from chainer_cfn import hostfile
+from chainer_cfn import placement
+
+
+def instance(host, group):
+    return {'PrivateDnsName': host,
+            'Tags': [{'Key': hostfile.NODE_GROUP_TAG, 'Value': group}]}
+
+
+class TestHostfileTask(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        user = mock.Mock(pw_uid=os.getuid(), pw_gid=os.getgid())
+        patches = [
+            mock.patch.object(hostfile, 'HOSTFILE_DIR', os.path.join(self.dir, 'hostfiles')),
+            mock.patch.object(hostfile, 'HOSTFILE_PATH', os.path.join(self.dir, 'default')),
+            mock.patch.object(placement, 'PLACEMENT_PATH', os.path.join(self.dir, 'placement.json')),
+            mock.patch.object(hostfile.pwd, 'getpwnam', return_value=user),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.task = hostfile.HostfileTask({
+            'cluster_name': 'test',
+            'node_groups': [{'name': 'master', 'gpus': 8}, {'name': 'cpu', 'gpus': 0}]})
+
+    def run_task(self, instances):
+        with mock.patch.object(hostfile, 'cluster_instances', return_value=instances):
+            self.task.run()
+        return sorted(os.listdir(hostfile.HOSTFILE_DIR))
+
+    def test_removed_group(self):
+        self.assertEqual(self.run_task([instance('a', 'master'), instance('b', 'cpu')]),
+                         ['all', 'cpu', 'master'])
+        # the cpu group was scaled in to no instances
+        self.assertEqual(self.run_task([instance('a', 'master')]), ['all', 'master'])
+        with open(os.path.join(hostfile.HOSTFILE_DIR, 'all')) as f:
+            self.assertEqual(f.read(), 'a\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
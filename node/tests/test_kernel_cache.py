@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from chainer_cfn import kernel_cache
+
+KEY = 'cuda9.0.176-driver396.44-sm7.0'
+
+
+class TestSetup(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.local_root = os.path.join(self.dir, 'var', 'kernel-cache')
+        user = mock.Mock(pw_uid=os.getuid(), pw_gid=os.getgid())
+        patches = [
+            mock.patch.object(kernel_cache, 'CACHE_LINK', os.path.join(self.local_root, 'current')),
+            mock.patch.object(kernel_cache, 'LOCAL_ROOT', self.local_root),
+            mock.patch.object(kernel_cache, 'cache_key', return_value=KEY),
+            mock.patch.object(kernel_cache.pwd, 'getpwnam', return_value=user),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def check(self, conf, expected):
+        directory = kernel_cache.setup(conf)
+        self.assertEqual(directory, expected)
+        self.assertTrue(os.path.isdir(directory))
+        self.assertEqual(os.readlink(kernel_cache.CACHE_LINK), directory)
+        # again, e.g. by chainer-cfn-resume
+        self.assertEqual(kernel_cache.setup(conf), expected)
+
+    def test_efs(self):
+        efs = os.path.join(self.dir, 'efs')
+        conf = {'kernel_cache': {'mode': 'EFS'}, 'efs_mount_point': efs}
+        self.check(conf, os.path.join(efs, kernel_cache.EFS_DIR, KEY))
+
+    def test_asset_bucket(self):
+        conf = {'kernel_cache': {'mode': 'AssetBucket'}, 'asset_bucket': 'bucket'}
+        self.check(conf, os.path.join(self.local_root, KEY))
+
+    def test_disabled(self):
+        self.assertIsNone(kernel_cache.setup({'kernel_cache': {'mode': 'None'}}))
+        self.assertFalse(os.path.lexists(kernel_cache.CACHE_LINK))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import argparse
+import unittest
+from unittest import mock
+
+from chainer_cfn import launcher
+
+# 8 GPUs, 4 on each of 2 NUMA nodes
+LAYOUT = {
+    'gpus': [(i, i // 4) for i in range(8)],
+    'numa_nodes': {0: list(range(0, 32)), 1: list(range(32, 64))},
+    'ranks_per_numa': 4,
+}
+CPU_LAYOUT = {'gpus': [], 'numa_nodes': {0: list(range(16))}, 'ranks_per_numa': None}
+
+
+def args(**kwargs):
+    a = dict(nodes=None, ppn=None, display_map=False, command=['python3', 'train.py'])
+    a.update(kwargs)
+    return argparse.Namespace(**a)
+
+
+def option(cmd, name):
+    return cmd[cmd.index(name) + 1]
+
+
+class TestBuildCommand(unittest.TestCase):
+
+    def setUp(self):
+        p = mock.patch.object(launcher, 'read_env_file', return_value={})
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_same_layout(self):
+        cmd = launcher.build_command(args(), LAYOUT, [('a', 8), ('b', 8)], {})
+        self.assertEqual(option(cmd, '-n'), '16')
+        self.assertEqual(option(cmd, '--host'), 'a:8,b:8')
+        self.assertEqual(option(cmd, '--map-by'), 'ppr:4:numa')
+        self.assertEqual(option(cmd, '--bind-to'), 'numa')
+
+    def test_mixed_slots(self):
+        cmd = launcher.build_command(args(), LAYOUT, [('a', 8), ('b', 4), ('c', 8)], {})
+        self.assertEqual(option(cmd, '-n'), '20')
+        self.assertEqual(option(cmd, '--host'), 'a:8,b:4,c:8')
+        self.assertEqual(option(cmd, '--map-by'), 'slot')
+        self.assertEqual(option(cmd, '--bind-to'), 'none')
+        self.assertNotIn('CHAINER_CFN_GPU_ORDER', ' '.join(cmd))
+
+    def test_mixed_slots_with_ppn(self):
+        cmd = launcher.build_command(args(ppn=2), LAYOUT, [('a', 8), ('b', 4)], {})
+        self.assertEqual(option(cmd, '-n'), '4')
+        self.assertEqual(option(cmd, '--host'), 'a:2,b:2')
+        self.assertEqual(option(cmd, '--map-by'), 'ppr:2:node')
+
+    def test_group_layout_from_cpu_master(self):
+        cmd = launcher.build_command(args(), CPU_LAYOUT, [('a', 8), ('b', 8)], {}, (8, 4))
+        self.assertEqual(option(cmd, '--map-by'), 'ppr:4:numa')
+        self.assertEqual(option(cmd, '--bind-to'), 'numa')
+
+    def test_nodes(self):
+        cmd = launcher.build_command(args(nodes=1), LAYOUT, [('a', 8), ('b', 8)], {})
+        self.assertEqual(option(cmd, '--host'), 'a:8')
+
+
+class TestMain(unittest.TestCase):
+
+    def test_too_many_nodes(self):
+        with mock.patch.object(launcher, 'read_hostfile', return_value=[('a', 8)]), \
+                mock.patch('sys.stderr'):
+            with self.assertRaises(SystemExit) as e:
+                launcher.main(['--nodes', '2', '--dry-run', 'python3'])
+        self.assertEqual(e.exception.code, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+from unittest import mock
+
+from chainer_cfn import preflight
+
+CONF = {
+    'cluster_name': 'test',
+    'role': 'Worker',
+    'asset_bucket': 'bucket',
+    'preflight': {'GpuCount': 1, 'MinGpuTflops': 9.0, 'MinLoopbackGbps': 4, 'MinMasterGbps': 4},
+}
+
+
+class TestRunChecks(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(preflight, 'gpu_matmul_tflops', return_value=[10.0]),
+            mock.patch.object(preflight, 'ecc_errors', return_value=[0]),
+            mock.patch.object(preflight, 'xid_events', return_value=[]),
+            mock.patch.object(preflight, 'loopback_bandwidth_gbps', return_value=10.0),
+            mock.patch.object(preflight, 'wait_for_master', return_value='10.0.0.1'),
+            mock.patch.object(preflight, 'tcp_bandwidth_gbps', return_value=10.0),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_pass(self):
+        results = preflight.run_checks(CONF, 0)
+        self.assertTrue(all(r['passed'] for r in results.values()))
+
+    def test_gpu_check_error_fails(self):
+        preflight.gpu_matmul_tflops.side_effect = ImportError('No module named cupy')
+        results = preflight.run_checks(CONF, 0)
+        self.assertIs(results['gpu_matmul_tflops']['passed'], False)
+        self.assertIn('cupy', results['gpu_matmul_tflops']['error'])
+
+    def test_nvidia_smi_error_fails(self):
+        preflight.ecc_errors.side_effect = OSError('nvidia-smi not found')
+        results = preflight.run_checks(CONF, 0)
+        self.assertIs(results['gpu_ecc_errors']['passed'], False)
+
+    def test_unreachable_master_is_unknown(self):
+        preflight.wait_for_master.return_value = None
+        results = preflight.run_checks(CONF, 0)
+        self.assertIsNone(results['master_gbps']['passed'])
+        self.assertTrue(all(r['passed'] is not False for r in results.values()))
+
+
+class TestWaitForMaster(unittest.TestCase):
+
+    def test_lookup_error_is_retried(self):
+        addresses = iter([RuntimeError('Throttling'), '10.0.0.1'])
+
+        def master_address(cluster_name):
+            a = next(addresses)
+            if isinstance(a, Exception):
+                raise a
+            return a
+        with mock.patch.object(preflight, 'master_address', side_effect=master_address), \
+                mock.patch.object(preflight.socket, 'create_connection'), \
+                mock.patch.object(preflight.time, 'sleep'):
+            self.assertEqual(preflight.wait_for_master('test', 60), '10.0.0.1')
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(preflight, 'record'),
+            mock.patch.object(preflight, 'mark_unhealthy'),
+            mock.patch.object(preflight.imds, 'instance_id', return_value='i-0'),
+            mock.patch.object(preflight.imds, 'instance_type', return_value='p3.2xlarge'),
+            mock.patch.object(preflight.imds, 'local_hostname', return_value='ip-10-0-0-2'),
+            mock.patch.object(preflight.config, 'load', return_value=CONF),
+            mock.patch.object(preflight, 'run_checks'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_pass(self):
+        preflight.run_checks.return_value = {'loopback_gbps': {'value': 10.0, 'passed': True}}
+        self.assertEqual(preflight.main(['--mark-unhealthy']), 0)
+        preflight.mark_unhealthy.assert_not_called()
+
+    def test_failed_check_marks_unhealthy(self):
+        preflight.run_checks.return_value = {
+            'gpu_matmul_tflops': {'value': None, 'passed': False, 'error': 'CUDARuntimeError'}}
+        self.assertEqual(preflight.main(['--mark-unhealthy']), 1)
+        preflight.mark_unhealthy.assert_called_once_with('i-0')
+
+    def test_unreachable_master_passes(self):
+        preflight.run_checks.return_value = {
+            'master_gbps': {'value': None, 'passed': None, 'error': 'master is not reachable'}}
+        self.assertEqual(preflight.main(['--mark-unhealthy']), 0)
+
+    def test_unexpected_error_marks_unhealthy(self):
+        preflight.run_checks.side_effect = RuntimeError('Throttling')
+        self.assertEqual(preflight.main(['--mark-unhealthy']), 1)
+        preflight.mark_unhealthy.assert_called_once_with('i-0')
+
+    def test_config_error_marks_unhealthy(self):
+        preflight.config.load.side_effect = IOError('node.json')
+        self.assertEqual(preflight.main(['--mark-unhealthy']), 1)
+        preflight.mark_unhealthy.assert_called_once_with('i-0')
+
+    def test_unexpected_error_without_mark_unhealthy(self):
+        preflight.run_checks.side_effect = RuntimeError('Throttling')
+        self.assertEqual(preflight.main([]), 1)
+        preflight.mark_unhealthy.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from chainer_cfn import cssh
+from chainer_cfn import profiler
+
+
+def profile(host, rank):
+    return {'host': host, 'rank': rank, 'stacks': {},
+            'seconds': {'compute': 1.0, 'data': 0.0, 'comm': 0.0}}
+
+
+class FakeShell(object):
+    """Gathers as cssh does: ``dest/<host>/<path>``, from files of ``REMOTE``."""
+
+    REMOTE = {}
+
+    def __init__(self, hosts, parallel, timeout, out=None):
+        self.hosts = hosts
+
+    def gather(self, paths, dest):
+        for host in self.hosts:
+            for path in paths:
+                target = os.path.join(dest, host, path.lstrip('/'))
+                os.makedirs(target, exist_ok=True)
+                for name, content in self.REMOTE[host].items():
+                    with open(os.path.join(target, name), 'w') as f:
+                        f.write(content)
+
+
+class TestCollect(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        p = mock.patch.object(cssh, 'ClusterShell', FakeShell)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_collect_into_missing_directory(self):
+        # launched from a node without GPUs nor EFS: nothing was written locally.
+        directory = os.path.join(self.dir, 'profiles', '20180101-000000')
+        FakeShell.REMOTE = {
+            h: {'%s-rank%d.json' % (h, r): json.dumps(profile(h, r)),
+                # same name on every host
+                'nvprof.log': h}
+            for h, r in [('a', 0), ('b', 1)]}
+        profiler.collect(directory, ['a', 'b'])
+
+        self.assertEqual([p['rank'] for p in profiler.load_profiles(directory)], [0, 1])
+        for h in ['a', 'b']:
+            with open(os.path.join(directory, h, 'nvprof.log')) as f:
+                self.assertEqual(f.read(), h)
+        self.assertIsNotNone(profiler.write_report(directory))
+
+    def test_local_and_gathered_rank_counted_once(self):
+        directory = os.path.join(self.dir, 'profiles')
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'a-rank0.json'), 'w') as f:
+            json.dump(profile('a', 0), f)
+        FakeShell.REMOTE = {'a': {'a-rank0.json': json.dumps(profile('a', 0))}}
+        profiler.collect(directory, ['a'])
+        self.assertEqual(len(profiler.load_profiles(directory)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from unittest import mock
+
+from chainer_cfn import stack
+
+
+class TestPause(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = {}
+
+        def client(service):
+            return self.clients.setdefault(service, mock.MagicMock())
+        patches = [
+            mock.patch.object(stack, '_client', side_effect=client),
+            mock.patch.object(stack, 'stack_resources', return_value=('i-m', ['asg'], 'bucket')),
+            mock.patch.object(stack, 'asg_instances', return_value={'asg': ['i-w']}),
+            mock.patch.object(stack, 'write_state'),
+            mock.patch.object(stack, 'read_state', return_value=None),
+            mock.patch.object(stack, '_log'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_state_is_stopped_after_instances_stop(self):
+        self.clients['ec2'] = ec2 = mock.MagicMock()
+        ec2.get_waiter.return_value.wait.side_effect = RuntimeError('interrupted')
+        with self.assertRaises(RuntimeError):
+            stack.pause('test')
+        # recorded for resume, but not as stopped
+        state = stack.write_state.call_args[0][1]
+        self.assertIsNone(state['stopped_at'])
+
+    def test_interrupted_pause_stops_again(self):
+        stack.read_state.return_value = {
+            'paused_at': 0, 'master': 'i-m', 'asgs': {'asg': ['i-w']}, 'stopped_at': None}
+        self.assertEqual(stack.pause('test'), 0)
+        self.clients['ec2'].stop_instances.assert_called_once_with(InstanceIds=['i-m', 'i-w'])
+        self.assertIsNotNone(stack.write_state.call_args[0][1]['stopped_at'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+import unittest
+
+NODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestImport(unittest.TestCase):
+
+    def test_without_boto3(self):
+        # chainer-cfn-tune and chainer-cfn-fscache setup run from cfn-init
+        # before the agent configset installs boto3.
+        code = ('import sys\n'
+                'sys.modules["boto3"] = None\n'
+                'sys.modules["botocore"] = None\n'
+                'import chainer_cfn.tune\n'
+                'import chainer_cfn.fscache\n')
+        subprocess.check_call([sys.executable, '-c', code], cwd=NODE_DIR)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+"""Estimates the critical path of stack creation from a generated template.
+
+The resource dependency graph is built from Ref, Fn::GetAtt, Fn::Sub and
+DependsOn after resolving conditions for each scenario (a set of parameter
+values), and the creation time of each resource is estimated from its type
+with DURATIONS.  Explicit DependsOn which are not implied by a reference
+only serialize creation; they are reported with the time they add.
+
+With --baseline, it fails when a scenario becomes slower than the recorded
+estimate so that it is caught by `make build`.
+
+    python critical_path.py ../build/template.yaml --baseline critical_path_baseline.json
+"""
+import argparse
+import json
+import re
+import sys
+
+import cfn_flip
+
+# Rough creation time in seconds of each resource type.
+DURATIONS = {
+    'AWS::AutoScaling::AutoScalingGroup': 60,
+    'AWS::AutoScaling::LaunchConfiguration': 5,
+    'AWS::CloudFormation::WaitCondition': 1,
+    'AWS::CloudFormation::WaitConditionHandle': 1,
+    'AWS::CloudWatch::Alarm': 5,
+    'AWS::CloudWatch::Dashboard': 5,
+    'AWS::EC2::Instance': 60,
+    'AWS::EC2::InternetGateway': 15,
+    'AWS::EC2::PlacementGroup': 5,
+    'AWS::EC2::Route': 30,
+    'AWS::EC2::RouteTable': 5,
+    'AWS::EC2::SecurityGroup': 5,
+    'AWS::EC2::SecurityGroupIngress': 5,
+    'AWS::EC2::Subnet': 5,
+    'AWS::EC2::SubnetRouteTableAssociation': 5,
+    'AWS::EC2::VPC': 15,
+    'AWS::EC2::VPCGatewayAttachment': 15,
+    'AWS::EFS::FileSystem': 10,
+    'AWS::EFS::MountTarget': 90,
+    'AWS::IAM::InstanceProfile': 120,
+    'AWS::IAM::Role': 20,
+    'AWS::S3::Bucket': 20,
+}
+DEFAULT_DURATION = 10
+# Time until cfn-signal of resources with CreationPolicy (cfn-init,
+# pre-flight check and so on).
+SIGNAL_DURATION = 600
+
+# Parameter values of each scenario in addition to the defaults.
+SCENARIOS = {
+    'default': {},
+    'no-efs': {'UseEFS': 'False'},
+    'existing-vpc-efs': {'VpcId': 'vpc-0', 'SubnetId': 'subnet-0', 'EFSFileSystemId': 'fs-0'},
+}
+
+PSEUDO_PARAMETERS = {
+    'AWS::AccountId': '123456789012',
+    'AWS::NoValue': None,
+    'AWS::Partition': 'aws',
+    'AWS::Region': 'us-east-1',
+    'AWS::StackId': 'stack-id',
+    'AWS::StackName': 'stack',
+    'AWS::URLSuffix': 'amazonaws.com',
+}
+
+
+class Stack(object):
+    """Resources and their dependencies of a template under a scenario."""
+
+    def __init__(self, template, parameters):
+        self.template = template
+        self.params = dict(PSEUDO_PARAMETERS)
+        for name, p in template.get('Parameters', {}).items():
+            self.params[name] = str(p['Default']) if 'Default' in p else ''
+        self.params.update(parameters)
+        self.conditions = {}
+        self.resources = {
+            name: r for name, r in template['Resources'].items()
+            if 'Condition' not in r or self.condition(r['Condition'])
+        }
+        self.refs = {name: self._references(r) for name, r in self.resources.items()}
+        self.depends_on = {}
+        for name, r in self.resources.items():
+            deps = r.get('DependsOn', [])
+            if isinstance(deps, str):
+                deps = [deps]
+            self.depends_on[name] = set(d for d in deps if d in self.resources)
+
+    def condition(self, name):
+        if name not in self.conditions:
+            self.conditions[name] = bool(self.evaluate(self.template['Conditions'][name]))
+        return self.conditions[name]
+
+    def evaluate(self, value):
+        if not isinstance(value, dict) or len(value) != 1:
+            return value
+        fn, args = list(value.items())[0]
+        if fn == 'Ref':
+            return self.params.get(args, args)
+        if fn == 'Condition':
+            return self.condition(args)
+        if fn == 'Fn::Equals':
+            a, b = [self.evaluate(x) for x in args]
+            return str(a) == str(b)
+        if fn == 'Fn::And':
+            return all(self.evaluate(x) for x in args)
+        if fn == 'Fn::Or':
+            return any(self.evaluate(x) for x in args)
+        if fn == 'Fn::Not':
+            return not self.evaluate(args[0])
+        if fn == 'Fn::If':
+            return self.evaluate(args[1] if self.condition(args[0]) else args[2])
+        return value
+
+    def _references(self, node):
+        refs = set()
+        if isinstance(node, list):
+            for x in node:
+                refs |= self._references(x)
+        elif isinstance(node, dict):
+            if len(node) == 1:
+                fn, args = list(node.items())[0]
+                if fn == 'Fn::If':
+                    return self._references(args[1] if self.condition(args[0]) else args[2])
+                if fn == 'Ref' and args in self.template['Resources']:
+                    refs.add(args)
+                elif fn == 'Fn::GetAtt':
+                    refs.add(args[0] if isinstance(args, list) else args.split('.')[0])
+                elif fn == 'Fn::Sub':
+                    text = args[0] if isinstance(args, list) else args
+                    refs |= set(m.split('.')[0] for m in re.findall(r'\$\{([^!}][^}]*)\}', text))
+            for k, v in node.items():
+                if k not in ('DependsOn', 'Condition'):
+                    refs |= self._references(v)
+        return refs & set(self.resources)
+
+    def dependencies(self, name):
+        return self.refs[name] | self.depends_on[name]
+
+    def duration(self, name):
+        r = self.resources[name]
+        d = DURATIONS.get(r['Type'], DEFAULT_DURATION)
+        if 'CreationPolicy' in r:
+            d += SIGNAL_DURATION
+        return d
+
+    def schedule(self, removed_edge=None):
+        """Returns ``{resource: (start, finish)}`` when created as early as possible."""
+        times = {}
+
+        def visit(name, path):
+            if name in times:
+                return times[name][1]
+            if name in path:
+                raise ValueError('circular dependency: %s' % ' -> '.join(path + [name]))
+            deps = [d for d in self.dependencies(name) if (name, d) != removed_edge]
+            start = max([visit(d, path + [name]) for d in deps] or [0])
+            times[name] = (start, start + self.duration(name))
+            return times[name][1]
+        for name in sorted(self.resources):
+            visit(name, [])
+        return times
+
+    def critical_path(self, times):
+        name = max(times, key=lambda n: times[n][1])
+        path = [name]
+        while True:
+            deps = [d for d in self.dependencies(name) if times[d][1] == times[name][0]]
+            if not deps or times[name][0] == 0:
+                break
+            name = max(deps, key=lambda d: times[d][1])
+            path.append(name)
+        return list(reversed(path))
+
+    def serializing_dependencies(self, total):
+        """Returns ``[(resource, depends_on, kind, seconds_added)]`` of explicit DependsOn."""
+        result = []
+        for name in sorted(self.resources):
+            for dep in sorted(self.depends_on[name]):
+                if dep in self.refs[name]:
+                    result.append((name, dep, 'redundant', 0))
+                    continue
+                without = max(f for _, f in self.schedule(removed_edge=(name, dep)).values())
+                result.append((name, dep, 'serialize-only', total - without))
+        return result
+
+
+def analyze(template, parameters):
+    stack = Stack(template, parameters)
+    times = stack.schedule()
+    total = max(f for _, f in times.values())
+    return {
+        'total': total,
+        'critical_path': [(n, stack.resources[n]['Type'], times[n][0], times[n][1])
+                          for n in stack.critical_path(times)],
+        'dependencies': stack.serializing_dependencies(total),
+    }
+
+
+def report(scenario, result):
+    print('%s: estimated creation time %ds' % (scenario, result['total']))
+    for name, type_, start, finish in result['critical_path']:
+        print('  %5d - %5ds  %-40s %s' % (start, finish, name, type_))
+    for name, dep, kind, added in result['dependencies']:
+        if kind == 'redundant':
+            print('  note: %s DependsOn %s is already implied by a reference' % (name, dep))
+        elif added == 0:
+            print('  note: %s DependsOn %s only serializes creation (off the critical path)' % (name, dep))
+        else:
+            print('  warning: %s DependsOn %s only serializes creation (adds %ds)' % (name, dep, added))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('template')
+    parser.add_argument('--baseline', help='JSON file of estimated seconds of each scenario')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='write the estimates to the baseline file')
+    parser.add_argument('--tolerance', type=int, default=0,
+                        help='seconds which each scenario may become slower than the baseline')
+    args = parser.parse_args(argv)
+
+    with open(args.template) as f:
+        template = cfn_flip.load_yaml(f.read())
+
+    estimates = {}
+    for scenario, parameters in sorted(SCENARIOS.items()):
+        result = analyze(template, parameters)
+        report(scenario, result)
+        estimates[scenario] = result['total']
+
+    if args.baseline is None:
+        return 0
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(estimates, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    slower = [(s, baseline[s], t) for s, t in sorted(estimates.items())
+              if s in baseline and t > baseline[s] + args.tolerance]
+    for s, before, after in slower:
+        print('%s: stack creation became slower: %ds -> %ds' % (s, before, after), file=sys.stderr)
+    if slower:
+        print('run `make critical-path-baseline` if this is intended', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
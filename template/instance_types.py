@@ -0,0 +1,139 @@
+from collections import OrderedDict
+
+# Capabilities of the instance types the template supports.  The allowed
+# values of the instance type parameters and every mapping looked up by
+# instance type (InstanceTypeMap, EBSOptimizationMap, TuningProfileMap and
+# PreflightThresholdMap) are generated from this catalog, so that the
+# hostfile slots, the cache device, the tuning profile and the MPI binding
+# of a node all follow the same facts.
+#
+#   vcpus           number of vCPUs
+#   gpus, gpu       number and model (a key of GPU_MODELS) of the GPUs
+#   numa_nodes      NUMA nodes; the GPUs are evenly spread over them
+#   network_gbps    sustained network bandwidth.  Types "up to" 10 Gbps
+#                   only burst to it, so their baseline is given here.
+#   instance_store  number of instance store volumes and whether they are
+#   store_nvme      NVMe devices ("Amazon EC2 NVMe Instance Storage")
+#   ebs_nvme        EBS volumes are NVMe devices (Nitro instances)
+#   ebs_optimized   EBS optimization is supported
+#   efa             Elastic Fabric Adapter is supported
+#   loopback_gbps   expected TCP throughput of loopback, lower on the older
+#                   CPUs of the smallest GPU types
+
+# Maximum application clocks "memory,graphics" (MHz) set by
+# chainer-cfn-tune, and the float32 matmul throughput (TFLOPS) a healthy GPU
+# reaches at least.
+GPU_MODELS = {
+    'V100': {'clocks': '877,1530', 'min_tflops': 9.0},
+    'K80': {'clocks': '2505,875', 'min_tflops': 2.0},
+    'K520': {'clocks': '', 'min_tflops': 1.0},
+    'M60': {'clocks': '2505,1177', 'min_tflops': 2.5},
+}
+
+
+def _instance(vcpus, network_gbps, gpus=0, gpu='', numa_nodes=1, instance_store=0, store_nvme=False,
+              ebs_nvme=False, ebs_optimized=True, efa=False, loopback_gbps=4):
+    return {
+        'vcpus': vcpus,
+        'gpus': gpus,
+        'gpu': gpu,
+        'numa_nodes': numa_nodes,
+        'network_gbps': network_gbps,
+        'instance_store': instance_store,
+        'store_nvme': store_nvme,
+        'ebs_nvme': ebs_nvme,
+        'ebs_optimized': ebs_optimized,
+        'efa': efa,
+        'loopback_gbps': loopback_gbps,
+    }
+
+
+GPU_INSTANCE_TYPES = OrderedDict([
+    ("p3.2xlarge", _instance(8, 2.5, gpus=1, gpu='V100')),
+    ("p3.8xlarge", _instance(32, 10, gpus=4, gpu='V100')),
+    ("p3.16xlarge", _instance(64, 25, gpus=8, gpu='V100', numa_nodes=2)),
+    ("p2.xlarge", _instance(4, 1.25, gpus=1, gpu='K80', loopback_gbps=2)),
+    ("p2.8xlarge", _instance(32, 10, gpus=8, gpu='K80')),
+    ("p2.16xlarge", _instance(64, 25, gpus=16, gpu='K80', numa_nodes=2)),
+    ("g2.2xlarge", _instance(8, 1.25, gpus=1, gpu='K520', instance_store=1, loopback_gbps=2)),
+    ("g2.8xlarge", _instance(32, 10, gpus=4, gpu='K520', numa_nodes=2, instance_store=2,
+                             ebs_optimized=False)),
+    ("g3.4xlarge", _instance(16, 5, gpus=1, gpu='M60')),
+    ("g3.8xlarge", _instance(32, 10, gpus=2, gpu='M60')),
+    ("g3.16xlarge", _instance(64, 25, gpus=4, gpu='M60', numa_nodes=2)),
+])
+# for the master and preprocessing nodes.
+CPU_INSTANCE_TYPES = OrderedDict([
+    ("c5.xlarge", _instance(4, 1.25, ebs_nvme=True)),
+    ("c5.2xlarge", _instance(8, 2.5, ebs_nvme=True)),
+    ("c5.4xlarge", _instance(16, 5, ebs_nvme=True)),
+    ("c5.9xlarge", _instance(36, 10, ebs_nvme=True)),
+    ("c5.18xlarge", _instance(72, 25, ebs_nvme=True, numa_nodes=2)),
+    ("m5.xlarge", _instance(4, 1.25, ebs_nvme=True)),
+    ("m5.2xlarge", _instance(8, 2.5, ebs_nvme=True)),
+    ("m5.4xlarge", _instance(16, 5, ebs_nvme=True)),
+    ("m5.12xlarge", _instance(48, 10, ebs_nvme=True)),
+    ("m5.24xlarge", _instance(96, 25, ebs_nvme=True, numa_nodes=2)),
+])
+INSTANCE_TYPES = OrderedDict(list(GPU_INSTANCE_TYPES.items()) + list(CPU_INSTANCE_TYPES.items()))
+
+
+def _number(x):
+    x = round(x, 2)
+    return int(x) if x == int(x) else x
+
+
+def tcp_max_buffer(network_gbps):
+    # large enough for the bandwidth-delay product within a region.
+    if network_gbps >= 25:
+        return 128 * 1024 * 1024
+    if network_gbps >= 10:
+        return 64 * 1024 * 1024
+    return 16 * 1024 * 1024
+
+
+def irq_cpu_count(vcpus):
+    if vcpus <= 8:
+        return 1
+    if vcpus <= 48:
+        return 2
+    return 4
+
+
+def capabilities(c):
+    """Row of InstanceTypeMap, written to node.json for each node group."""
+    return {
+        "GpuCount": c['gpus'],
+        "GpuModel": c['gpu'],
+        "NumaNodes": c['numa_nodes'],
+        "NetworkGbps": c['network_gbps'],
+        "InstanceStoreCount": c['instance_store'],
+        "InstanceStoreNvme": c['store_nvme'],
+        "EbsNvme": c['ebs_nvme'],
+        "Efa": c['efa'],
+    }
+
+
+def tuning_profile(c):
+    """Row of TuningProfileMap applied by chainer-cfn-tune."""
+    return {
+        "GpuClocks": GPU_MODELS[c['gpu']]['clocks'] if c['gpus'] else "",
+        "Mtu": 9001,
+        "TcpMaxBuffer": tcp_max_buffer(c['network_gbps']),
+        "IrqCpuCount": irq_cpu_count(c['vcpus']),
+    }
+
+
+def preflight_thresholds(c):
+    """Row of PreflightThresholdMap.  Min*Gbps are TCP throughput with 4 streams."""
+    return {
+        "GpuCount": c['gpus'],
+        "MinGpuTflops": GPU_MODELS[c['gpu']]['min_tflops'] if c['gpus'] else 0,
+        "MinLoopbackGbps": c['loopback_gbps'],
+        # 4 streams reach 40% of the sustained bandwidth, up to 8 Gbps.
+        "MinMasterGbps": _number(min(c['network_gbps'] * 0.4, 8)),
+    }
+
+
+def mapping(row):
+    return OrderedDict((name, row(c)) for name, c in INSTANCE_TYPES.items())
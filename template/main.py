@@ -1,3 +1,5 @@
+import json
+import os
 import textwrap
 import troposphere
 from troposphere import *
@@ -7,11 +9,21 @@ from troposphere.iam import *
 from troposphere.s3 import *
 from troposphere.policies import *
 from troposphere.efs import *
+from troposphere.cloudwatch import Alarm, Dashboard, MetricDimension
 
 import awacs
 from awacs.aws import Statement, Allow, Action, Principal
 
 from utils import *
+import instance_types
+
+NODE_BUNDLE_URL = os.environ.get(
+    'NODE_BUNDLE_URL',
+    'https://s3-us-west-2.amazonaws.com/chainer-cfn/chainer-cfn-node-v0.1.0.tar.gz'
+)
+
+# worker groups in addition to the default one (WorkerLC/WorkerASG).
+EXTRA_WORKER_GROUPS = [2, 3]
 
 
 def main():
@@ -42,14 +54,34 @@ def main():
                     'Label': {
                         'default': 'Cluster Configuration (Cluster = 1 Master + N(>=0) Workers)'
                     },
-                    'Parameters': ['InstanceType', 'KeyPairName', 'SSHLocation', 'RootVolumeSize', 'WorkerSize']
+                    'Parameters': ['InstanceType', 'MasterInstanceType', 'KeyPairName', 'SSHLocation', 'RootVolumeSize',
+                                   'WorkerSize', 'PlacementStrategy', 'PlacementPartitionCount']
+                },
+                {
+                    'Label': {
+                        'default': 'Additional Worker Groups (e.g. CPU nodes for preprocessing or another GPU type)'
+                    },
+                    'Parameters': sum([
+                        ['WorkerGroup%dName' % i, 'WorkerGroup%dInstanceType' % i, 'WorkerGroup%dSize' % i]
+                        for i in EXTRA_WORKER_GROUPS
+                    ], [])
                 },
                 {
                     'Label': {
                         'default': 'Elastic File System(EFS) Configuration'
                     },
                     'Parameters': ['UseEFS', 'EFSFileSystemId', 'ExistingEFSMountTargetSecurityGroupId',
-                                   'NewEFSPerformanceMode', 'EFSMountPoint']
+                                   'NewEFSPerformanceMode', 'NewEFSThroughputMode', 'NewEFSProvisionedThroughput',
+                                   'EFSBurstCreditThreshold', 'EFSAutoProvisionThroughput', 'EFSMountPoint',
+                                   'EFSCache', 'EFSCacheVolumeSize', 'EFSCacheCullThresholds']
+                },
+                {
+                    'Label': {
+                        'default': 'Advanced Configuration'
+                    },
+                    'Parameters': ['NodeBundleURL', 'EnablePreflight', 'StragglerThreshold',
+                                   'EnableRegistryCache', 'RegistryCacheUpstream', 'RegistryCacheStorage',
+                                   'KernelCache']
                 }
             ],
             'ParameterLabels': {
@@ -74,6 +106,9 @@ def main():
                 'InstanceType': {
                     'default': 'Instance Type:'
                 },
+                'MasterInstanceType': {
+                    'default': 'Master Instance Type:'
+                },
                 'KeyPairName': {
                     'default': 'Key Pair:'
                 },
@@ -86,6 +121,17 @@ def main():
                 'WorkerSize': {
                     'default': 'Worker Size:'
                 },
+                'PlacementStrategy': {
+                    'default': 'Placement strategy:'
+                },
+                'PlacementPartitionCount': {
+                    'default': 'Number of partitions (partition strategy):'
+                },
+                **{
+                    'WorkerGroup%d%s' % (i, k): {'default': 'Worker group %d %s:' % (i, label)}
+                    for i in EXTRA_WORKER_GROUPS
+                    for k, label in [('Name', 'name'), ('InstanceType', 'instance type'), ('Size', 'size')]
+                },
                 'UseEFS': {
                     'default': 'Use EFS?'
                 },
@@ -98,8 +144,50 @@ def main():
                 'NewEFSPerformanceMode': {
                     'default': 'Performance mode of new EFS:'
                 },
+                'NewEFSThroughputMode': {
+                    'default': 'Throughput mode of new EFS:'
+                },
+                'NewEFSProvisionedThroughput': {
+                    'default': 'Provisioned throughput (MiB/s) of new EFS:'
+                },
+                'EFSBurstCreditThreshold': {
+                    'default': 'Burst credit alarm threshold (bytes):'
+                },
+                'EFSAutoProvisionThroughput': {
+                    'default': 'Switch to provisioned throughput on low burst credits?'
+                },
                 'EFSMountPoint': {
                     'default': 'Mount point of new EFS:'
+                },
+                'EFSCache': {
+                    'default': 'Local read cache (FS-Cache) of EFS:'
+                },
+                'EFSCacheVolumeSize': {
+                    'default': 'Size(GiB) of EBS cache volume:'
+                },
+                'EFSCacheCullThresholds': {
+                    'default': 'Cache cull thresholds (brun,bcull,bstop %):'
+                },
+                'NodeBundleURL': {
+                    'default': 'Node bundle URL:'
+                },
+                'EnablePreflight': {
+                    'default': 'Enable pre-flight check?'
+                },
+                'StragglerThreshold': {
+                    'default': 'Straggler threshold(%):'
+                },
+                'EnableRegistryCache': {
+                    'default': 'Enable container registry cache on the master?'
+                },
+                'RegistryCacheUpstream': {
+                    'default': 'Upstream registry of the cache:'
+                },
+                'RegistryCacheStorage': {
+                    'default': 'Storage of the registry cache:'
+                },
+                'KernelCache': {
+                    'default': 'Shared CuPy kernel cache:'
                 }
             }
         }
@@ -176,23 +264,31 @@ def main():
 
     InstanceType = t.add_parameter(Parameter(
         "InstanceType",
-        Description="Instance type of each node in the cluster. GPU instnaces are highly recommended.",
+        Description="Instance type of each node in the cluster (of the master, only when MasterInstanceType is empty). GPU instnaces are highly recommended.",
         Default="p3.16xlarge",
-        AllowedValues=[
-            "p3.2xlarge",
-            "p3.8xlarge",
-            "p3.16xlarge",
-            "p2.xlarge",
-            "p2.8xlarge",
-            "p2.16xlarge",
-            "g2.2xlarge",
-            "g2.8xlarge",
-            "g3.4xlarge",
-            "g3.8xlarge",
-            "g3.16xlarge"
-        ],
+        AllowedValues=list(instance_types.INSTANCE_TYPES),
+        Type="String"
+    ))
+
+    MasterInstanceType = t.add_parameter(Parameter(
+        "MasterInstanceType",
+        Description="Instance type of the master.  Leave blank to use InstanceType.  A CPU instance type is enough when the master does not run training processes: GPU ranks run only on nodes with GPUs.",
+        Default="",
+        AllowedValues=[""] + list(instance_types.INSTANCE_TYPES),
         Type="String"
     ))
+    IsMasterInstanceTypeEmpty = empty(Ref(MasterInstanceType))
+    t.add_condition("IsMasterInstanceTypeEmpty", IsMasterInstanceTypeEmpty)
+    masterInstanceType = If("IsMasterInstanceTypeEmpty", Ref(InstanceType), Ref(MasterInstanceType))
+
+    def findInInstanceTypeMap(mapName, instanceType, key):
+        # Fn::FindInMap takes only Ref or Fn::FindInMap as its keys, so
+        # the master's type (an Fn::If) chooses between two lookups.
+        if instanceType is masterInstanceType:
+            return If("IsMasterInstanceTypeEmpty",
+                      FindInMap(mapName, Ref(InstanceType), key),
+                      FindInMap(mapName, Ref(MasterInstanceType), key))
+        return FindInMap(mapName, instanceType, key)
 
     KeyPairName = t.add_parameter(Parameter(
         "KeyPairName",
@@ -227,6 +323,72 @@ def main():
         Type="Number"
     ))
 
+    # Each worker group has its own AutoScalingGroup and is tagged with
+    # ChainerClusterNodeGroup=<name>.  The default group is named "workers".
+    workerGroups = [{
+        'name': 'workers',
+        'resource_prefix': 'Worker',
+        'instance_type': Ref(InstanceType),
+        'size': Ref(WorkerSize),
+        'condition': None
+    }]
+    for i in EXTRA_WORKER_GROUPS:
+        name = t.add_parameter(Parameter(
+            "WorkerGroup%dName" % i,
+            Description="Name of worker group %d.  Its nodes are listed in /etc/chainer-cfn/hostfiles/<name>.  all, master and workers are reserved." % i,
+            Default="group%d" % i,
+            # all, master and workers name hostfiles of their own.
+            AllowedPattern="(?!(all|master|workers)$)[a-z0-9][a-z0-9-]*",
+            ConstraintDescription="must consist of lowercase letters, digits and hyphens, and not be all, master or workers.",
+            Type="String"
+        ))
+        instanceType = t.add_parameter(Parameter(
+            "WorkerGroup%dInstanceType" % i,
+            Description="Instance type of worker group %d." % i,
+            Default="c5.4xlarge",
+            AllowedValues=list(instance_types.INSTANCE_TYPES),
+            Type="String"
+        ))
+        size = t.add_parameter(Parameter(
+            "WorkerGroup%dSize" % i,
+            Description="The number of nodes in worker group %d.  Put 0 to disable the group." % i,
+            Default=0,
+            MinValue=0,
+            Type="Number"
+        ))
+        t.add_condition("HasWorkerGroup%d" % i, Not(Equals("0", Ref(size))))
+        workerGroups.append({
+            'name': Ref(name),
+            'resource_prefix': 'WorkerGroup%d' % i,
+            'instance_type': Ref(instanceType),
+            'size': Ref(size),
+            'condition': "HasWorkerGroup%d" % i
+        })
+
+    PlacementStrategy = t.add_parameter(Parameter(
+        "PlacementStrategy",
+        Description="How the nodes are placed.  'cluster' puts all the nodes in one cluster placement group (lowest latency, but large clusters may fail with insufficient capacity).  'cluster-per-group' gives each additional worker group its own cluster placement group.  'partition' spreads the nodes over PlacementPartitionCount partitions of a partition placement group.  Hostfiles list the nodes ordered by placement.",
+        Type="String",
+        Default="cluster",
+        AllowedValues=["cluster", "cluster-per-group", "partition"]
+    ))
+    IsPlacementPartition = Equals("partition", Ref(PlacementStrategy))
+    t.add_condition("IsPlacementPartition", IsPlacementPartition)
+    IsPlacementPerGroup = Equals("cluster-per-group", Ref(PlacementStrategy))
+    t.add_condition("IsPlacementPerGroup", IsPlacementPerGroup)
+    for i in EXTRA_WORKER_GROUPS:
+        t.add_condition("HasWorkerGroup%dPlacementGroup" % i,
+                        And(Condition("HasWorkerGroup%d" % i), Condition("IsPlacementPerGroup")))
+
+    PlacementPartitionCount = t.add_parameter(Parameter(
+        "PlacementPartitionCount",
+        Description="The number of partitions of the placement group when PlacementStrategy is 'partition'.",
+        Default=3,
+        MinValue=1,
+        MaxValue=7,
+        Type="Number"
+    ))
+
     UseEFS = t.add_parameter(Parameter(
         "UseEFS",
         Description="Switch for using EFS or not.  If this true, The template will auto-mount EFS to the cluster",
@@ -272,6 +434,136 @@ def main():
         Default='generalPurpose'
     ))
 
+    NewEFSThroughputMode = t.add_parameter(Parameter(
+        "NewEFSThroughputMode",
+        Description='The throughput mode of EFS file system.  In bursting mode, throughput scales with the size of the filesystem and a small filesystem can run out of burst credits in a long training.  It is used only when you don\'t specify existing EFS filesystem',
+        Type="String",
+        AllowedValues=['bursting', 'provisioned'],
+        Default='bursting'
+    ))
+    IsEFSProvisioned = Equals('provisioned', Ref(NewEFSThroughputMode))
+    t.add_condition('IsEFSProvisioned', IsEFSProvisioned)
+
+    NewEFSProvisionedThroughput = t.add_parameter(Parameter(
+        "NewEFSProvisionedThroughput",
+        Description='Throughput in MiB/s of new EFS filesystem in provisioned mode.  It is also used when the filesystem is switched to provisioned mode automatically.',
+        Type="Number",
+        MinValue=1,
+        MaxValue=1024,
+        Default=100
+    ))
+
+    EFSBurstCreditThreshold = t.add_parameter(Parameter(
+        "EFSBurstCreditThreshold",
+        Description='EFSBurstCreditAlarm goes off when BurstCreditBalance of new EFS filesystem falls below this number of bytes.',
+        Type="Number",
+        MinValue=0,
+        Default=100000000000
+    ))
+
+    EFSAutoProvisionThroughput = t.add_parameter(Parameter(
+        "EFSAutoProvisionThroughput",
+        Description='Switch for automatic throughput mode change.  If this is true, the master switches new EFS filesystem to provisioned mode with NewEFSProvisionedThroughput when EFSBurstCreditAlarm goes off.  Note that updating the stack with NewEFSThroughputMode=bursting switches it back.',
+        Type="String",
+        Default="False",
+        AllowedValues=["True", "False"]
+    ))
+    EFSAutoProvisionEnabled = And(Condition('ShouldCreateEFS'), Equals("True", Ref(EFSAutoProvisionThroughput)))
+    t.add_condition('EFSAutoProvisionEnabled', EFSAutoProvisionEnabled)
+
+    EFSCache = t.add_parameter(Parameter(
+        "EFSCache",
+        Description='Local read cache of EFS.  If this is not None, EFS is mounted with FS-Cache (fsc) and cachefilesd caches pages read from EFS on the instance store or on a dedicated EBS volume of each node, so that later epochs are served from local disk.  When the instance type has no instance store, the root volume is used.',
+        Type="String",
+        AllowedValues=['None', 'InstanceStore', 'EBS'],
+        Default='None'
+    ))
+    EFSCacheEnabled = And(Condition('EFSEnabled'), Not(Equals('None', Ref(EFSCache))))
+    t.add_condition('EFSCacheEnabled', EFSCacheEnabled)
+    EFSCacheOnEBS = And(Condition('EFSEnabled'), Equals('EBS', Ref(EFSCache)))
+    t.add_condition('EFSCacheOnEBS', EFSCacheOnEBS)
+    EFSCacheOnInstanceStore = And(Condition('EFSEnabled'), Equals('InstanceStore', Ref(EFSCache)))
+    t.add_condition('EFSCacheOnInstanceStore', EFSCacheOnInstanceStore)
+
+    EFSCacheVolumeSize = t.add_parameter(Parameter(
+        "EFSCacheVolumeSize",
+        Description='Size(GiB) of EBS volume for the EFS cache of each node.  It is used only when EFSCache is EBS.',
+        Type="Number",
+        MinValue=1,
+        Default=200
+    ))
+
+    EFSCacheCullThresholds = t.add_parameter(Parameter(
+        "EFSCacheCullThresholds",
+        Description='Free space thresholds (percent) of the cache device: cachefilesd stops culling above brun, starts culling below bcull and stops caching below bstop.',
+        Type="String",
+        AllowedPattern="\\d{1,2},\\d{1,2},\\d{1,2}",
+        ConstraintDescription="must be brun,bcull,bstop e.g. 10,7,3",
+        Default="10,7,3"
+    ))
+
+    # PercentIOLimit is reported only for General Purpose filesystems.
+    ShouldAlarmEFSIOLimit = And(Condition('ShouldCreateEFS'), Equals('generalPurpose', Ref(NewEFSPerformanceMode)))
+    t.add_condition('ShouldAlarmEFSIOLimit', ShouldAlarmEFSIOLimit)
+
+    NodeBundleURL = t.add_parameter(Parameter(
+        "NodeBundleURL",
+        Description="URL of the node bundle (tar.gz) which contains helper programs installed to /opt/chainer-cfn on each cluster node.  You usually don't need to change this.",
+        Default=NODE_BUNDLE_URL,
+        Type="String"
+    ))
+
+    EnablePreflight = t.add_parameter(Parameter(
+        "EnablePreflight",
+        Description="Switch for pre-flight check.  If this is true, each node checks GPU matmul throughput, ECC errors, XID events and network bandwidth against thresholds of the instance type before signaling.  Workers which fail the check are replaced.  Results are stored in s3://<AssetBucket>/preflight/.",
+        Type="String",
+        Default="True",
+        AllowedValues=["True", "False"]
+    ))
+    PreflightEnabled = Equals("True", Ref(EnablePreflight))
+    t.add_condition("PreflightEnabled", PreflightEnabled)
+
+    StragglerThreshold = t.add_parameter(Parameter(
+        "StragglerThreshold",
+        Description="StragglerAlarm goes off when the step time of the slowest host is this percent larger than the median host.  Training scripts report step time with chainer_cfn.straggler.StragglerReport extension.",
+        Default=20,
+        MinValue=0,
+        Type="Number"
+    ))
+
+    EnableRegistryCache = t.add_parameter(Parameter(
+        "EnableRegistryCache",
+        Description="Switch for the pull-through container registry cache.  If this is true, the master runs a registry mirror of RegistryCacheUpstream on port 5000 and the docker daemon of every node uses it, so that each image layer is downloaded from the upstream only once.",
+        Type="String",
+        Default="False",
+        AllowedValues=["True", "False"]
+    ))
+    RegistryCacheEnabled = Equals("True", Ref(EnableRegistryCache))
+    t.add_condition("RegistryCacheEnabled", RegistryCacheEnabled)
+
+    RegistryCacheUpstream = t.add_parameter(Parameter(
+        "RegistryCacheUpstream",
+        Description="URL of the upstream registry of the cache.  Docker uses registry mirrors only for Docker Hub images; images of other registries can be pulled through the cache as <master>:5000/<repository>.",
+        Type="String",
+        Default="https://registry-1.docker.io"
+    ))
+
+    RegistryCacheStorage = t.add_parameter(Parameter(
+        "RegistryCacheStorage",
+        Description="Where the registry cache stores image layers.  EFS keeps the cache when the master is replaced.  It falls back to Local when EFS is not used.",
+        Type="String",
+        Default="Local",
+        AllowedValues=["Local", "EFS"]
+    ))
+
+    KernelCache = t.add_parameter(Parameter(
+        "KernelCache",
+        Description="Where the CuPy kernel cache shared by the cluster is.  EFS shares compiled kernels right away; AssetBucket restores them at bootstrap and merges them back every 10 minutes.  Nodes of different CUDA, driver or GPU architecture use separate caches.  EFS falls back to AssetBucket when EFS is not used.",
+        Type="String",
+        Default="EFS",
+        AllowedValues=["EFS", "AssetBucket", "None"]
+    ))
+
     #
     # Mapping
     #
@@ -294,19 +586,19 @@ def main():
         "us-west-2": {"AMI": "ami-ea403b92"}
     })
 
-    t.add_mapping('EBSOptimizationMap', {
-        "p3.2xlarge": {"EBSOptimized": True},
-        "p3.8xlarge": {"EBSOptimized": True},
-        "p3.16xlarge": {"EBSOptimized": True},
-        "p2.xlarge": {"EBSOptimized": True},
-        "p2.8xlarge": {"EBSOptimized": True},
-        "p2.16xlarge": {"EBSOptimized": True},
-        "g2.2xlarge": {"EBSOptimized": True},
-        "g2.8xlarge": {"EBSOptimized": False},
-        "g3.4xlarge": {"EBSOptimized": True},
-        "g3.8xlarge": {"EBSOptimized": True},
-        "g3.16xlarge": {"EBSOptimized": True}
-    })
+    # Capabilities of each instance type, see instance_types.py.
+    t.add_mapping('InstanceTypeMap', instance_types.mapping(instance_types.capabilities))
+
+    t.add_mapping('EBSOptimizationMap', instance_types.mapping(
+        lambda c: {"EBSOptimized": c['ebs_optimized']}))
+
+    # Host tuning profile applied by chainer-cfn-tune.  GpuClocks are the
+    # maximum application clocks "memory,graphics" (MHz) of the GPU.
+    t.add_mapping('TuningProfileMap', instance_types.mapping(instance_types.tuning_profile))
+
+    # Thresholds of pre-flight check.  MinGpuTflops is float32 matmul
+    # throughput per GPU, Min*Gbps are TCP throughput with 4 streams.
+    t.add_mapping('PreflightThresholdMap', instance_types.mapping(instance_types.preflight_thresholds))
 
     #
     # VPC and subnet
@@ -447,6 +739,44 @@ def main():
                         Resource=[
                             Join('/', [GetAtt(AssetBucket, "Arn"), '*'])
                         ]
+                    ),
+                    Statement(
+                        Sid="AllowWritePreflightResults",
+                        Effect=Allow,
+                        Action=[
+                            Action("s3", "PutObject")
+                        ],
+                        Resource=[
+                            Join('/', [GetAtt(AssetBucket, "Arn"), 'preflight', '*'])
+                        ]
+                    ),
+                    Statement(
+                        Sid="AllowWriteKernelCache",
+                        Effect=Allow,
+                        Action=[
+                            Action("s3", "PutObject")
+                        ],
+                        Resource=[
+                            Join('/', [GetAtt(AssetBucket, "Arn"), 'kernel-cache', '*'])
+                        ]
+                    ),
+                    Statement(
+                        Sid="AllowReportResumed",
+                        Effect=Allow,
+                        Action=[
+                            Action("s3", "PutObject")
+                        ],
+                        Resource=[
+                            Join('/', [GetAtt(AssetBucket, "Arn"), 'cluster-state', 'resumed', '*'])
+                        ]
+                    ),
+                    Statement(
+                        Sid="AllowMarkUnhealthy",
+                        Effect=Allow,
+                        Action=[
+                            Action("autoscaling", "SetInstanceHealth")
+                        ],
+                        Resource=['*']
                     )
                 ]
             )
@@ -480,7 +810,18 @@ def main():
                         Sid="CloudWatchPutMetricData",
                         Effect=Allow,
                         Action=[
-                            Action('cloudwatch', 'PutMetricData')
+                            Action('cloudwatch', 'PutMetricData'),
+                            Action('cloudwatch', 'SetAlarmState'),
+                            Action('cloudwatch', 'DescribeAlarms')
+                        ],
+                        Resource=['*']
+                    ),
+                    Statement(
+                        Sid="EFSThroughputMode",
+                        Effect=Allow,
+                        Action=[
+                            Action('elasticfilesystem', 'DescribeFileSystems'),
+                            Action('elasticfilesystem', 'UpdateFileSystem')
                         ],
                         Resource=['*']
                     ),
@@ -501,7 +842,8 @@ def main():
                         Action=[
                             Action("s3", "AbortMultipartUpload"),
                             Action("s3", "ListMultipartUploadParts"),
-                            Action("s3", "PutObject")
+                            Action("s3", "PutObject"),
+                            Action("s3", "GetObject")
                         ],
                         Resource=[
                             Join('/', [GetAtt(AssetBucket, "Arn"), '*'])
@@ -582,6 +924,12 @@ def main():
         "EFSFileSystem",
         Condition="ShouldCreateEFS",
         PerformanceMode=Ref(NewEFSPerformanceMode),
+        ThroughputMode=Ref(NewEFSThroughputMode),
+        ProvisionedThroughputInMibps=If(
+            'IsEFSProvisioned',
+            Ref(NewEFSProvisionedThroughput),
+            Ref(AWS_NO_VALUE)
+        )
     ))
     targetFileSystem=If(
         "EFSEnabled",
@@ -625,7 +973,70 @@ def main():
     #
     ClusterPlacementGroup = t.add_resource(PlacementGroup(
         "ClusterPlacementGroup",
-        Strategy='cluster'
+        Strategy=If("IsPlacementPartition", 'partition', 'cluster'),
+        PartitionCount=If("IsPlacementPartition", Ref(PlacementPartitionCount), NoValue)
+    ))
+    for i in EXTRA_WORKER_GROUPS:
+        t.add_resource(PlacementGroup(
+            "WorkerGroup%dPlacementGroup" % i,
+            Strategy='cluster',
+            Condition="HasWorkerGroup%dPlacementGroup" % i
+        ))
+
+    #
+    # Alarms
+    #
+    StragglerAlarm = t.add_resource(Alarm(
+        "StragglerAlarm",
+        AlarmDescription=Join('', [
+            'Step time of the slowest host in ', StackName,
+            ' is larger than the median host.  The state reason names the slowest host.'
+        ]),
+        Namespace='ChainerCluster/Training',
+        MetricName='StepTimeSpread',
+        Dimensions=[MetricDimension(Name='ChainerClusterName', Value=StackName)],
+        Statistic='Maximum',
+        Period=60,
+        EvaluationPeriods=3,
+        Threshold=Ref(StragglerThreshold),
+        ComparisonOperator='GreaterThanThreshold',
+        TreatMissingData='notBreaching'
+    ))
+
+    EFSBurstCreditAlarm = t.add_resource(Alarm(
+        "EFSBurstCreditAlarm",
+        Condition="ShouldCreateEFS",
+        AlarmDescription=Join('', [
+            'Burst credits of EFS filesystem of ', StackName,
+            ' are running out.  Throughput drops to the baseline when they are exhausted.'
+        ]),
+        Namespace='AWS/EFS',
+        MetricName='BurstCreditBalance',
+        Dimensions=[MetricDimension(Name='FileSystemId', Value=Ref(EFSFileSystem))],
+        Statistic='Minimum',
+        Period=300,
+        EvaluationPeriods=1,
+        Threshold=Ref(EFSBurstCreditThreshold),
+        ComparisonOperator='LessThanThreshold',
+        TreatMissingData='notBreaching'
+    ))
+
+    EFSPercentIOLimitAlarm = t.add_resource(Alarm(
+        "EFSPercentIOLimitAlarm",
+        Condition="ShouldAlarmEFSIOLimit",
+        AlarmDescription=Join('', [
+            'EFS filesystem of ', StackName,
+            ' is close to the I/O limit of General Purpose performance mode.'
+        ]),
+        Namespace='AWS/EFS',
+        MetricName='PercentIOLimit',
+        Dimensions=[MetricDimension(Name='FileSystemId', Value=Ref(EFSFileSystem))],
+        Statistic='Maximum',
+        Period=300,
+        EvaluationPeriods=3,
+        Threshold='95',
+        ComparisonOperator='GreaterThanThreshold',
+        TreatMissingData='notBreaching'
     ))
 
     #
@@ -651,6 +1062,136 @@ def main():
             }
         }
     )
+    nodeBundleInitConfig = cloudformation.InitConfig(
+        sources={
+            '/opt/chainer-cfn': Ref(NodeBundleURL)
+        },
+        commands={
+            # make chainer_cfn importable from training scripts
+            '01_add_to_python_path': {
+                'command': 'echo /opt/chainer-cfn > $(python3 -c "import site; print(site.getsitepackages()[0])")/chainer-cfn.pth'
+            },
+            '02_link_commands': {
+                'command': 'ln -sf /opt/chainer-cfn/bin/* /usr/local/bin/'
+            }
+        }
+    )
+    def preflightThresholds(instanceType):
+        return {
+            k: findInInstanceTypeMap("PreflightThresholdMap", instanceType, k)
+            for k in ['GpuCount', 'MinGpuTflops', 'MinLoopbackGbps', 'MinMasterGbps']
+        }
+
+    def tuningProfile(instanceType):
+        return {
+            k: findInInstanceTypeMap("TuningProfileMap", instanceType, k)
+            for k in ['GpuClocks', 'Mtu', 'TcpMaxBuffer', 'IrqCpuCount']
+        }
+
+    def instanceCapabilities(instanceType):
+        # capabilities of the instance type of a node, e.g. to find the cache
+        # device; see instance_types.py
+        return {
+            k: findInInstanceTypeMap("InstanceTypeMap", instanceType, key)
+            for k, key in [('gpus', 'GpuCount'), ('gpu_model', 'GpuModel'), ('numa_nodes', 'NumaNodes'),
+                           ('network_gbps', 'NetworkGbps'), ('instance_store', 'InstanceStoreCount'),
+                           ('instance_store_nvme', 'InstanceStoreNvme'), ('ebs_nvme', 'EbsNvme'),
+                           ('efa', 'Efa')]
+        }
+
+    # used to write the hostfile of each group and the default hostfile
+    # which contains only the nodes with GPUs, and to bind the ranks of a
+    # group launched from a node with another layout.
+    nodeGroups = [{
+        'name': name,
+        'instance_type': instanceType,
+        'gpus': findInInstanceTypeMap("InstanceTypeMap", instanceType, 'GpuCount'),
+        'numa_nodes': findInInstanceTypeMap("InstanceTypeMap", instanceType, 'NumaNodes')
+    } for name, instanceType in [('master', masterInstanceType)] + [
+        (g['name'], g['instance_type']) for g in workerGroups
+    ]]
+    fscacheConfig = {
+        'mode': If('EFSCacheEnabled', Ref(EFSCache), 'None'),
+        'cull': Ref(EFSCacheCullThresholds)
+    }
+    # mounted again by the agent after the node is stopped and started
+    efsMountConfig = {
+        'source': Join('', [targetFileSystem, '.efs.', Region, '.amazonaws.com:/']),
+        'options': If('EFSCacheEnabled', 'nfsvers=4.1,fsc', 'nfsvers=4.1')
+    }
+    registryCacheConfig = {
+        'enabled': Ref(EnableRegistryCache),
+        'upstream': Ref(RegistryCacheUpstream),
+        'storage': Ref(RegistryCacheStorage)
+    }
+    masterNodeConfigInitConfig = cloudformation.InitConfig(
+        files={
+            '/etc/chainer-cfn/node.json': {
+                'content': {
+                    'cluster_name': StackName,
+                    'role': 'Master',
+                    'node_group': 'master',
+                    'node_groups': nodeGroups,
+                    'region': Region,
+                    'asset_bucket': Ref(AssetBucket),
+                    'efs_mount_point': If("EFSEnabled", Join('', ['/', Ref(EFSMountPoint)]), ''),
+                    'efs_mount': efsMountConfig,
+                    'instance': instanceCapabilities(masterInstanceType),
+                    'preflight': preflightThresholds(masterInstanceType),
+                    'tuning': tuningProfile(masterInstanceType),
+                    'fscache': fscacheConfig,
+                    'registry_cache': registryCacheConfig,
+                    'kernel_cache': {'mode': Ref(KernelCache)},
+                    'efs_throughput': {
+                        'auto_provision': If('EFSAutoProvisionEnabled', 'True', 'False'),
+                        'file_system_id': If('ShouldCreateEFS', Ref(EFSFileSystem), ''),
+                        'alarm_name': If('ShouldCreateEFS', Ref(EFSBurstCreditAlarm), ''),
+                        'provisioned_mibps': Ref(NewEFSProvisionedThroughput)
+                    },
+                    'straggler': {
+                        'threshold_percent': Ref(StragglerThreshold),
+                        'alarm_name': Ref(StragglerAlarm)
+                    }
+                },
+                'mode': '000644',
+                'owner': 'root',
+                'group': 'root'
+            }
+        }
+    )
+    def workerNodeConfigInitConfig(group):
+        return cloudformation.InitConfig(
+            files={
+                '/etc/chainer-cfn/node.json': {
+                    'content': {
+                        'cluster_name': StackName,
+                        'role': 'Worker',
+                        'node_group': group['name'],
+                        'node_groups': nodeGroups,
+                        'region': Region,
+                        'asset_bucket': Ref(AssetBucket),
+                        'efs_mount_point': If("EFSEnabled", Join('', ['/', Ref(EFSMountPoint)]), ''),
+                        'efs_mount': efsMountConfig,
+                        'instance': instanceCapabilities(group['instance_type']),
+                        'preflight': preflightThresholds(group['instance_type']),
+                        'tuning': tuningProfile(group['instance_type']),
+                        'fscache': fscacheConfig,
+                        'registry_cache': registryCacheConfig,
+                        'kernel_cache': {'mode': Ref(KernelCache)}
+                    },
+                    'mode': '000644',
+                    'owner': 'root',
+                    'group': 'root'
+                }
+            }
+        )
+    tuningInitConfig = cloudformation.InitConfig(
+        commands={
+            'tune': {
+                'command': 'python3 /opt/chainer-cfn/bin/chainer-cfn-tune'
+            }
+        }
+    )
     sshClientConfigInitConfig = cloudformation.InitConfig(
         files={
             '/home/chainer/.ssh/environment': {
@@ -689,7 +1230,7 @@ def main():
                     'region=$(curl -sL http://169.254.169.254/latest/meta-data/placement/availability-zone | sed -e \'s/.$//\')\n',
                     'CLUSTER_KEY_BUCKET_NAME=', Ref(AssetBucket), '\n',
                     'aws s3 --region $region cp $SSH_DIR/id_rsa s3://$CLUSTER_KEY_BUCKET_NAME/.ssh/id_rsa\n',
-                    'aws s3 --region $region cp $SSH_DIR/id_rsa.pub s3://$CLUSTER_KEY_BUCKET_NAME/.ssh/id_rsa.pub/\n',
+                    'aws s3 --region $region cp $SSH_DIR/id_rsa.pub s3://$CLUSTER_KEY_BUCKET_NAME/.ssh/id_rsa.pub\n',
                     'aws s3 --region $region cp $SSH_DIR/authorized_keys s3://$CLUSTER_KEY_BUCKET_NAME/.ssh/authorized_keys\n',
                     'cat ~ubuntu/.ssh/authorized_keys >> $SSH_DIR/authorized_keys\n'
                 ]),
@@ -705,108 +1246,14 @@ def main():
         }
     )
 
-    hostfileUpdaterInitConfig = cloudformation.InitConfig(
-        files={
-            '/root/hostfile-updater.sh':{
-                'content': Join('', [
-                    '#! /bin/bash\n',
-                    'region=$(curl -sL http://169.254.169.254/latest/meta-data/placement/availability-zone | sed -e \'s/.$//\')\n',
-                    'aws ec2 describe-instances',
-                    '  --region=$region',
-                    '  --filters "Name=tag:ChainerClusterName,Values=', StackName, '"',
-                    '  --query=\'Reservations[*][].Instances[?PrivateDnsName!=``][].PrivateDnsName\'',
-                    '  --output text | sed -e \'s/\\t/\\n/g\' > /tmp/hostfile.generated\n',
-                    'chown chainer:chainer /tmp/hostfile.generated\n',
-                    'chmod 644 /tmp/hostfile.generated\n',
-                    'mv /tmp/hostfile.generated /usr/local/mpi/etc/openmpi-default-hostfile\n'
-                ]),
-                'mode': '0755',
-                'owner': 'root',
-                'group': 'root'
-            },
-            '/etc/cron.d/hostfile-updater': {
-                'content': Join('', [
-                    'SHELL=/bin/bash\n',
-                    'PATH=/sbin:/bin:/usr/sbin:/usr/bin:/usr/local/bin\n',
-                    'MAILTO=""\n',
-                    'HOME=/\n',
-                    '*/1 * * * * root /root/hostfile-updater.sh\n',
-                ]),
-                'mode': '000644',
-                'owner': 'root',
-                'group': 'root'
-            }
-        },
-        services={
-            'sysvinit': cloudformation.InitServices({
-                "cron": cloudformation.InitService(
-                    enabled=True,
-                    ensureRunning=True,
-                    files=[
-                        '/etc/cron.d/hostfile-updater',
-                        '/root/hostfile-updater.sh'
-                    ]
-                )
-            })
-        }
-    )
-
     pullClusterKeyInitConfig = cloudformation.InitConfig(
-        files={
-            '/root/pull-cluster-key.sh': {
-                'content': Join('', [
-                    '#! /bin/bash\n',
-                    'SSH_DIR=~chainer/.ssh\n',
-                    'mkdir -p $SSH_DIR\n',
-                    'chmod 755 $SSH_DIR\n',
-                    'chown chainer:chainer $SSH_DIR\n',
-                    'region=$(curl -sL http://169.254.169.254/latest/meta-data/placement/availability-zone | sed -e \'s/.$//\')\n',
-                    'CLUSTER_KEY_BUCKET_NAME=', Ref(AssetBucket), '\n',
-                    'TMP_DIR=$(mktemp -d)\n',
-                    'aws s3 --region $region cp s3://$CLUSTER_KEY_BUCKET_NAME/.ssh/id_rsa $TMP_DIR/id_rsa\n',
-                    'aws s3 --region $region cp s3://$CLUSTER_KEY_BUCKET_NAME/.ssh/id_rsa.pub $TMP_DIR/id_rsa.pub\n',
-                    'aws s3 --region $region cp s3://$CLUSTER_KEY_BUCKET_NAME/.ssh/authorized_keys $TMP_DIR/authorized_keys\n',
-                    'chmod 600 $TMP_DIR/id_rsa\n',
-                    'chmod 644 $TMP_DIR/id_rsa.pub\n',
-                    'chmod 600 $TMP_DIR/authorized_keys\n',
-                    'cat ~ubuntu/.ssh/authorized_keys >> $TMP_DIR/authorized_keys\n'
-                    'chown chainer:chainer $TMP_DIR/*\n',
-                    'mv $TMP_DIR/* $SSH_DIR/\n',
-                    'rm -rf $TMP_DIR\n'
-                ]),
-                'mode': '000755',
-                'owner': 'root',
-                'group': 'root'
-            },
-            '/etc/cron.d/pull-cluster-key': {
-                'content': Join('', [
-                    'SHELL=/bin/bash\n',
-                    'PATH=/sbin:/bin:/usr/sbin:/usr/bin:/usr/local/bin\n',
-                    'MAILTO=""\n',
-                    'HOME=/\n',
-                    '* * * * * root /root/pull-cluster-key.sh\n',
-                ]),
-                'mode': '000644',
-                'owner': 'root',
-                'group': 'root'
-            }
-        },
         commands={
             'pull-cluster-key': {
-                'command':'/root/pull-cluster-key.sh'
+                'command': 'python3 /opt/chainer-cfn/bin/chainer-cfn-agent once cluster_key',
+                # workers start with the master, which may not have uploaded
+                # the key yet; the agent pulls it every minute anyway.
+                'ignoreErrors': 'true'
             }
-        },
-        services={
-            'sysvinit': cloudformation.InitServices({
-                "cron": cloudformation.InitService(
-                    enabled=True,
-                    ensureRunning=True,
-                    files=[
-                        '/etc/cron.d/pull-cluster-key',
-                        '/root/pull-cluster-key.sh'
-                    ]
-                )
-            })
         }
     )
 
@@ -817,14 +1264,17 @@ def main():
                     'mkdir -p /', Ref(EFSMountPoint), '\n'
                 ])
             },
-            '02_mount': {
+            '02_fscache': {
+                'command': 'python3 /opt/chainer-cfn/bin/chainer-cfn-fscache setup'
+            },
+            '03_mount': {
                 'command': Join('', [
-                    'mount -t nfs4 -o nfsvers=4.1 ',
+                    'mount -t nfs4 -o ', If('EFSCacheEnabled', 'nfsvers=4.1,fsc ', 'nfsvers=4.1 '),
                     targetFileSystem, '.efs.', Region, '.amazonaws.com:/ ',
                     '/', Ref(EFSMountPoint)
                 ])
             },
-            '03_permissions': {
+            '04_permissions': {
                 'command': Join('', [
                     'chown chainer:chainer /', Ref(EFSMountPoint), '\n',
                 ])
@@ -832,100 +1282,50 @@ def main():
         }
     )
 
-    nfsStatInitConfig = cloudformation.InitConfig(
-        files={
-            '/root/post-nfsstat.sh': {
-                'content': Sub(textwrap.dedent('''
-                    #!/bin/bash
-
-                    INPUT="$(cat)"
-                    CW_JSON_OPEN='{ "Namespace": "EFS", "MetricData": [ '
-                    CW_JSON_CLOSE=' ] }'
-                    CW_JSON_METRIC=''
-                    METRIC_COUNTER=0
-
-                    for COL in 1 2 3 4 5 6; do
-
-                     COUNTER=0
-                     METRIC_FIELD=$COL
-                     DATA_FIELD=$(($COL+($COL-1)))
-
-                     while read line; do
-                       if [[ COUNTER -gt 0 ]]; then
-
-                         LINE=`echo $line | tr -s ' ' `
-                         AWS_COMMAND="aws cloudwatch put-metric-data --region ${AWS::Region}"
-                         MOD=$(( $COUNTER % 2))
-
-                         if [ $MOD -eq 1 ]; then
-                           METRIC_NAME=`echo $LINE | cut -d ' ' -f $METRIC_FIELD`
-                         else
-                           METRIC_VALUE=`echo $LINE | cut -d ' ' -f $DATA_FIELD`
-                         fi
-
-                         if [[ -n "$METRIC_NAME" && -n "$METRIC_VALUE" ]]; then
-                           INSTANCE_ID=$(curl -s http://169.254.169.254/latest/meta-data/instance-id)
-                           CW_JSON_METRIC="$CW_JSON_METRIC { \"MetricName\": \"$METRIC_NAME\", \"Dimensions\": [{\"Name\": \"InstanceId\", \"Value\": \"$INSTANCE_ID\"} ], \"Value\": $METRIC_VALUE },"
-                           unset METRIC_NAME
-                           unset METRIC_VALUE
-
-                           METRIC_COUNTER=$((METRIC_COUNTER+1))
-                           if [ $METRIC_COUNTER -eq 20 ]; then
-                             # 20 is max metric collection size, so we have to submit here
-                             aws cloudwatch put-metric-data --region ${AWS::Region} --cli-input-json "`echo $CW_JSON_OPEN ${!CW_JSON_METRIC%?} $CW_JSON_CLOSE`"
-
-                             # reset
-                             METRIC_COUNTER=0
-                             CW_JSON_METRIC=''
-                           fi
-                         fi
-
-
-
-                         COUNTER=$((COUNTER+1))
-                       fi
-
-                       if [[ "$line" == "Client nfs v4:" ]]; then
-                         # the next line is the good stuff
-                         COUNTER=$((COUNTER+1))
-                       fi
-                     done <<< "$INPUT"
-                    done
-
-                    # submit whatever is left
-                    aws cloudwatch put-metric-data --region ${AWS::Region} --cli-input-json "`echo $CW_JSON_OPEN ${!CW_JSON_METRIC%?} $CW_JSON_CLOSE`"
-                ''').strip()),
-                'mode': '000755',
-                'owner': 'root',
-                'group': 'root'
+    agentInitConfig = cloudformation.InitConfig(
+        commands={
+            '01_install_boto3': {
+                'command': 'python3 -m pip install boto3',
+                'test': '! python3 -c "import boto3"'
             },
-            '/etc/cron.d/post-nfsstat': {
-                'content': Sub(textwrap.dedent('''
-                    SHELL=/bin/bash
-                    PATH=/sbin:/bin:/usr/sbin:/usr/bin:/usr/local/bin
-                    MAILTO=""
-                    HOME=/
-                    * * * * * root /usr/sbin/nfsstat | /root/post_nfsstat
-                ''').strip()),
-                'mode': '000644',
-                'owner': 'root',
-                'group': 'root'
+            '02_install_initscript': {
+                'command': 'install -m 755 /opt/chainer-cfn/etc/init.d/chainer-cfn-agent /etc/init.d/chainer-cfn-agent'
             }
         },
         services={
             'sysvinit': cloudformation.InitServices({
-                "cron": cloudformation.InitService(
+                "chainer-cfn-agent": cloudformation.InitService(
                     enabled=True,
                     ensureRunning=True,
                     files=[
-                        '/etc/cron.d/post-nfsstat',
-                        '/root/post-nfsstat.sh'
+                        '/etc/chainer-cfn/node.json'
+                    ],
+                    sources=[
+                        '/opt/chainer-cfn'
                     ]
                 )
             })
         }
     )
 
+    # after the agent, which installs boto3 used to find the master.
+    registryCacheInitConfig = cloudformation.InitConfig(
+        commands={
+            '01_setup': {
+                'command': 'python3 /opt/chainer-cfn/bin/chainer-cfn-registry-cache setup'
+            }
+        }
+    )
+
+    # after the agent, which installs boto3, and EFS.
+    kernelCacheInitConfig = cloudformation.InitConfig(
+        commands={
+            '01_setup': {
+                'command': 'python3 /opt/chainer-cfn/bin/chainer-cfn-kernel-cache setup'
+            }
+        }
+    )
+
     #
     # Master
     #
@@ -938,10 +1338,10 @@ def main():
         "ClusterMaster",
         DependsOn=["EFSReadyWaitCondition"],
         ImageId=FindInMap("RegionMap", Ref("AWS::Region"), "AMI"),
-        InstanceType=Ref(InstanceType),
+        InstanceType=masterInstanceType,
         KeyName=Ref(KeyPairName),
         IamInstanceProfile=Ref(ClusterMasterInstanceProfile),
-        EbsOptimized=True,
+        EbsOptimized=findInInstanceTypeMap("EBSOptimizationMap", masterInstanceType, "EBSOptimized"),
         Monitoring=True,
         CreationPolicy=CreationPolicy(
             ResourceSignal=ResourceSignal(
@@ -964,10 +1364,31 @@ def main():
                     VolumeSize=Ref(RootVolumeSize),
                     VolumeType="gp2"
                 )
+            ),
+            If(
+                "EFSCacheOnEBS",
+                BlockDeviceMapping(
+                    DeviceName='/dev/sdf',
+                    Ebs=EBSBlockDevice(
+                        VolumeSize=Ref(EFSCacheVolumeSize),
+                        VolumeType="gp2",
+                        DeleteOnTermination=True
+                    )
+                ),
+                Ref(AWS_NO_VALUE)
+            ),
+            If(
+                "EFSCacheOnInstanceStore",
+                BlockDeviceMapping(
+                    DeviceName='/dev/sdb',
+                    VirtualName='ephemeral0'
+                ),
+                Ref(AWS_NO_VALUE)
             )
         ],
         Tags=trackingTags + Tags(
-            ChainerClusterRole='Master'
+            ChainerClusterRole='Master',
+            ChainerClusterNodeGroup='master'
         ),
         Metadata=If(
             "EFSEnabled",
@@ -976,19 +1397,27 @@ def main():
                     cloudformation.InitConfigSets(
                         install=[
                             'createChainerUser',
+                            'nodeBundle',
+                            'nodeConfig',
+                            'tuning',
                             'sshClientConfig',
                             'provisionClusterKey',
-                            'hostfileUpdater',
                             'nfsMount',
-                            'nfsStat'
+                            'agent',
+                            'registryCache',
+                            'kernelCache'
                         ]
                     ),
                     createChainerUser=createChainerUserInitConfig,
+                    nodeBundle=nodeBundleInitConfig,
+                    nodeConfig=masterNodeConfigInitConfig,
+                    tuning=tuningInitConfig,
                     sshClientConfig=sshClientConfigInitConfig,
                     provisionClusterKey=provisionClusterKeyInitConfig,
-                    hostfileUpdater=hostfileUpdaterInitConfig,
                     nfsMount=nfsMountInitConfig,
-                    nfsStat=nfsStatInitConfig
+                    agent=agentInitConfig,
+                    registryCache=registryCacheInitConfig,
+                    kernelCache=kernelCacheInitConfig
                 )
             ),
             cloudformation.Metadata(
@@ -996,15 +1425,25 @@ def main():
                     cloudformation.InitConfigSets(
                         install=[
                             'createChainerUser',
+                            'nodeBundle',
+                            'nodeConfig',
+                            'tuning',
                             'sshClientConfig',
                             'provisionClusterKey',
-                            'hostfileUpdater',
+                            'agent',
+                            'registryCache',
+                            'kernelCache'
                         ]
                     ),
                     createChainerUser=createChainerUserInitConfig,
+                    nodeBundle=nodeBundleInitConfig,
+                    nodeConfig=masterNodeConfigInitConfig,
+                    tuning=tuningInitConfig,
                     sshClientConfig=sshClientConfigInitConfig,
                     provisionClusterKey=provisionClusterKeyInitConfig,
-                    hostfileUpdater=hostfileUpdaterInitConfig
+                    agent=agentInitConfig,
+                    registryCache=registryCacheInitConfig,
+                    kernelCache=kernelCacheInitConfig
                 )
             )
         ),
@@ -1016,63 +1455,53 @@ def main():
             "         --resource ClusterMaster",
             "         --configsets install",
             "         --region ", Region, "\n",
-            "",
+            "# the master is never replaced, its pre-flight check result is just recorded\n",
+            If("PreflightEnabled", "python3 /opt/chainer-cfn/bin/chainer-cfn-preflight || true\n", ""),
             "/usr/local/bin/cfn-signal -e $? ",
             "         --stack ", StackName,
             "         --resource ClusterMaster ",
-            "         --region ", Region, "\n"
+            "         --region ", Region, "\n",
+            "python3 /opt/chainer-cfn/bin/chainer-cfn-agent report-bootstrap || true\n"
         ]))
     ))
 
     #
-    # Worker (Auto Scaling Group)
+    # Worker (Auto Scaling Group per worker group)
     #
     ClusterWorkerInstanceProfile = t.add_resource(InstanceProfile(
         "ClusterWorkerInstanceProfile",
         Roles=[Ref(ClusterWorkerRole)]
     ))
-    WorkerLC = t.add_resource(LaunchConfiguration(
-        "WorkerLC",
-        DependsOn=["EFSReadyWaitCondition"],
-        ImageId=FindInMap("RegionMap", Ref("AWS::Region"), "AMI"),
-        InstanceType=Ref(InstanceType),
-        KeyName=Ref(KeyPairName),
-        IamInstanceProfile=Ref(ClusterWorkerInstanceProfile),
-        EbsOptimized=True,
-        SecurityGroups=[
-            Ref(ClusterMemberMarkerSg),
-            Ref(AllowSSHFromExternalSG),
-            Ref(AllowAllAmongClusterMember)
-        ],
-        BlockDeviceMappings=[
-            BlockDeviceMapping(
-                DeviceName='/dev/sda1',
-                Ebs=EBSBlockDevice(
-                    VolumeSize=Ref(RootVolumeSize),
-                    VolumeType="gp2"
-                )
-            )
-        ],
-        Metadata=If(
+
+    def workerMetadata(nodeConfig):
+        return If(
             "EFSEnabled",
             cloudformation.Metadata(
                 cloudformation.Init(
                     cloudformation.InitConfigSets(
                         install=[
                             'createChainerUser',
+                            'nodeBundle',
+                            'nodeConfig',
+                            'tuning',
                             'sshClientConfig',
                             'pullClusterKey',
-                            'hostfileUpdater',
                             'nfsMount',
-                            'nfsStat'
+                            'agent',
+                            'registryCache',
+                            'kernelCache'
                         ]
                     ),
                     createChainerUser=createChainerUserInitConfig,
+                    nodeBundle=nodeBundleInitConfig,
+                    nodeConfig=nodeConfig,
+                    tuning=tuningInitConfig,
                     sshClientConfig=sshClientConfigInitConfig,
                     pullClusterKey=pullClusterKeyInitConfig,
-                    hostfileUpdater=hostfileUpdaterInitConfig,
                     nfsMount=nfsMountInitConfig,
-                    nfsStat=nfsStatInitConfig
+                    agent=agentInitConfig,
+                    registryCache=registryCacheInitConfig,
+                    kernelCache=kernelCacheInitConfig
                 )
             ),
             cloudformation.Metadata(
@@ -1080,55 +1509,203 @@ def main():
                     cloudformation.InitConfigSets(
                         install=[
                             'createChainerUser',
+                            'nodeBundle',
+                            'nodeConfig',
+                            'tuning',
                             'sshClientConfig',
                             'pullClusterKey',
-                            'hostfileUpdater',
+                            'agent',
+                            'registryCache',
+                            'kernelCache'
                         ]
                     ),
                     createChainerUser=createChainerUserInitConfig,
+                    nodeBundle=nodeBundleInitConfig,
+                    nodeConfig=nodeConfig,
+                    tuning=tuningInitConfig,
                     sshClientConfig=sshClientConfigInitConfig,
                     pullClusterKey=pullClusterKeyInitConfig,
-                    hostfileUpdater=hostfileUpdaterInitConfig,
+                    agent=agentInitConfig,
+                    registryCache=registryCacheInitConfig,
+                    kernelCache=kernelCacheInitConfig
                 )
             ),
-        ),
-        UserData=Base64(Join('', [
-            "#!/bin/bash -xe\n",
-            "# Install the files and packages from the metadata\n",
-            "/usr/local/bin/cfn-init -v ",
-            "         --stack ", StackName,
-            "         --resource WorkerLC",
-            "         --configsets install",
-            "         --region ", Region, "\n",
-            "",
-            "/usr/local/bin/cfn-signal -e $? ",
-            "         --stack ", StackName,
-            "         --resource WorkerASG ",
-            "         --region ", Region, "\n"
-        ]))
-    ))
+        )
 
-    WorkerASG = t.add_resource(AutoScalingGroup(
-        "WorkerASG",
-        LaunchConfigurationName=Ref(WorkerLC),
-        VPCZoneIdentifier=[targetSubnet],
-        PlacementGroup=Ref(ClusterPlacementGroup),
-        MinSize=0,
-        DesiredCapacity=Ref(WorkerSize),
-        MaxSize=Ref(WorkerSize),
-        CreationPolicy=CreationPolicy(
-            ResourceSignal=ResourceSignal(
-                Timeout='PT30M',
-                Count=Ref(WorkerSize)
-            )
-        ),
-        MetricsCollection=[MetricsCollection(
-            Granularity='1Minute'
-        )],
-        Tags=troposphere.autoscaling.Tags(
-            ChainerClusterName=StackName,
-            ChainerClusterRole='Worker'
+    for group in workerGroups:
+        lcName = group['resource_prefix'] + 'LC'
+        asgName = group['resource_prefix'] + 'ASG'
+        conditional = {'Condition': group['condition']} if group['condition'] else {}
+
+        t.add_resource(LaunchConfiguration(
+            lcName,
+            DependsOn=["EFSReadyWaitCondition"],
+            ImageId=FindInMap("RegionMap", Ref("AWS::Region"), "AMI"),
+            InstanceType=group['instance_type'],
+            KeyName=Ref(KeyPairName),
+            IamInstanceProfile=Ref(ClusterWorkerInstanceProfile),
+            EbsOptimized=FindInMap("EBSOptimizationMap", group['instance_type'], "EBSOptimized"),
+            SecurityGroups=[
+                Ref(ClusterMemberMarkerSg),
+                Ref(AllowSSHFromExternalSG),
+                Ref(AllowAllAmongClusterMember)
+            ],
+            BlockDeviceMappings=[
+                BlockDeviceMapping(
+                    DeviceName='/dev/sda1',
+                    Ebs=EBSBlockDevice(
+                        VolumeSize=Ref(RootVolumeSize),
+                        VolumeType="gp2"
+                    )
+                ),
+                If(
+                    "EFSCacheOnEBS",
+                    BlockDeviceMapping(
+                        DeviceName='/dev/sdf',
+                        Ebs=EBSBlockDevice(
+                            VolumeSize=Ref(EFSCacheVolumeSize),
+                            VolumeType="gp2",
+                            DeleteOnTermination=True
+                        )
+                    ),
+                    Ref(AWS_NO_VALUE)
+                ),
+                If(
+                    "EFSCacheOnInstanceStore",
+                    BlockDeviceMapping(
+                        DeviceName='/dev/sdb',
+                        VirtualName='ephemeral0'
+                    ),
+                    Ref(AWS_NO_VALUE)
+                )
+            ],
+            Metadata=workerMetadata(workerNodeConfigInitConfig(group)),
+            UserData=Base64(Join('', [
+                "#!/bin/bash -xe\n",
+                "# Install the files and packages from the metadata\n",
+                "/usr/local/bin/cfn-init -v ",
+                "         --stack ", StackName,
+                "         --resource ", lcName,
+                "         --configsets install",
+                "         --region ", Region, "\n",
+                "# failed workers are marked unhealthy and never signal, so that they are replaced\n",
+                If("PreflightEnabled", "python3 /opt/chainer-cfn/bin/chainer-cfn-preflight --mark-unhealthy\n", ""),
+                "/usr/local/bin/cfn-signal -e $? ",
+                "         --stack ", StackName,
+                "         --resource ", asgName, " ",
+                "         --region ", Region, "\n",
+                "python3 /opt/chainer-cfn/bin/chainer-cfn-agent report-bootstrap || true\n"
+            ])),
+            **conditional
+        ))
+
+        # the groups share the placement group of the master, unless each
+        # additional group has its own one
+        if group['condition'] is None:
+            placementGroup = Ref(ClusterPlacementGroup)
+        else:
+            placementGroup = If("%sPlacementGroup" % group['condition'],
+                                Ref("%sPlacementGroup" % group['resource_prefix']),
+                                Ref(ClusterPlacementGroup))
+        t.add_resource(AutoScalingGroup(
+            asgName,
+            LaunchConfigurationName=Ref(lcName),
+            VPCZoneIdentifier=[targetSubnet],
+            PlacementGroup=placementGroup,
+            MinSize=0,
+            DesiredCapacity=group['size'],
+            MaxSize=group['size'],
+            CreationPolicy=CreationPolicy(
+                ResourceSignal=ResourceSignal(
+                    Timeout='PT30M',
+                    Count=group['size']
+                )
+            ),
+            MetricsCollection=[MetricsCollection(
+                Granularity='1Minute'
+            )],
+            Tags=troposphere.autoscaling.Tags(
+                ChainerClusterName=StackName,
+                ChainerClusterRole='Worker',
+                ChainerClusterNodeGroup=group['name']
+            ),
+            **conditional
+        ))
+
+    #
+    # Dashboard
+    #
+    def nodeMetricSearch(namespace, metric, stat='Average'):
+        # one line per node of this cluster
+        return {'expression': (
+            "SEARCH('{%s,ChainerClusterName,ChainerClusterRole,InstanceId} "
+            "MetricName=\"%s\" ChainerClusterName=\"${AWS::StackName}\"', '%s', 60)"
+        ) % (namespace, metric, stat), 'id': metric.lower(), 'label': metric}
+
+    def dashboardWidget(title, metrics, x, y, yAxisLabel=None, stat='Average'):
+        properties = {
+            'title': title,
+            'region': '${AWS::Region}',
+            'view': 'timeSeries',
+            'stacked': False,
+            'period': 60,
+            'stat': stat,
+            'metrics': metrics,
+        }
+        if yAxisLabel:
+            properties['yAxis'] = {'left': {'label': yAxisLabel, 'showUnits': False}}
+        return {'type': 'metric', 'x': x, 'y': y, 'width': 12, 'height': 6, 'properties': properties}
+
+    # metrics of optional worker groups are inserted as ${...} fragments
+    # so that they refer to the ASGs only when they exist.
+    asgMetrics = [['AWS/AutoScaling', 'GroupInServiceInstances', 'AutoScalingGroupName', '${WorkerASG}',
+                   {'label': 'workers'}]]
+    asgMetricVariables = {}
+    for group in workerGroups[1:]:
+        variable = group['resource_prefix'] + 'InServiceMetric'
+        asgMetrics.append('@@%s@@' % variable)
+        asgMetricVariables[variable] = If(
+            group['condition'],
+            Join('', [
+                ',["AWS/AutoScaling","GroupInServiceInstances","AutoScalingGroupName","',
+                Ref(group['resource_prefix'] + 'ASG'), '",{"label":"', group['name'], '"}]'
+            ]),
+            ''
         )
+    dashboardBody = json.dumps({'widgets': [
+        dashboardWidget('GPU utilization (%) per node', [
+            [nodeMetricSearch('ChainerCluster/GPU', 'GPUUtilization')]
+        ], 0, 0),
+        dashboardWidget('Least busy GPU (%) per node', [
+            [nodeMetricSearch('ChainerCluster/GPU', 'MinGPUUtilization')]
+        ], 12, 0),
+        dashboardWidget('EFS client throughput (bytes/s) per node', [
+            [nodeMetricSearch('EFS', 'ReadBytesPerSec')],
+            [nodeMetricSearch('EFS', 'WriteBytesPerSec')]
+        ], 0, 6),
+        dashboardWidget('EFS client latency (ms) per node', [
+            [nodeMetricSearch('EFS', 'ReadLatency')],
+            [nodeMetricSearch('EFS', 'WriteLatency')],
+            [nodeMetricSearch('EFS', 'MetadataLatency')]
+        ], 12, 6),
+        dashboardWidget('Network (bytes/s) per node', [
+            [nodeMetricSearch('ChainerCluster/Network', 'RxBytesPerSec')],
+            [nodeMetricSearch('ChainerCluster/Network', 'TxBytesPerSec')]
+        ], 0, 12),
+        dashboardWidget('TCP retransmits (%) per node', [
+            [nodeMetricSearch('ChainerCluster/Network', 'TcpRetransPercent')]
+        ], 12, 12),
+        dashboardWidget('Workers in service', asgMetrics, 0, 18),
+        dashboardWidget('Bootstrap duration (s) per node', [
+            [nodeMetricSearch('ChainerCluster/Agent', 'BootstrapDuration', 'Maximum')]
+        ], 12, 18, stat='Maximum'),
+    ]}, sort_keys=True, separators=(',', ':'))
+    for variable in asgMetricVariables:
+        dashboardBody = dashboardBody.replace(',"@@%s@@"' % variable, '${%s}' % variable)
+
+    ClusterDashboard = t.add_resource(Dashboard(
+        "ClusterDashboard",
+        DashboardBody=Sub(dashboardBody, **asgMetricVariables)
     ))
 
     #
@@ -1165,6 +1742,52 @@ def main():
             Condition="ShouldCreateEFS",
             Value=Ref(EFSMountTarget)
         ),
+        Output(
+            "EFSBurstCreditAlarm",
+            Description="CloudWatch alarm which goes off when burst credits of the EFS filesystem are running out.",
+            Condition="ShouldCreateEFS",
+            Value=Ref(EFSBurstCreditAlarm)
+        ),
+        Output(
+            "EFSPercentIOLimitAlarm",
+            Description="CloudWatch alarm which goes off when the EFS filesystem is close to its I/O limit.",
+            Condition="ShouldAlarmEFSIOLimit",
+            Value=Ref(EFSPercentIOLimitAlarm)
+        ),
+        Output(
+            "EFSMetrics",
+            Description="CloudWatch metrics (BurstCreditBalance, PercentIOLimit, MeteredIOBytes ...) of the EFS filesystem.",
+            Condition="ShouldCreateEFS",
+            Value=Join('', [
+                'https://console.aws.amazon.com/cloudwatch/home?region=', Region,
+                '#metricsV2:graph=~();namespace=AWS/EFS;dimensions=FileSystemId;search=', Ref(EFSFileSystem)
+            ])
+        ),
+        Output(
+            "PreflightResults",
+            Description="Location of pre-flight check results of each node.",
+            Condition="PreflightEnabled",
+            Value=Join('', ['s3://', Ref(AssetBucket), '/preflight/'])
+        ),
+        Output(
+            "RegistryCache",
+            Description="Pull-through container registry cache on the master.  Run `chainer-cfn-registry-cache prepull IMAGE...` on the master to pull images on all the nodes.",
+            Condition="RegistryCacheEnabled",
+            Value=Join('', [GetAtt(ClusterMaster, 'PrivateDnsName'), ':5000'])
+        ),
+        Output(
+            "Dashboard",
+            Description="CloudWatch dashboard of GPU utilization, EFS, network, workers in service and bootstrap duration of the cluster.",
+            Value=Join('', [
+                'https://console.aws.amazon.com/cloudwatch/home?region=', Region,
+                '#dashboards:name=', Ref(ClusterDashboard)
+            ])
+        ),
+        Output(
+            "StragglerAlarm",
+            Description="CloudWatch alarm which goes off when a host is slower than the others.",
+            Value=Ref(StragglerAlarm)
+        ),
         Output(
             "ClusterMemberMarkerSecurityGroup",
             Description="SecurityGroup which all instance in the cluster have.  You can use this source/destination security group when you add some rules to other security groups",
@@ -1,5 +1,25 @@
 from troposphere import *
+from troposphere import ec2
+from troposphere import efs
+from troposphere.validators import floatingpoint, integer
 
 
 def empty(x):
     return Equals("", x)
+
+
+class FileSystem(efs.FileSystem):
+    # troposphere 2.2.1 predates EFS throughput modes.
+    props = dict(
+        efs.FileSystem.props,
+        ThroughputMode=(str, False),
+        ProvisionedThroughputInMibps=(floatingpoint, False),
+    )
+
+
+class PlacementGroup(ec2.PlacementGroup):
+    # troposphere 2.2.1 predates partition placement groups.
+    props = dict(
+        ec2.PlacementGroup.props,
+        PartitionCount=(integer, False),
+    )